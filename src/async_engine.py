@@ -0,0 +1,975 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   asyncio engine of the DTZ Master Controller
+#   Alternative to the thread based engine in opc_ua_master.py, built on asyncua. The master server, the upstream
+#   sessions to the Panda, PiXtend and FHS servers, their reconnect loops and the pick-and-place sequence all run as
+#   coroutines in one event loop - no shared globals between threads. Several demonstrator cells (see cells.py)
+#   share the loop, the master server, the metrics and the telemetry, every cell has its own sessions and queue.
+#   Selected at startup with "python opc_ua_master.py --asyncio" or the environment variable DTZ_ENGINE=asyncio
+#   With ha_lease the sessions and the address space are set up first, the server starts once the lease is held -
+#   see failover.py
+
+from state_cache import StateCache
+from shelf_storage import ShelfStorage
+from motion_pipeline import CyclePlan, AsyncCycleRun
+from job_queue import JobScheduler
+from telemetry import TelemetryExporter
+from cells import CellRegistry
+from session_pool import CircuitBreaker, SessionNotConnected
+from node_cache import node_cache, browse_request, browse_results
+from supervisor import Backoff, CONNECTING, CONNECTED, BACKOFF, CONNECTION_VARIABLES
+from metrics import metrics, FAMILIES
+from historian import Historian, HistorianStorage
+from motion_tracker import MotionTracker
+from pick_sequencer import PickSequencer
+from publisher import Publisher, STATUS, initial_status
+from failover import FileLease, Replica, Standby
+from traffic_capture import recorder
+from diagnostics import diagnostics
+from config import FHS_REQUEST_KEYS
+from datetime import datetime
+from job_queue import FINISHED, JOB_EVENT_PROPERTIES
+import motion_tracker
+import motion_pipeline
+import job_queue
+import collections
+import asyncio
+import signal
+import atexit
+import json
+import logging
+import time
+import os
+
+from asyncua import Client, Server, ua, uamethod
+
+logger = logging.getLogger('dtz_master_controller')
+
+
+def node_writer(node, variant_type=None):
+    """
+    write(value) for the publisher - called in the event loop, the write itself runs as a task. asyncua refuses a
+    write with another variant type, e.g. an int for ConBeltDist
+    """
+    def write(value):
+        asyncio.ensure_future(node.write_value(value if variant_type is None else ua.Variant(value, variant_type)))
+    return write
+
+
+class AsyncStateCache(StateCache):
+    """
+    State cache for the event loop. Updates come from the subscription handlers running in the loop,
+    waiting is done with futures instead of blocking on the condition variable
+    """
+
+    def __init__(self):
+        StateCache.__init__(self)
+        self._waiters = []
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def update(self, key, value):
+        StateCache.update(self, key, value)
+        self._wake()
+
+    def invalidate(self, keys):
+        StateCache.invalidate(self, keys)
+        self._wake()
+
+    async def _wait(self, predicate, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                if deadline is None:
+                    await waiter
+                else:
+                    await asyncio.wait_for(waiter, max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                return predicate()
+        return True
+
+    async def wait_for_async(self, key, value, timeout=None, since=None):
+        return await self._wait(lambda: self._matches(key, value, since), timeout)
+
+    async def wait_change_async(self, since, timeout=None):
+        await self._wait(lambda: self._sequence > since, timeout)
+        return self._sequence
+
+
+class UpstreamHandler(object):
+    """
+    Subscription handler of one upstream session - feeds the cache and the heartbeat
+    """
+
+    def __init__(self, upstream, keys):
+        self.upstream = upstream
+        self.keys = keys  # nodeid -> cache key
+
+    def datachange_notification(self, node, val, data):
+        self.upstream.last_notification = time.time()
+        key = self.keys.get(node.nodeid)
+        if key is not None:
+            recorder.record("datachange", self.upstream.endpoint, key, val)
+            self.upstream.cell.state.update(key, val)
+            if key in self.upstream.callbacks:
+                self.upstream.callbacks[key](val)
+
+    def status_change_notification(self, status):
+        logger.debug("async: %s subscription status changed: %s", self.upstream.name, status)
+        self.upstream.lost.set()
+
+    def event_notification(self, event):
+        pass
+
+
+class AsyncHistorianStorage(HistorianStorage):
+    """
+    The history backend for asyncua - same store, the library awaits every call. Reads touch the segment files,
+    so they run in the executor
+    """
+
+    aware = True  # asyncua uses timezone aware datetimes
+
+    async def init(self):
+        pass
+
+    async def historize(self, server, node, series):
+        self._series[node.nodeid] = series
+        access = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.HistoryRead.mask
+        for attribute in (ua.AttributeIds.AccessLevel, ua.AttributeIds.UserAccessLevel):
+            access_value = (await node.read_attribute(attribute)).Value.Value | access
+            await node.write_attribute(attribute, ua.DataValue(ua.Variant(access_value, ua.VariantType.Byte)))
+        await node.write_attribute(ua.AttributeIds.Historizing, ua.DataValue(ua.Variant(True)))
+        await server.historize_node_data_change(node, count=0)
+
+    def datavalue(self, value, moment):
+        return ua.DataValue(ua.Variant(value), SourceTimestamp=moment, ServerTimestamp=moment)
+
+    async def new_historized_node(self, node_id, period, count=0):
+        HistorianStorage.new_historized_node(self, node_id, period, count)
+
+    async def save_node_value(self, node_id, datavalue):
+        HistorianStorage.save_node_value(self, node_id, datavalue)
+
+    async def read_node_history(self, node_id, start, end, nb_values):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, HistorianStorage.read_node_history, self, node_id, start, end, nb_values)
+
+    async def new_historized_event(self, source_id, evtypes, period, count=0):
+        HistorianStorage.new_historized_event(self, source_id, evtypes, period, count)
+
+    async def save_event(self, event):
+        pass
+
+    async def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    async def stop(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.historian.flush)
+
+
+class AsyncUpstream(object):
+    """
+    One upstream session, kept alive by its own reconnect coroutine - the asyncio counterpart of the
+    EndpointSupervisor: heartbeat from the subscription, circuit breaker, capped backoff with jitter
+    """
+
+    def __init__(self, cell, name, url, browse_paths=None, node_ids=None, state_keys=(), callbacks=None,
+                 backoff=None, stable_after=30):
+        self.cell = cell
+        self.name = name
+        self.url = url
+        self.browse_paths = browse_paths or {}
+        self.node_ids = node_ids or {}
+        self.state_keys = list(state_keys)
+        self.callbacks = callbacks or {}  # cache key -> function(val), called from the subscription
+        self.client = None
+        self.nodes = {}
+        self.connected = asyncio.Event()
+        self.lost = asyncio.Event()
+        self.last_notification = 0
+        self.heartbeat_timeout = 5.0  # set by run()
+        self.breaker = CircuitBreaker(name)
+        self.backoff = backoff or Backoff()
+        self.stable_after = stable_after
+        self.state = CONNECTING
+        self.reconnects = 0
+        self.retry_in = 0.0
+        self.last_error = ""
+        self._listeners = []
+
+    def node(self, key):
+        if not self.connected.is_set():
+            raise SessionNotConnected("async: {} not connected".format(self.name))
+        self.breaker.check()
+        return self.nodes[key]
+
+    @property
+    def endpoint(self):
+        # name in the traffic capture - "<cell>/panda" if there are several cells
+        return self.cell.prefix + self.name
+
+    async def _request(self, op, target, coroutine):
+        # target as recorded in the capture, see PooledSession._request
+        start = recorder.start()
+        with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op=op, **self.cell.labels):
+            try:
+                result = await coroutine
+            except ua.UaStatusCodeError as e:
+                recorder.record(op, self.endpoint, target, error=e, start=start)
+                self.breaker.record_success()  # the server answered
+                if e.code == ua.StatusCodes.BadNodeIdUnknown:
+                    # the address space of the server changed - resolve again with a new session
+                    node_cache.invalidate(self.url, str(e))
+                    self.breaker.trip("unknown node: {}".format(e))
+                    self.lost.set()
+                raise
+            except Exception as e:
+                recorder.record(op, self.endpoint, target, error=e, start=start)
+                self.breaker.record_failure(e)
+                if self.breaker.tripped.is_set():
+                    self.lost.set()
+                raise
+        recorder.record(op, self.endpoint, target, result, start=start)
+        self.breaker.record_success()
+        return result
+
+    async def call(self, key, method, *args):
+        return await self._request("call", [key, method] + list(args), self.node(key).call_method(method, *args))
+
+    async def read(self, key):
+        return await self._request("read", key, self.node(key).read_value())
+
+    async def read_many(self, keys):
+        """
+        Values of several nodes in one Read service call - {key: value}
+        """
+        keys = list(keys)
+        nodes = [self.node(key) for key in keys]
+        return dict(zip(keys, await self._request("read_many", keys, self.client.read_values(nodes))))
+
+    async def connect(self):
+        client = Client(self.url, timeout=4)
+        credentials = self.cell.master.credentials  # see security.py
+        start = recorder.start()
+        with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op="connect", **self.cell.labels):
+            try:
+                if credentials is not None:
+                    await credentials.secure_async_client(client, self.url)
+                await client.connect()
+            except Exception as e:
+                recorder.record("connect", self.endpoint, self.url, error=e, start=start)
+                if credentials is not None:
+                    credentials.forget(self.url)
+                raise
+        recorder.record("connect", self.endpoint, self.url, start=start)
+        self.client = client
+        nodes = {}
+        paths = list(self.browse_paths.values())
+        if paths:
+            # from the node cache if the namespace array is unchanged, otherwise one batched request
+            with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op="browse", **self.cell.labels):
+                namespaces = await client.get_namespace_array()
+                resolved = node_cache.lookup(self.url, namespaces, paths)
+                if resolved is None:
+                    results = await client.uaclient.translate_browsepaths_to_nodeids(browse_request(ua, paths))
+                    resolved = browse_results(ua, paths, results)
+                    node_cache.store(self.url, namespaces, resolved)
+            for key, path in self.browse_paths.items():
+                nodes[key] = client.get_node(resolved[tuple(path)])
+        for key, nodeid in self.node_ids.items():
+            nodes[key] = client.get_node(nodeid)
+
+        watched = [nodes[key] for key in self.state_keys]
+        heartbeat = client.get_node(ua.FourByteNodeId(ua.ObjectIds.Server_ServerStatus_CurrentTime))
+        handler = UpstreamHandler(self, dict((node.nodeid, key) for node, key in zip(watched, self.state_keys)))
+        if watched:
+            sub = await client.create_subscription(100, handler)
+            await sub.subscribe_data_change(watched)
+        # the heartbeat on its own, slower subscription - see state_cache.subscribe_state
+        sub = await client.create_subscription(self.heartbeat_timeout * 1000 / 3, handler)
+        await sub.subscribe_data_change(heartbeat)
+
+        self.nodes = nodes
+        self.last_notification = time.time()
+        self.lost.clear()
+        self.connected.set()
+        self.breaker.close()
+
+    async def disconnect(self, reason="disconnected"):
+        self.connected.clear()
+        self.breaker.open(reason)
+        self.cell.state.invalidate(self.state_keys)
+        client, self.client = self.client, None
+        if client is not None:
+            recorder.record("disconnect", self.endpoint, self.url)
+            try:
+                await client.disconnect()
+            except Exception as e:
+                logger.debug("async: %s disconnected with exception: %s", self.name, e)
+
+    def add_listener(self, listener):
+        """
+        listener(upstream) is called after every change of the connection state
+        """
+        self._listeners.append(listener)
+
+    def _set(self, state, error=None):
+        self.state = state
+        if error is not None:
+            self.last_error = str(error)
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                logger.debug("async: listener Catched Exception: %s", e)
+
+    def status(self):
+        return {"state": self.state, "breaker": self.breaker.state, "reconnects": self.reconnects,
+                "retry_in": round(self.retry_in, 1), "last_error": self.last_error}
+
+    async def run(self, heartbeat_timeout=5):
+        self.heartbeat_timeout = heartbeat_timeout
+        while True:
+            connected_at = None
+            try:
+                logger.debug("async: %s connecting to %s server", self.cell.name, self.name)
+                self.breaker.half_open()
+                self._set(CONNECTING)
+                await self.connect()
+                connected_at = time.time()
+                logger.debug("async: successful connected to %s", self.name)
+                self._set(CONNECTED, "")
+
+                # everything went fine? then wait until the subscription is lost, the heartbeat stops or
+                # the breaker was opened by failing requests
+                while True:
+                    try:
+                        await asyncio.wait_for(self.lost.wait(), heartbeat_timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        if time.time() - self.last_notification > heartbeat_timeout:
+                            break
+                raise ConnectionError("{} session lost - {}".format(
+                    self.name, self.breaker.reason if self.breaker.tripped.is_set() else "no heartbeat"))
+
+            except asyncio.CancelledError:
+                await self.disconnect()
+                raise
+            except Exception as e:
+                logger.debug("async: Catched Exception: %s", e, extra={"throttle": True})
+                error = e
+            await self.disconnect(str(error))
+
+            if connected_at is not None and time.time() - connected_at > self.stable_after:
+                self.backoff.reset()
+            self.retry_in = self.backoff.next()
+            self.reconnects += 1
+            metrics.inc("dtz_reconnects_total", server=self.name, **self.cell.labels)
+            logger.debug("async: no connection to %s server - trying again in %.1f seconds.", self.name,
+                         self.retry_in)
+            self._set(BACKOFF, error)
+            await asyncio.sleep(self.retry_in)
+
+
+class AsyncCell(object):
+    """
+    One demonstrator cell - its upstream sessions, state cache, storage, job queue and pick-and-place sequence
+    """
+
+    def __init__(self, master, config):
+        # master is the opc_ua_master module - the node definitions live there
+        self.master = master
+        self.config = config
+        self.name = config.name
+        self.labels = {"cell": config.name}
+        self.state = AsyncStateCache()
+        self.publisher = None
+        self.prefix = ""  # of the published variables, "<cell>/" if there are several cells
+        self.storage = ShelfStorage(config.storage_path)
+        self.shelf_nodes = []
+        self.jobs = job_queue.JobQueue(config.jobs_path, PickSequencer().configure(master.config))
+        self.jobs_event = asyncio.Event()
+        self.fhs_request_waiting = False
+        self.fhs_request_lock = asyncio.Lock()
+        self.plan = CyclePlan.from_config(master.config)
+        self.actions = {"robot": self.robot_phase, "storage": self.storage_phase, "belt": self.belt_phase}
+        self.last_cycle_timing = None
+        self.jobs_object = None
+        self.job_nodes = collections.OrderedDict()  # job_id -> Jobs/Job<id>
+        self.job_events = None
+        self.job_lock = asyncio.Lock()
+        self.history_nodes = []  # (node, series) - historized once the server is running
+        self.standby = None  # see failover.py - FHS requests are only remembered while it is not active
+        self.replica = None
+        self.tracker = MotionTracker().configure(master.config)  # deadlines of the moves, learned per cell
+        self.loop = asyncio.get_event_loop()
+        self.panda = AsyncUpstream(self, "panda", config.panda_url,
+                                   browse_paths=master.panda_browse_paths, state_keys=master.panda_state_keys)
+        self.pixtend = AsyncUpstream(self, "pixtend", config.pixtend_url,
+                                     browse_paths=master.pixtend_browse_paths, state_keys=master.pixtend_state_keys)
+        self.fhs = AsyncUpstream(self, "fhs", config.fhs_url, node_ids=master.fhs_node_ids,
+                                 state_keys=["NewValAvailable"],
+                                 callbacks={"NewValAvailable": self.new_val_available})
+
+    ################ SERVER SETUP ################
+    async def add_nodes(self, idx, cell_object, publisher, job_events, prefix=""):
+        self.publisher = publisher
+        self.prefix = prefix
+        demonstrator_busy = await cell_object.add_variable(idx, "DemonstratorBusy", False)
+        await demonstrator_busy.set_writable()
+
+        # Status - device state, queue and connections in one JSON object, see publisher.py
+        status_node = await cell_object.add_variable(idx, STATUS, json.dumps(initial_status(
+            self.master.state_initial_values)))
+        write_status = node_writer(status_node)
+        publisher.add(prefix + STATUS, lambda status: write_status(json.dumps(status, sort_keys=True)),
+                      initial_status(self.master.state_initial_values))
+        write_busy = node_writer(demonstrator_busy)
+
+        def write_demonstrator_busy(busy):
+            write_busy(busy)
+            publisher.merge(prefix + STATUS, DemonstratorBusy=busy)
+        publisher.add(prefix + "DemonstratorBusy", write_demonstrator_busy)
+        await cell_object.add_method(idx, "MoveDemonstrator", uamethod(self.move_demonstrator),
+                                     [ua.VariantType.String, ua.VariantType.Int64],
+                                     [ua.VariantType.String, ua.VariantType.Int64])
+        await cell_object.add_method(idx, "CancelDemonstrator", uamethod(self.cancel_demonstrator),
+                                     [ua.VariantType.Int64, ua.VariantType.Double], [ua.VariantType.String])
+
+        # Device state - State/RobotMoving, RobotState, ConBeltMoving, ConBeltState, ConBeltDist
+        state_object = await cell_object.add_object(idx, "State")
+        for key, value in self.master.state_initial_values.items():
+            node = await state_object.add_variable(idx, key, value)
+            publisher.add(prefix + "State/" + key, node_writer(node, await node.read_data_type_as_variant_type()),
+                          value)
+            self.history_nodes.append((node, "State/{}".format(key)))
+
+        def publish_state(key, value):
+            if key in self.master.state_initial_values and value is not None:
+                publisher.set(prefix + "State/" + key, value)
+                publisher.merge(prefix + STATUS, **{key: value})
+        self.state.add_listener(publish_state)
+
+        # Shelf occupancy - Storage/Shelf1 ... Storage/Shelf9
+        storage_object = await cell_object.add_object(idx, "Storage")
+        for shelf, occupied in enumerate(self.storage.load(), 1):
+            self.shelf_nodes.append(await storage_object.add_variable(idx, "Shelf{}".format(shelf), occupied))
+            self.history_nodes.append((self.shelf_nodes[-1], "Storage/Shelf{}".format(shelf)))
+
+        # Job queue - Jobs/QueueDepth, Jobs/JobStatus, Jobs/Motion and Jobs/Sequencer
+        jobs_object = await cell_object.add_object(idx, "Jobs")
+        publisher.add(prefix + "Jobs/QueueDepth", node_writer(await jobs_object.add_variable(idx, "QueueDepth", 0)), 0)
+        publisher.add(prefix + "Jobs/JobStatus", node_writer(await jobs_object.add_variable(idx, "JobStatus", "[]")),
+                      "[]")
+        self.last_cycle_timing = await jobs_object.add_variable(idx, "LastCycleTiming", "{}")
+        self.history_nodes.append((self.last_cycle_timing, "Jobs/LastCycleTiming"))
+        publisher.add(prefix + "Jobs/Motion", node_writer(await jobs_object.add_variable(idx, "Motion", "{}")), "{}")
+        publisher.add(prefix + "Jobs/Sequencer", node_writer(await jobs_object.add_variable(idx, "Sequencer", "{}")),
+                      "{}")
+        self.jobs.add_listener(self.jobs_changed)
+
+        # Jobs/Job<id> and the DemonstratorJobEvents of the cell object - see opc_ua_master.py
+        self.jobs_object = jobs_object
+        self.job_events = job_events
+        self.jobs.add_job_listener(self.job_changed)
+        if self.standby is None:
+            for job in self.jobs.load():
+                self.job_changed(job)
+        else:
+            self.jobs.load(replica=True)  # the journal belongs to the active instance
+
+        # Connections - Connections/<name>/State, Breaker, Reconnects, RetryIn, LastError of every upstream
+        connections_object = await cell_object.add_object(idx, "Connections")
+        for upstream in (self.fhs, self.panda, self.pixtend):
+            endpoint_object = await connections_object.add_object(idx, upstream.name)
+            for key, name, value in CONNECTION_VARIABLES:
+                publisher.add("{}Connections/{}/{}".format(prefix, upstream.name, key),
+                              node_writer(await endpoint_object.add_variable(idx, name, value)), value)
+            upstream.add_listener(self.publish_connection)
+
+    def publish_connection(self, upstream):
+        for key, value in upstream.status().items():
+            self.publisher.set("{}Connections/{}/{}".format(self.prefix, upstream.name, key), value)
+        self.publisher.merge(self.prefix + STATUS, Connections=dict(
+            (upstream.name, upstream.status()["state"]) for upstream in (self.fhs, self.panda, self.pixtend)))
+
+    def sessions(self):
+        heartbeat_timeout = self.master.config.heartbeat_timeout
+        return [self.fhs.run(heartbeat_timeout), self.panda.run(heartbeat_timeout), self.pixtend.run(heartbeat_timeout)]
+
+    def tasks(self):
+        return [self.supervise(), self.dispatch()]
+
+    async def take_over(self, since):
+        # storage and jobs as the previous active instance left them, its lost FHS requests - see failover.py
+        loop = asyncio.get_event_loop()
+        for shelf, occupied in enumerate(await loop.run_in_executor(None, self.storage.load), 1):
+            await self.shelf_nodes[shelf - 1].write_value(occupied)
+        compact_after = self.standby.lease.grace_end()  # the previous instance may still append until then
+        for job in await loop.run_in_executor(None, lambda: self.jobs.load(compact_after=compact_after)):
+            self.job_changed(job)
+        for shelf in self.replica.missed(since):
+            logger.debug("standby: FHS request of shelf %s of %s was not queued by the previous instance", shelf,
+                         self.name)
+            await self.set_shelf(shelf, True)
+            await self.submit(shelf, "SO", "fhs")
+
+    ##################### METHODS ######################
+    async def move_demonstrator(self, parent, movement, shelf):
+        # a wrong shelf would only be noticed by the storage, after the robot moved
+        error = job_queue.invalid_request(shelf, movement)
+        if error is not None:
+            return error, 0
+        # fail fast - a job for an unreachable robot or belt would only wait in the queue
+        for upstream in (self.panda, self.pixtend):
+            if not upstream.breaker.allow():
+                return "Error - {} not connected".format(upstream.name), 0
+        # queued - also while the robot or the belt is moving
+        job = await self.submit(shelf, movement, "method")
+        return "Successful", job.job_id
+
+    async def cancel_demonstrator(self, parent, job_id, timeout):
+        return await asyncio.get_event_loop().run_in_executor(None, self.jobs.cancel, job_id, timeout)
+
+    def new_val_available(self, val):
+        # called from the FHS subscription - never block in here. An edge while the last one still waits is
+        # coalesced, like in the EventDispatcher of the thread engine
+        if val is True:
+            if self.fhs_request_waiting:
+                metrics.inc("dtz_dispatch_events_total", result="coalesced", key="NewValAvailable", **self.labels)
+                return
+            self.fhs_request_waiting = True
+            metrics.inc("dtz_dispatch_events_total", result="queued", key="NewValAvailable", **self.labels)
+            asyncio.ensure_future(self.fhs_request())
+
+    async def fhs_request(self):
+        async with self.fhs_request_lock:  # one after the other - keeps the order of the requests
+            self.fhs_request_waiting = False
+            try:
+                request = await self.fhs.read_many(key for key in FHS_REQUEST_KEYS if key in self.fhs.node_ids)
+            except Exception as e:
+                logger.debug("async: Catched Exception: %s", e)
+                return
+            shelf = request["ShelfNumber"]
+            logger.debug("async: NewValAvailable on %s. ShelfNumber: %s. TaskRunning: %s.", self.name, shelf,
+                         request.get("TaskRunning"))
+            # rejected like a MoveDemonstrator call - the FHS server gets no answer, so it is published in the Status
+            error = job_queue.invalid_request(shelf, "SO")
+            if error is not None:
+                logger.warning("async: FHS request of shelf %r on %s rejected: %s", shelf, self.name, error)
+                metrics.inc("dtz_dispatch_events_total", result="rejected", key="NewValAvailable", **self.labels)
+                self.publisher.merge(self.prefix + STATUS, Rejected={"Shelf": shelf, "Error": error})
+                return
+            if self.standby is not None and not self.standby.active:
+                self.replica.remember(shelf)  # the active instance queues it
+                return
+            await self.set_shelf(shelf, True)
+            await self.submit(shelf, "SO", "fhs")
+
+    async def submit(self, shelf, movement, source):
+        # the journal write does an fsync - keep it out of the event loop
+        job = await asyncio.get_event_loop().run_in_executor(None, self.jobs.submit, shelf, movement, source)
+        self.publisher.set(self.prefix + "DemonstratorBusy", True)
+        return job
+
+    ##################### JOB DISPATCHER ######################
+    def jobs_changed(self, queue):
+        # job queue listener - may be called from an executor thread
+        self.loop.call_soon_threadsafe(self._jobs_changed)
+
+    def _jobs_changed(self):
+        self.jobs_event.set()
+        self.state.update("JobsPending", bool(self.jobs.jobs()))  # wakes up the supervision
+        self.publish_jobs()
+
+    def publish_jobs(self):
+        if self.publisher is not None:
+            self.publisher.set(self.prefix + "Jobs/QueueDepth", self.jobs.depth())
+            self.publisher.set(self.prefix + "Jobs/JobStatus", json.dumps([job.to_dict() for job in self.jobs.jobs()]))
+            self.publisher.merge(self.prefix + STATUS, QueueDepth=self.jobs.depth())
+
+    def job_changed(self, job):
+        # job listener - may be called from an executor thread, the job may change again until the loop runs
+        self.loop.call_soon_threadsafe(asyncio.ensure_future, self.publish_job(job.to_dict()))
+
+    async def publish_job(self, record):
+        async with self.job_lock:  # in order, one node per job
+            node = self.job_nodes.get(record["id"])
+            if node is None:
+                node = self.job_nodes[record["id"]] = await self.jobs_object.add_variable(
+                    self.jobs_object.nodeid.NamespaceIndex, "Job{}".format(record["id"]), "{}")
+            await node.write_value(json.dumps(record))
+            while len(self.job_nodes) > 20:
+                oldest = self.jobs.get(next(iter(self.job_nodes)))
+                if oldest is not None and oldest.status not in FINISHED:
+                    break
+                await self.job_nodes.popitem(last=False)[1].delete()
+            event = self.job_events.event
+            event.JobId, event.Shelf, event.Status, event.JobMessage = (record["id"], record["shelf"],
+                                                                        record["status"], record["message"])
+            await self.job_events.trigger(message="job {} {}".format(record["id"], record["status"]))
+
+    async def dispatch(self):
+        prev = None
+        while True:
+            # jobs stay queued while the robot or the belt is unreachable instead of failing one after the other
+            while not (self.panda.breaker.allow() and self.pixtend.breaker.allow()):
+                await asyncio.sleep(0.5)
+            if prev is not None:
+                # there is only one robot - the next cycle can start once it is done with this one, the sequencer
+                # chooses the next job afterwards - see JobScheduler.run
+                await prev.wait_event("robot", motion_pipeline.FINISHED)
+            self.jobs_event.clear()
+            job = self.jobs.next(timeout=0)
+            if job is None:
+                await self.jobs_event.wait()
+                continue
+            if job.cancellation.requested:
+                await self.set_job_status(job, job_queue.CANCELLED, "cancelled before it started")
+                continue
+            prev = AsyncCycleRun(self.plan, job, prev, self.state, self.actions).start(self.cycle_done)
+
+    async def set_job_status(self, job, status, message=""):
+        await asyncio.get_event_loop().run_in_executor(None, self.jobs.set_status, job, status, message)
+
+    async def cycle_done(self, cycle):
+        if cycle.ok():
+            await self.set_job_status(cycle.job, job_queue.DONE)
+        elif cycle.job.cancellation.requested:
+            await self.set_job_status(cycle.job, job_queue.CANCELLED, "cancelled in phase {}".format(
+                cycle.failed_phase()))
+        else:
+            await self.set_job_status(cycle.job, job_queue.FAILED, JobScheduler.errors[cycle.failed_phase()])
+        logger.debug("cycle: %s %s", self.name, cycle.timing)
+        metrics.record_cycle(cycle.timing, **self.labels)
+        await self.last_cycle_timing.write_value(json.dumps(cycle.timing.to_dict()))
+
+    ############# PHASES #############
+    async def robot_phase(self, job):
+        await self.set_job_status(job, job_queue.ROBOT, "move robot to shelf {}".format(job.shelf))
+        timeout = self.tracker.deadline(motion_tracker.ROBOT, motion_tracker.DURATION, motion_tracker.ANY)
+        if not await self.wait_state("RobotMoving", False, self.panda, timeout=timeout,
+                                     cancel=job.cancellation):  # robot is free
+            self.tracker.stalled(motion_tracker.ROBOT, motion_tracker.DURATION, motion_tracker.ANY, timeout)
+            return False
+        commanded = time.time()
+        moved = False
+        try:
+            moved = await self.move_robot(job.movement, job.shelf, job.cancellation)
+        finally:
+            self.jobs.record_move(job.shelf if moved else None, time.time() - commanded)
+        return moved
+
+    async def storage_phase(self, job):
+        await self.set_shelf(job.shelf, False)
+        return True
+
+    async def belt_phase(self, job):
+        await self.set_job_status(job, job_queue.BELT, "move belt")
+        return await self.move_belt("left", self.config.belt_distance, job.cancellation)
+
+    async def move_robot(self, movement, shelf, cancel=None):
+        key = self.tracker.robot_key(movement, shelf)
+        if cancel is not None:
+            cancel.check()
+        since = self.state.sequence()
+        await self.panda.call("PandaRobot", "2:MoveRobotRos", movement, str(shelf))
+        logger.debug("move robot to shelf %s", shelf)
+        return await self.track_move(motion_tracker.ROBOT, key, "RobotMoving", self.panda, since, cancel)
+
+    async def move_belt(self, movement, distance, cancel=None):
+        key = self.tracker.belt_key(distance)
+        if cancel is not None:
+            cancel.check()
+        since = self.state.sequence()
+        await self.pixtend.call("ConveyorBelt", "2:MoveBelt", movement, distance)
+        return await self.track_move(motion_tracker.BELT, key, "ConBeltMoving", self.pixtend, since, cancel)
+
+    async def track_move(self, device, key, moving, upstream, since, cancel=None):
+        # start and end of the move within the deadlines of the motion tracker - see JobScheduler.track_move
+        commanded = time.time()
+        timeout = self.tracker.deadline(device, motion_tracker.START, key)
+        if not await self.wait_state(moving, True, upstream, timeout=timeout, since=since, cancel=cancel):
+            self.tracker.stalled(device, motion_tracker.START, key, timeout)
+            return False
+        started = time.time()
+        self.tracker.record(device, motion_tracker.START, key, started - commanded)
+
+        timeout = self.tracker.deadline(device, motion_tracker.DURATION, key)
+        if not await self.wait_state(moving, False, upstream, timeout=timeout, cancel=cancel):
+            self.tracker.stalled(device, motion_tracker.DURATION, key, timeout)
+            return False
+        self.tracker.record(device, motion_tracker.DURATION, key, time.time() - started)
+        logger.debug("%s move finished", device)
+        return True
+
+    async def wait_state(self, key, value, upstream, timeout=None, since=None, poll=0.5, cancel=None):
+        # wait_for_async which fails fast - raises CircuitOpen as soon as the breaker of the upstream opens,
+        # Cancelled when the job was cancelled
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            upstream.breaker.check()
+            if cancel is not None:
+                cancel.check()
+                if cancel.requested:
+                    poll = min(poll, cancel.remaining())
+            step = poll if deadline is None else min(poll, max(deadline - time.time(), 0))
+            if await self.state.wait_for_async(key, value, timeout=step, since=since):
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    async def set_shelf(self, shelf, occupied):
+        # the atomic write-back does an fsync - keep it out of the event loop
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(None, self.storage.set, shelf, occupied):
+            await self.shelf_nodes[shelf - 1].write_value(occupied)
+
+    ############### SERVER RUNNING ROUTINE #######################
+    async def supervise(self):
+        busy = None
+        light = None  # (busy, reconnects of the pixtend) of the last switch of the light
+        since = 0
+        last_notification = time.time()
+        while True:
+            since = await self.state.wait_change_async(since, timeout=5)
+            if time.time() - last_notification >= 60:
+                logger.debug("server: %s running", self.name)
+                last_notification = time.time()
+
+            panda_moving = self.state.get("RobotMoving")
+            belt_moving = self.state.get("ConBeltMoving")
+            if panda_moving is None or belt_moving is None:
+                new_busy = True  # one of the clients is disconnected
+            else:
+                new_busy = panda_moving is True or belt_moving is True or self.state.get("JobsPending") is True
+            try:
+                if new_busy != busy:
+                    self.publisher.set(self.prefix + "DemonstratorBusy", new_busy)
+                    busy = new_busy
+                if panda_moving is not None and belt_moving is not None and light != (busy, self.pixtend.reconnects):
+                    # switch the alarm light to red/green - means the demonstrator is working/not working,
+                    # again after a reconnect, the device may have lost it
+                    await self.pixtend.call("ConveyorBelt", "2:SwitchBusyLight", busy)
+                    light = (busy, self.pixtend.reconnects)
+            except Exception as e:
+                logger.debug("server: Catched Exception: %s", e, extra={"throttle": True})
+
+
+class AsyncController(object):
+    """
+    The complete controller in one event loop - one master server, one AsyncCell per configured cell
+    """
+
+    def __init__(self, master, registry=None):
+        self.master = master
+        self.registry = registry or CellRegistry.from_master(master)
+        self.server = None
+        self.url = None
+        self.historian = None
+        self.publisher = Publisher().configure(master.config)  # variables of all cells, only written on changes
+        self.server_time = None
+        self.cells = [AsyncCell(master, config) for config in self.registry.cells()]
+        self.standby = None
+        if master.config.ha_lease:
+            for cell in self.cells:
+                cell.replica = Replica(cell.storage, cell.jobs, cell.name)
+            self.standby = Standby(FileLease(master.config.ha_lease, master.config.ha_lease_ttl),
+                                   [cell.replica for cell in self.cells])
+            for cell in self.cells:
+                cell.standby = self.standby
+
+    ################ SERVER SETUP ################
+    async def setup_server(self, url=None):
+        # the address space - the server is started by start_server
+        url = self.url = url or self.master.config.server_url
+        server = self.server = Server()
+        await server.init()
+        server.set_endpoint(url)
+        if self.master.credentials is not None and self.master.config.server_security != "None":
+            await self.master.credentials.secure_async_server(server)
+        idx = await server.register_namespace("urn:freeopcua")
+        master_object = await server.nodes.objects.add_object(idx, "DTZMasterController")
+        self.server_time = await master_object.add_variable(idx, "ServerTime", datetime.utcnow())
+        await master_object.add_method(idx, "ReloadConfig", uamethod(self.reload_config), [], [ua.VariantType.String])
+        await master_object.add_method(idx, "SetLogLevel", uamethod(self.set_log_level), [ua.VariantType.String],
+                                       [ua.VariantType.String])
+
+        # a single cell keeps the address space of the single demonstrator, several cells get an object each
+        job_event_type = await server.create_custom_event_type(
+            idx, "DemonstratorJobEventType", ua.ObjectIds.BaseEventType,
+            [(name, getattr(ua.VariantType, variant_type)) for name, variant_type in JOB_EVENT_PROPERTIES])
+        if len(self.cells) == 1:
+            await self.cells[0].add_nodes(idx, master_object, self.publisher,
+                                          await server.get_event_generator(job_event_type, master_object))
+        else:
+            for cell in self.cells:
+                cell_object = await master_object.add_object(idx, cell.name)
+                await cell.add_nodes(idx, cell_object, self.publisher,
+                                     await server.get_event_generator(job_event_type, cell_object),
+                                     "{}/".format(cell.name))
+
+        # Diagnostics - one variable per metric with a JSON summary per label set
+        diagnostics_object = await master_object.add_object(idx, "Diagnostics")
+        for name in sorted(FAMILIES):
+            node = await diagnostics_object.add_variable(idx, name, "{}")
+            self.publisher.add("Diagnostics/" + name, node_writer(node), "{}")
+        # thread dump, sampling profiler and object census - see diagnostics.py
+        await diagnostics_object.add_method(idx, "DumpThreads", uamethod(self.dump_threads), [],
+                                            [ua.VariantType.String])
+        await diagnostics_object.add_method(idx, "Profile", uamethod(self.profile), [ua.VariantType.Double],
+                                            [ua.VariantType.String])
+        await diagnostics_object.add_method(idx, "ObjectCounts", uamethod(self.object_counts), [],
+                                            [ua.VariantType.String])
+
+    async def start_server(self):
+        server = self.server
+        if self.standby is None:
+            await server.start()
+        else:
+            # retried while the previous active instance may still hold the port - see Standby.serve
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.standby.serve,
+                                       lambda: asyncio.run_coroutine_threadsafe(server.start(), loop).result(),
+                                       lambda: asyncio.run_coroutine_threadsafe(server.stop(), loop).result())
+
+        # History - HistoryRead on State/*, Storage/Shelf* and Jobs/LastCycleTiming of every cell
+        historian = self.historian = Historian(self.master.history_path, self.master.history_retention,
+                                               self.master.history_max_bytes)
+        history_storage = AsyncHistorianStorage(historian, ua)
+        server.iserver.history_manager.set_storage(history_storage)
+        for cell in self.cells:
+            prefix = "{}/".format(cell.name) if len(self.cells) > 1 else ""
+            for node, series in cell.history_nodes:
+                await history_storage.historize(server, node, prefix + series)
+        historian.start()
+        logger.debug("OPC-UA - Master - Server (asyncio) started at %s with %s cell(s)", self.url, len(self.cells))
+
+    def stop_on_sigterm(self):
+        # see opc_ua_master.stop_on_sigterm
+        self.standby.lease.release()
+        self.master.log_pipeline.stop()
+        recorder.close()
+        os._exit(0)
+
+    ################ CONFIGURATION ################
+    async def reload_config(self, parent):
+        return self.master.reload_configuration()
+
+    async def set_log_level(self, parent, level):
+        return self.master.log_pipeline.set_level(level)
+
+    ################ DIAGNOSTICS ################
+    async def dump_threads(self, parent):
+        return diagnostics.threads()
+
+    async def profile(self, parent, seconds):
+        return diagnostics.start_profile(seconds)
+
+    async def object_counts(self, parent):
+        # walks all objects - not in the event loop
+        return await asyncio.get_event_loop().run_in_executor(None, diagnostics.objects)
+
+    def config_reloaded(self, config, changed):
+        # the sessions stay open - only distances, timeouts and limits change
+        for cell in self.cells:
+            cell.tracker.configure(config)
+            cell.jobs.sequencer.configure(config)
+            if self.registry.default:  # the belt distance of a configured cell comes from the cells file
+                cell.config.belt_distance = config.belt_distance
+        if self.historian is not None:
+            self.historian.retention = config.history_retention
+            self.historian.max_bytes = config.history_max_bytes
+        self.publisher.configure(config)
+
+    async def publish_diagnostics(self, interval=2):
+        # mirror the metrics into the Diagnostics object, motion trackers and pick sequencers into the Jobs of the
+        # cells
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                for name in FAMILIES:
+                    self.publisher.set("Diagnostics/" + name, json.dumps(metrics.summary(name), sort_keys=True))
+                for cell in self.cells:
+                    self.publisher.set(cell.prefix + "Jobs/Motion",
+                                       json.dumps(cell.tracker.status(), sort_keys=True))
+                    self.publisher.set(cell.prefix + "Jobs/Sequencer",
+                                       json.dumps(cell.jobs.sequencer.status(), sort_keys=True))
+            except Exception as e:
+                # a failing status must never end the gather of run() - that stops the server
+                logger.debug("async: Catched Exception: %s", e, extra={"throttle": True})
+
+    async def publish(self):
+        # held back changes of the published variables, ServerTime once a second
+        last_time = 0
+        while True:
+            await asyncio.sleep(self.publisher.resolution)
+            self.publisher.flush()
+            if time.time() - last_time >= 1:
+                await self.server_time.write_value(datetime.utcnow())
+                last_time = time.time()
+
+    async def run(self):
+        await self.setup_server()
+        coroutines = [self.publish()]
+        for cell in self.cells:
+            coroutines.extend(cell.sessions())
+        tasks = [asyncio.ensure_future(coro) for coro in coroutines]
+        if self.standby is not None:
+            # warm sessions and address space, storage and jobs follow the active instance until its lease expires
+            await asyncio.get_event_loop().run_in_executor(None, self.standby.wait)
+            for cell in self.cells:
+                await cell.take_over(self.standby.since())
+        if self.standby is not None:
+            # an instance which lost its lease stops at once - restarted, it is the standby. The lease is kept while
+            # the server start is retried
+            self.standby.keep(lambda: (self.master.log_pipeline.stop(), recorder.close(), os._exit(3)))
+            atexit.register(self.standby.lease.release)
+            asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self.stop_on_sigterm)
+        await self.start_server()
+        self.master.config.add_listener(self.config_reloaded)
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self.master.reload_configuration)
+        if self.master.metrics_port:
+            metrics.start_http_server(self.master.metrics_port)
+        diagnostics.configure(self.master.config).attach(asyncio.get_event_loop())
+        if self.master.config.diagnostics_port:
+            diagnostics.start_http_server(self.master.config.diagnostics_port)
+        # telemetry keeps a sender thread and a spill file per cell, recording from the subscriptions never blocks
+        # the loop
+        for cell in self.cells:
+            telemetry = TelemetryExporter(self.master.global_url_opcua_adapter, cell.config.spill_path)
+            prefix = cell.name if len(self.cells) > 1 else None
+            cell.state.add_listener(lambda key, value, telemetry=telemetry, prefix=prefix:
+                                    telemetry.state_listener(key, value, prefix))
+            telemetry.start()
+        coroutines = [self.publish_diagnostics()]
+        for cell in self.cells:
+            coroutines.extend(cell.tasks())
+        tasks += [asyncio.ensure_future(coro) for coro in coroutines]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.server.stop()
+            logger.debug("\nClients disconnected and Server stopped")
+
+
+async def run_controller(master, registry=None):
+    # created inside the running loop, so all events and locks belong to it
+    await AsyncController(master, registry).run()
+
+
+def main(master, registry=None):
+    try:
+        asyncio.run(run_controller(master, registry))
+    except KeyboardInterrupt:
+        logger.debug("\nCTRL+C pressed")
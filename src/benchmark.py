@@ -0,0 +1,644 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   End-to-end benchmark of the DTZ Master Controller
+#   Starts the simulated devices (simulators.py) and the controller as a separate process, drives FHS shelf requests
+#   (NewValAvailable) and MoveDemonstrator calls at fixed rates and reports
+#       cycles/hour, p50/p99 latency from the request to the end of its cycle, CPU and memory of the controller
+#   The result can be written as JSON and compared with an earlier run, as regression baseline of a change.
+#
+#   python benchmark.py --duration 300 --fhs-rate 2 --method-rate 4 [--engine asyncio] [--json result.json]
+#                       [--baseline baseline.json] [--lost-rate 0.05] [--error-rate 0.05] [--latency 0.1]
+#
+#   Pick sequencing against FIFO: random shelves, robot moves which depend on the way from the previous shelf and
+#   more requests than the demonstrator can take, once with pick window 1 (FIFO) and once with the sequencer
+#
+#   python benchmark.py --shelves random --seed 1 --panda-travel 1.5 --fhs-rate 0 --method-rate 12 --pick-window 1
+#                       --json fifo.json
+#   python benchmark.py --shelves random --seed 1 --panda-travel 1.5 --fhs-rate 0 --method-rate 12 --pick-window 3
+#                       --baseline fifo.json
+#
+#   The sequential cycle plan (see motion_pipeline.py) must never move robot and belt at the same time - the run fails
+#   if the simulators saw both moving together:
+#
+#   python benchmark.py --cycle-plan sequential --duration 60 --fhs-rate 0 --method-rate 12 [--engine asyncio]
+#
+#   Fan-out load test: --subscribers 0,50,100,200,400 connects that many clients step by step, every one subscribed to
+#   Status, DemonstratorBusy and ServerTime, while MoveDemonstrator is called at --method-rate. Reports per step the
+#   CPU of the controller and the notification latency (ServerTime is written with the current time, so its
+#   notifications show how long the controller takes to deliver a change). The clients run in this process - on a
+#   1-CPU machine they compete with the controller, the CPU of the controller is measured on its own.
+#
+#   python benchmark.py --subscribers 0,50,100,200,400 --duration 60 [--engine asyncio] [--json fanout.json]
+#
+#   Cost of one FHS event (read of ShelfNumber) with the security modes None, Sign and SignAndEncrypt of
+#   Basic256Sha256, see security.py: on the long-lived session of the session pool, with a new client per event
+#   which reads certificate and key from the files (the pattern of a fresh client in every datachange handler), and
+#   the reconnect of a pooled session with the cached credentials. Wall time and CPU per event - client and
+#   simulated FHS run in this process, the CPU is that of both ends.
+#
+#   python benchmark.py --security-cost 1000 [--certificate cert.der --private-key key.pem] [--json security.json]
+
+from opcua import Client, ua
+from opcua.crypto.security_policies import SecurityPolicyBasic256Sha256
+from datetime import timezone
+from simulators import Faults, SimulatedFhs, start_all, SIM_URLS
+from security import Credentials, MODES, generate_certificate
+from session_pool import PooledSession
+import subprocess
+import argparse
+import asyncio
+import random
+import tempfile
+import threading
+import logging
+import json
+import time
+import sys
+import os
+
+MASTER_URL = "opc.tcp://127.0.0.1:4840/freeopcua/server"
+METRICS_URL = "http://127.0.0.1:9102/metrics"
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))]
+
+
+class JobTracker(object):
+    """
+    Follows Jobs/JobStatus of the controller. A job is done when it disappears from the list. The n-th job of a
+    source belongs to the n-th request of this source, the requests are sent one after the other
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requested = {"fhs": [], "method": []}  # source -> request times
+        self.jobs = {"fhs": [], "method": []}  # source -> job ids in order
+        self.active = set()
+        self.finished = {}  # job id -> finish time
+        self.max_id = 0
+
+    def request(self, source):
+        with self.lock:
+            self.requested[source].append(time.time())
+
+    def datachange_notification(self, node, val, data):
+        now = time.time()
+        try:
+            jobs = json.loads(val)
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            ids = set()
+            for job in sorted(jobs, key=lambda job: job["id"]):
+                ids.add(job["id"])
+                if job["id"] > self.max_id:
+                    self.max_id = job["id"]
+                    self.jobs.setdefault(job["source"], []).append(job["id"])
+            for job_id in self.active - ids:
+                self.finished[job_id] = now
+            self.active = ids
+
+    def latencies(self):
+        with self.lock:
+            result = []
+            for source, job_ids in self.jobs.items():
+                for request_time, job_id in zip(self.requested.get(source, []), job_ids):
+                    if job_id in self.finished:
+                        result.append(self.finished[job_id] - request_time)
+            return result
+
+    def pending(self):
+        with self.lock:
+            return len(self.active) + sum(max(0, len(self.requested[source]) - len(self.jobs.get(source, [])))
+                                          for source in self.requested)
+
+
+class ProcessSampler(object):
+    """
+    CPU and resident memory of the controller process from /proc
+    """
+
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.ticks = os.sysconf("SC_CLK_TCK")
+        self.cpu = []  # percent of one core per interval
+        self.rss = []  # MB
+        self._stop = threading.Event()
+
+    def _cpu_seconds(self):
+        with open("/proc/{}/stat".format(self.pid)) as in_file:
+            fields = in_file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks  # utime + stime
+
+    def _rss(self):
+        with open("/proc/{}/status".format(self.pid)) as in_file:
+            for line in in_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+        return 0.0
+
+    def run(self):
+        last_cpu, last_time = self._cpu_seconds(), time.time()
+        while not self._stop.wait(self.interval):
+            try:
+                cpu, now = self._cpu_seconds(), time.time()
+                self.cpu.append(100.0 * (cpu - last_cpu) / (now - last_time))
+                self.rss.append(self._rss())
+                last_cpu, last_time = cpu, now
+            except IOError:
+                return
+
+    def start(self):
+        sampler_thread = threading.Thread(name='sampler_thread', target=self.run)
+        sampler_thread.daemon = True
+        sampler_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class MotionOverlap(object):
+    """
+    Seconds in which the simulated robot and belt moved at the same time - 0 with the sequential cycle plan
+    """
+
+    def __init__(self, panda, pixtend, interval=0.01):
+        self.panda = panda
+        self.pixtend = pixtend
+        self.interval = interval
+        self.robot = 0.0
+        self.belt = 0.0
+        self.both = 0.0
+        self._stop = threading.Event()
+
+    def run(self):
+        last = time.time()
+        while not self._stop.wait(self.interval):
+            now = time.time()
+            robot = self.panda.robot_moving.get_value()
+            belt = self.pixtend.belt_moving.get_value()
+            self.robot += (now - last) if robot else 0.0
+            self.belt += (now - last) if belt else 0.0
+            self.both += (now - last) if robot and belt else 0.0
+            last = now
+
+    def start(self):
+        overlap_thread = threading.Thread(name='overlap_thread', target=self.run)
+        overlap_thread.daemon = True
+        overlap_thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class FanoutClients(object):
+    """
+    Subscribed clients in one event loop of their own thread, built on asyncua - one thread for hundreds of them
+    """
+
+    def __init__(self, interval=500):
+        self.interval = interval  # publishing interval in milliseconds
+        self.loop = asyncio.new_event_loop()
+        self.clients = []
+        self.lock = threading.Lock()
+        self.latencies = []  # seconds from ServerTime to its notification
+        self.notifications = 0
+        self.failed = 0  # clients which could not connect
+        fanout_thread = threading.Thread(name='fanout_thread', target=self.loop.run_forever)
+        fanout_thread.daemon = True
+        fanout_thread.start()
+
+    def datachange_notification(self, node, val, data):
+        now = time.time()
+        with self.lock:
+            self.notifications += 1
+            if node.nodeid == self.server_time:
+                self.latencies.append(now - val.replace(tzinfo=timezone.utc).timestamp())
+
+    def reset(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+            notifications, self.notifications = self.notifications, 0
+        return latencies, notifications
+
+    async def _connect(self, count):
+        from asyncua import Client as AsyncClient
+        for n in range(count):
+            client = AsyncClient(MASTER_URL, timeout=30)
+            try:
+                await client.connect()
+                master = await client.nodes.objects.get_child(["2:DTZMasterController"])
+                nodes = [await master.get_child([name]) for name in ("2:Status", "2:DemonstratorBusy", "2:ServerTime")]
+                self.server_time = nodes[2].nodeid
+                subscription = await client.create_subscription(self.interval, self)
+                await subscription.subscribe_data_change(nodes)
+                self.clients.append(client)
+            except Exception:
+                self.failed += 1
+
+    def status_change_notification(self, status):
+        pass
+
+    async def _disconnect(self):
+        for client in self.clients:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+        self.clients = []
+
+    def connect(self, count):
+        asyncio.run_coroutine_threadsafe(self._connect(count), self.loop).result()
+
+    def disconnect(self):
+        asyncio.run_coroutine_threadsafe(self._disconnect(), self.loop).result(120)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def drive(rate, duration, action):
+    """
+    Call action() rate times per minute for duration seconds, in its own thread
+    """
+    def run():
+        interval = 60.0 / rate
+        start = time.time()
+        n = 0
+        while time.time() - start < duration:
+            action(n)
+            n += 1
+            time.sleep(max(0, start + n * interval - time.time()))
+    driver_thread = threading.Thread(name='driver_thread', target=run)
+    driver_thread.daemon = True
+    driver_thread.start()
+    return driver_thread
+
+
+def failed_cycles():
+    # failed cycles are not visible in the job list - take them from the metrics of the controller
+    from urllib.request import urlopen
+    try:
+        text = urlopen(METRICS_URL, timeout=2).read().decode("utf-8")
+    except Exception:
+        return None
+    return sum(int(float(line.split()[-1])) for line in text.splitlines()
+               if line.startswith('dtz_cycle_duration_seconds_count{ok="False"}'))
+
+
+def wait_for_controller(timeout=60):
+    """
+    Connect to the master server and wait until it is connected to all devices (DemonstratorBusy False)
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        client = Client(MASTER_URL)
+        try:
+            client.connect()
+            master = client.get_root_node().get_child(["0:Objects", "2:DTZMasterController"])
+            busy = master.get_child(["2:DemonstratorBusy"])
+            while time.time() < deadline:
+                if busy.get_value() is False:
+                    return client, master
+                time.sleep(0.5)
+        except Exception:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+            time.sleep(1)
+    raise RuntimeError("controller not ready within {} seconds".format(timeout))
+
+
+def start_controller(args, workdir):
+    command = [sys.executable, os.path.abspath(os.path.join(os.path.dirname(__file__), "opc_ua_master.py")),
+               "--simulate"]
+    if args.engine == "asyncio":
+        command.append("--asyncio")
+    env = dict(os.environ)
+    if getattr(args, "pick_window", None) is not None:
+        env["DTZ_PICK_WINDOW"] = str(args.pick_window)
+    if getattr(args, "cycle_plan", None) is not None:
+        env["DTZ_CYCLE_PLAN"] = args.cycle_plan
+    os.makedirs(workdir, exist_ok=True)
+    log_file = open(os.path.join(workdir, "controller.log"), "w")
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT), log_file
+
+
+def stop_controller(controller, log_file):
+    if controller is None:
+        return
+    controller.terminate()
+    try:
+        controller.wait(10)
+    except subprocess.TimeoutExpired:
+        controller.kill()
+    log_file.close()
+
+
+def run_benchmark(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dtz_benchmark_")
+    faults = Faults(args.lost_rate, args.error_rate, args.latency, seed=args.seed)
+    panda, pixtend, fhs = start_all(args.panda_move, args.belt_move, faults, args.panda_travel)
+    fhs.pulse = args.pulse
+    shelf_random = random.Random(args.seed)
+
+    def shelf(n):
+        return shelf_random.randint(1, 9) if args.shelves == "random" else n % 9 + 1
+
+    controller = log_file = client = None
+    try:
+        controller, log_file = start_controller(args, workdir)
+        client, master = wait_for_controller()
+        tracker = JobTracker()
+        job_status = master.get_child(["2:Jobs", "2:JobStatus"])
+        client.create_subscription(50, tracker).subscribe_data_change(job_status)
+        sampler = ProcessSampler(controller.pid)
+        sampler.start()
+        overlap = MotionOverlap(panda, pixtend)
+        overlap.start()
+
+        method_client = Client(MASTER_URL)
+        method_client.connect()
+        method_master = method_client.get_root_node().get_child(["0:Objects", "2:DTZMasterController"])
+
+        def fhs_request(n):
+            tracker.request("fhs")
+            fhs.trigger(shelf(n))
+
+        def method_request(n):
+            tracker.request("method")
+            method_master.call_method("2:MoveDemonstrator", "SO", shelf(n))
+
+        start = time.time()
+        drivers = []
+        if args.fhs_rate > 0:
+            drivers.append(drive(args.fhs_rate, args.duration, fhs_request))
+        if args.method_rate > 0:
+            drivers.append(drive(args.method_rate, args.duration, method_request))
+        for driver in drivers:
+            driver.join()
+
+        # let the queue run empty
+        deadline = time.time() + args.drain
+        while tracker.pending() and time.time() < deadline:
+            time.sleep(0.5)
+        elapsed = time.time() - start
+        sampler.stop()
+        overlap.stop()
+        method_client.disconnect()
+
+        latencies = tracker.latencies()
+        completed = len(tracker.finished)
+        result = {
+            "engine": args.engine,
+            "duration": round(elapsed, 1),
+            "requests": dict((source, len(times)) for source, times in tracker.requested.items()),
+            "completed": completed,
+            "failed": failed_cycles(),
+            "unfinished": tracker.pending(),
+            "cycles_per_hour": round(completed / elapsed * 3600, 1),
+            "latency_p50": round(percentile(latencies, 0.5), 3) if latencies else None,
+            "latency_p99": round(percentile(latencies, 0.99), 3) if latencies else None,
+            "cpu_avg_percent": round(sum(sampler.cpu) / len(sampler.cpu), 1) if sampler.cpu else None,
+            "cpu_max_percent": round(max(sampler.cpu), 1) if sampler.cpu else None,
+            "rss_max_mb": round(max(sampler.rss), 1) if sampler.rss else None,
+            "motion": {"robot": round(overlap.robot, 2), "belt": round(overlap.belt, 2),
+                       "both": round(overlap.both, 2)},
+            "faults": {"lost": faults.lost, "errors": faults.errors},
+            "settings": {"fhs_rate": args.fhs_rate, "method_rate": args.method_rate, "panda_move": args.panda_move,
+                         "belt_move": args.belt_move, "lost_rate": args.lost_rate, "error_rate": args.error_rate,
+                         "latency": args.latency, "panda_travel": args.panda_travel, "shelves": args.shelves,
+                         "pick_window": args.pick_window, "cycle_plan": args.cycle_plan},
+            "log": log_file.name,
+        }
+        return result
+    finally:
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        stop_controller(controller, log_file)
+        for device in (panda, pixtend, fhs):
+            device.stop()
+
+
+def run_fanout(args):
+    """
+    CPU of the controller and notification latency with a growing number of subscribed clients
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dtz_fanout_")
+    panda, pixtend, fhs = start_all(args.panda_move, args.belt_move)
+    controller = log_file = client = None
+    clients = FanoutClients()
+    try:
+        controller, log_file = start_controller(args, workdir)
+        client, master = wait_for_controller()
+        steps = []
+        for count in sorted(set(int(count) for count in args.subscribers.split(","))):
+            clients.connect(count - len(clients.clients) - clients.failed)
+            time.sleep(5)  # initial notifications of the new subscriptions
+            clients.reset()
+            sampler = ProcessSampler(controller.pid)
+            sampler.start()
+            driver = drive(args.method_rate, args.duration,
+                           lambda n: master.call_method("2:MoveDemonstrator", "SO", n % 9 + 1)) \
+                if args.method_rate > 0 else None
+            time.sleep(args.duration)
+            if driver is not None:
+                driver.join()
+            sampler.stop()
+            latencies, notifications = clients.reset()
+            steps.append({
+                "subscribers": count,
+                "failed": clients.failed,
+                "notifications_per_second": round(notifications / args.duration, 1),
+                "latency_p50": round(percentile(latencies, 0.5), 4) if latencies else None,
+                "latency_p99": round(percentile(latencies, 0.99), 4) if latencies else None,
+                "cpu_avg_percent": round(sum(sampler.cpu) / len(sampler.cpu), 1) if sampler.cpu else None,
+                "cpu_max_percent": round(max(sampler.cpu), 1) if sampler.cpu else None,
+                "rss_max_mb": round(max(sampler.rss), 1) if sampler.rss else None,
+            })
+            report_fanout(steps[-1:], header=len(steps) == 1)
+        return {"engine": args.engine, "duration": args.duration, "method_rate": args.method_rate, "steps": steps,
+                "log": log_file.name}
+    finally:
+        clients.disconnect()
+        if client is not None:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+        stop_controller(controller, log_file)
+        for device in (panda, pixtend, fhs):
+            device.stop()
+
+
+def measure(count, action):
+    """
+    (milliseconds, CPU milliseconds) per call of action
+    """
+    start, cpu = time.perf_counter(), time.process_time()
+    for _ in range(count):
+        action()
+    return (round(1000 * (time.perf_counter() - start) / count, 3),
+            round(1000 * (time.process_time() - cpu) / count, 3))
+
+
+def run_security_cost(args):
+    """
+    Cost of one event with and without a secure channel - long-lived session, new client per event, reconnect
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix="dtz_security_")
+    os.makedirs(workdir, exist_ok=True)
+    certificate, private_key = args.certificate, args.private_key
+    if not certificate:
+        certificate, private_key = generate_certificate(os.path.join(workdir, "cert.der"),
+                                                        os.path.join(workdir, "key.pem"))
+    fhs = SimulatedFhs(credentials=Credentials(certificate, private_key)).start()
+    node_ids = {"ShelfNumber": "ns=6;s=::AsGlobalPV:ShelfNumber"}
+    connects = max(5, args.security_cost // 20)
+    rows = []
+    try:
+        for mode in MODES:
+            credentials = Credentials(certificate, private_key, upstream_security=mode) if mode != "None" else None
+
+            def new_client():
+                # the library parses certificate and key and asks for the endpoints on every call of set_security
+                client = Client(SIM_URLS["fhs"], timeout=4)
+                if mode != "None":
+                    client.set_security(SecurityPolicyBasic256Sha256, certificate, private_key,
+                                        mode=getattr(ua.MessageSecurityMode, mode))
+                client.connect()
+                try:
+                    client.get_node(node_ids["ShelfNumber"]).get_value()
+                finally:
+                    client.disconnect()
+
+            session = PooledSession("fhs", SIM_URLS["fhs"], node_ids=node_ids, credentials=credentials)
+
+            def reconnect():
+                session.disconnect()
+                session.connect()
+
+            session.connect()
+            try:
+                session_ms, session_cpu_ms = measure(args.security_cost, lambda: session.read("ShelfNumber"))
+                new_client_ms, new_client_cpu_ms = measure(connects, new_client)
+                reconnect_ms, reconnect_cpu_ms = measure(connects, reconnect)
+            finally:
+                session.disconnect()
+            rows.append({"security": mode, "session_ms": session_ms, "session_cpu_ms": session_cpu_ms,
+                         "new_client_ms": new_client_ms, "new_client_cpu_ms": new_client_cpu_ms,
+                         "reconnect_ms": reconnect_ms, "reconnect_cpu_ms": reconnect_cpu_ms})
+    finally:
+        fhs.stop()
+    return {"events": args.security_cost, "connects": connects, "rows": rows}
+
+
+def report_security(result):
+    keys = ["security", "session_ms", "session_cpu_ms", "new_client_ms", "new_client_cpu_ms", "reconnect_ms",
+            "reconnect_cpu_ms"]
+    print("{} events on the session, {} new clients and reconnects - milliseconds per event".format(
+        result["events"], result["connects"]))
+    print(" ".join("{:>17}".format(key) for key in keys))
+    for row in result["rows"]:
+        print(" ".join("{:>17}".format(row[key]) for key in keys))
+
+
+def report(result, baseline=None):
+    keys = ["cycles_per_hour", "latency_p50", "latency_p99", "cpu_avg_percent", "cpu_max_percent", "rss_max_mb"]
+    print("engine {engine}, {duration}s, requests {requests}, completed {completed}, failed {failed}, "
+          "unfinished {unfinished}, pick window {pick_window}".format(
+              pick_window=result["settings"].get("pick_window") or "default", **result))
+    for key in keys:
+        line = "{:<18} {:>10}".format(key, result[key])
+        if baseline is not None and baseline.get(key) and result[key] is not None:
+            line += "   baseline {:>10}  ({:+.1f}%)".format(baseline[key], 100.0 * (result[key] / baseline[key] - 1))
+        print(line)
+    if "motion" in result:
+        print("{:<18} {:>10}   robot {robot} s, belt {belt} s".format("motion_overlap", result["motion"]["both"],
+                                                                      **result["motion"]))
+
+
+def report_fanout(steps, header=True):
+    keys = ["subscribers", "failed", "notifications_per_second", "latency_p50", "latency_p99", "cpu_avg_percent",
+            "cpu_max_percent", "rss_max_mb"]
+    if header:
+        print(" ".join("{:>14}".format(key.replace("_percent", "").replace("notifications", "notif")) for key in keys))
+    for step in steps:
+        print(" ".join("{:>14}".format(step[key] if step[key] is not None else "-") for key in keys))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the DTZ Master Controller")
+    parser.add_argument("--duration", type=float, default=300, help="seconds of requests")
+    parser.add_argument("--fhs-rate", type=float, default=2, help="FHS shelf requests per minute")
+    parser.add_argument("--method-rate", type=float, default=4, help="MoveDemonstrator calls per minute")
+    parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--panda-move", type=float, default=2.0, help="duration of a robot move in seconds")
+    parser.add_argument("--panda-travel", type=float, default=0.0,
+                        help="extra seconds of a robot move per grid cell from the previous shelf")
+    parser.add_argument("--belt-move", type=float, default=3.0, help="duration of a belt move in seconds")
+    parser.add_argument("--shelves", choices=["cyclic", "random"], default="cyclic",
+                        help="shelves of the requests - 1 to 9 in turn or random (--seed)")
+    parser.add_argument("--pick-window", type=int, default=None,
+                        help="pick_window of the controller, 1 = FIFO - default of its configuration")
+    parser.add_argument("--cycle-plan", choices=["overlapped", "sequential"], default=None,
+                        help="cycle_plan of the controller - sequential fails if robot and belt ever move together")
+    parser.add_argument("--pulse", type=float, default=0.5, help="length of the NewValAvailable pulse in seconds")
+    parser.add_argument("--lost-rate", type=float, default=0.0, help="probability of a lost motion command")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a failing method call")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra latency of the method calls in seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the fault injection")
+    parser.add_argument("--drain", type=float, default=120, help="max. seconds to wait for the queue to run empty")
+    parser.add_argument("--workdir", default=None, help="working directory of the controller (storage, jobs, log)")
+    parser.add_argument("--json", default=None, help="write the result to this file")
+    parser.add_argument("--baseline", default=None, help="compare with the result of an earlier run")
+    parser.add_argument("--subscribers", default=None,
+                        help="fan-out load test with these numbers of subscribed clients, e.g. 0,50,100,200,400")
+    parser.add_argument("--security-cost", type=int, default=None,
+                        help="cost per event of the security modes with this number of events")
+    parser.add_argument("--certificate", default=None, help="certificate for --security-cost, default a new one")
+    parser.add_argument("--private-key", default=None, help="private key of the certificate")
+    args = parser.parse_args()
+
+    logging.getLogger("opcua").setLevel(logging.ERROR)
+    logging.getLogger("asyncua").setLevel(logging.ERROR)
+    if args.security_cost:
+        result = run_security_cost(args)
+        report_security(result)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as out_file:
+                json.dump(result, out_file, indent=2)
+        return
+    if args.subscribers:
+        result = run_fanout(args)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as out_file:
+                json.dump(result, out_file, indent=2)
+        return
+    result = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as in_file:
+            baseline = json.load(in_file)
+    report(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as out_file:
+            json.dump(result, out_file, indent=2)
+    if args.cycle_plan == "sequential" and result["motion"]["both"] > 0:
+        print("FAILED - robot and belt moved together for {} s with the sequential cycle plan".format(
+            result["motion"]["both"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
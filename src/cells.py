@@ -0,0 +1,121 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Cell registry of the DTZ Master Controller
+#   A cell is one demonstrator - Panda robot, PiXtend conveyor belt and FHS PLC - with its own storage and job queue.
+#   Without configuration there is one cell with the endpoints of opc_ua_master.py. Several cells are configured
+#   with a JSON file (--cells <file> or DTZ_CELLS_FILE=<file>) or inline in the environment (DTZ_CELLS='<json>'):
+#
+#   {"cells": [
+#       {"name": "cell1", "panda": "opc.tcp://192.168.48.41:4840/freeopcua/server/",
+#        "pixtend": "opc.tcp://192.168.48.42:4840/freeopcua/server/", "fhs": "opc.tcp://192.168.10.102:4840"},
+#       {"name": "cell2", "panda": "...", "pixtend": "...", "fhs": "...", "storage": "./cell2_storage",
+#        "jobs": "./cell2_jobs", "telemetry": "./cell2_telemetry_spill", "belt_distance": 0.5}
+#   ]}
+#
+#   Every cell gets its own sessions, state cache, job queue, telemetry spill file and object
+#   DTZMasterController/<name> on the master server. Event loop, server and metrics are shared, so more cells cost a
+#   few sessions and one telemetry sender thread each.
+
+import collections
+import logging
+import json
+import os
+import re
+
+logger = logging.getLogger('dtz_master_controller')
+
+
+class CellConfig(object):
+    """
+    Endpoints and files of one cell
+    """
+
+    def __init__(self, name, panda_url, pixtend_url, fhs_url, storage_path=None, jobs_path=None,
+                 belt_distance=0.55, spill_path=None):
+        if not re.match(r"^[A-Za-z0-9_\-]+$", name):
+            raise ValueError("cell name must only contain letters, digits, '_' and '-': {}".format(name))
+        self.name = name
+        self.panda_url = panda_url
+        self.pixtend_url = pixtend_url
+        self.fhs_url = fhs_url
+        self.storage_path = storage_path or "./dtz_storage_{}".format(name)
+        self.jobs_path = jobs_path or "./dtz_jobs_{}".format(name)
+        self.spill_path = spill_path or "./dtz_telemetry_spill_{}".format(name)
+        self.belt_distance = belt_distance
+
+    @classmethod
+    def from_dict(cls, record):
+        missing = [key for key in ("name", "panda", "pixtend", "fhs") if key not in record]
+        if missing:
+            raise ValueError("cell {} misses {}".format(record.get("name", "?"), ", ".join(missing)))
+        return cls(record["name"], record["panda"], record["pixtend"], record["fhs"], record.get("storage"),
+                   record.get("jobs"), float(record.get("belt_distance", 0.55)), record.get("telemetry"))
+
+    def __repr__(self):
+        return "Cell({}, panda={}, pixtend={}, fhs={})".format(self.name, self.panda_url, self.pixtend_url,
+                                                             self.fhs_url)
+
+
+class CellRegistry(object):
+    """
+    The configured cells, in configuration order
+    """
+
+    def __init__(self, cells, default=False):
+        self.default = default  # the single demonstrator of the configuration, no cells configured
+        self._cells = collections.OrderedDict()
+        for cell in cells:
+            if cell.name in self._cells:
+                raise ValueError("cell {} is configured twice".format(cell.name))
+            self._cells[cell.name] = cell
+        if not self._cells:
+            raise ValueError("no cell configured")
+        paths = [path for cell in cells for path in (cell.storage_path, cell.jobs_path, cell.spill_path)]
+        if len(set(os.path.abspath(path) for path in paths)) != len(paths):
+            raise ValueError("every cell needs its own storage, jobs and telemetry spill file")
+
+    @classmethod
+    def from_master(cls, master):
+        """
+        The single demonstrator of opc_ua_master.py - same endpoints and files as before
+        """
+        return cls([CellConfig("dtz", master.global_url_panda_server, master.global_url_pixtend_server,
+                               master.global_url_fhs_server, "./dtz_storage", "./dtz_jobs",
+                               master.desired_distance, "./dtz_telemetry_spill")], default=True)
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        records = data["cells"] if isinstance(data, dict) else data
+        return cls([CellConfig.from_dict(record) for record in records])
+
+    def cells(self):
+        return list(self._cells.values())
+
+    def get(self, name):
+        return self._cells[name]
+
+    def __len__(self):
+        return len(self._cells)
+
+
+def load_registry(master, argv=None, environ=None, path=None):
+    """
+    Cells from path (cells_file of the configuration), --cells <file>, DTZ_CELLS_FILE or DTZ_CELLS - the single
+    demonstrator of master otherwise
+    """
+    argv = argv if argv is not None else []
+    environ = environ if environ is not None else os.environ
+    if path is None:
+        path = environ.get("DTZ_CELLS_FILE")
+        if "--cells" in argv and argv.index("--cells") + 1 < len(argv):
+            path = argv[argv.index("--cells") + 1]
+    if path:
+        with open(path, "r", encoding="utf-8") as in_file:
+            registry = CellRegistry.from_json(in_file.read())
+    elif environ.get("DTZ_CELLS"):
+        registry = CellRegistry.from_json(environ["DTZ_CELLS"])
+    else:
+        return CellRegistry.from_master(master)
+    logger.debug("cells: %s", registry.cells())
+    return registry
@@ -0,0 +1,284 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Configuration of the DTZ Master Controller
+#   All settings are typed and validated at startup: defaults, then a JSON file (--config <file>, DTZ_CONFIG or
+#   ./dtz_config.json if it exists), then the environment (DTZ_<NAME>, e.g. DTZ_PANDA_URL, DTZ_BELT_DISTANCE),
+#   then the command line flags --simulate, --asyncio and --cells <file>. "python opc_ua_master.py --check-config"
+#   prints the resulting configuration and exits.
+#
+#   {"panda_url": "opc.tcp://192.168.48.41:4840/freeopcua/server/", "fhs_profile": "pseudo", "belt_distance": 0.5}
+#
+#   A reload (SIGHUP or the method ReloadConfig of the master server) reads file and environment again. Reloadable
+#   settings (distances, timeouts, intervals, history limits, logging, pick window) are applied at once, the sessions
+#   stay open.
+#   A changed endpoint or file path is only reported - it needs a restart. An invalid file is rejected, the old values
+#   stay.
+
+from motion_pipeline import CyclePlan, PLANS
+import threading
+import logging
+import json
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+DEFAULT_PATH = "./dtz_config.json"
+
+# endpoint and NodeIds of the FHS PLC and of the pseudo FHS server used for testing
+FHS_PROFILES = {
+    "original": {"url": "opc.tcp://192.168.10.102:4840",
+                 "node_ids": {"ShelfNumber": "ns=6;s=::AsGlobalPV:ShelfNumber",
+                              "NewValAvailable": "ns=6;s=::AsGlobalPV:NewValAvailable",
+                              "TaskRunning": "ns=6;s=::AsGlobalPV:TaskRunning"}},
+    "pseudo": {"url": "opc.tcp://192.168.48.44:4840/freeopcua/server/",
+               "node_ids": {"ShelfNumber": "ns=2;i=3", "NewValAvailable": "ns=2;i=4"}},
+}
+
+
+# read together in one Read service call when NewValAvailable rises - TaskRunning only with the original profile
+FHS_REQUEST_KEYS = ("ShelfNumber", "TaskRunning")
+
+
+class ConfigError(ValueError):
+    """
+    Raised for an invalid configuration - the message lists every problem
+    """
+    pass
+
+
+class Setting(object):
+    """
+    One typed setting. reloadable settings may change while the controller is running
+    """
+
+    def __init__(self, name, type, default, help, reloadable=False, choices=None, minimum=None):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.help = help
+        self.reloadable = reloadable
+        self.choices = choices
+        self.minimum = minimum
+
+    @property
+    def env(self):
+        return "DTZ_{}".format(self.name.upper())
+
+    def parse(self, value):
+        if value is None or value == "":
+            if self.default is None:
+                return None
+            raise ValueError("must not be empty")
+        if self.type is bool:
+            if isinstance(value, bool):
+                return value
+            if str(value).lower() in ("1", "true", "yes", "on"):
+                return True
+            if str(value).lower() in ("0", "false", "no", "off"):
+                return False
+            raise ValueError("not a boolean: {!r}".format(value))
+        if self.type is not str and isinstance(value, bool):
+            raise ValueError("not a number: {!r}".format(value))
+        parsed = self.type(value)
+        if self.choices is not None and parsed not in self.choices:
+            raise ValueError("{!r} is not one of {}".format(parsed, ", ".join(self.choices)))
+        if self.minimum is not None and parsed < self.minimum:
+            raise ValueError("{!r} is below {}".format(parsed, self.minimum))
+        if self.name.endswith("_url") and self.name != "adapter_url" and not parsed.startswith("opc.tcp://"):
+            raise ValueError("{!r} is no opc.tcp:// url".format(parsed))
+        return parsed
+
+
+SETTINGS = (
+    Setting("engine", str, "thread", "thread or asyncio engine", choices=("thread", "asyncio")),
+    Setting("simulate", bool, False, "connect to the simulated devices of simulators.py"),
+    Setting("cells_file", str, None, "JSON file with several demonstrator cells, see cells.py"),
+    Setting("server_url", str, "opc.tcp://0.0.0.0:4840/freeopcua/server", "endpoint of the master server"),
+    Setting("metrics_port", int, 9102, "port of the prometheus endpoint, 0 = off", minimum=0),
+    Setting("adapter_url", str, "192.168.48.81:1337", "host:port of the data stack adapter"),
+    Setting("panda_url", str, "opc.tcp://192.168.48.41:4840/freeopcua/server/", "endpoint of the Panda robot"),
+    Setting("pixtend_url", str, "opc.tcp://192.168.48.42:4840/freeopcua/server/", "endpoint of the PiXtend belt"),
+    Setting("fhs_profile", str, "original", "FHS PLC or the pseudo FHS server", choices=tuple(FHS_PROFILES)),
+    Setting("fhs_url", str, None, "endpoint of the FHS server - default of the fhs_profile"),
+    Setting("fhs_shelf_number_node", str, None, "NodeId of ShelfNumber - default of the fhs_profile"),
+    Setting("fhs_new_val_available_node", str, None, "NodeId of NewValAvailable - default of the fhs_profile"),
+    Setting("belt_distance", float, 0.55, "distance in meters to drive the belt", reloadable=True, minimum=0.0),
+    Setting("belt_velocity", float, 0.05428, "velocity of the belt in m/s", reloadable=True, minimum=0.001),
+    Setting("robot_start_timeout", float, 9.0, "seconds until the robot has to start moving", reloadable=True,
+            minimum=0.1),
+    Setting("belt_start_timeout", float, 3.0, "seconds until the belt has to start moving", reloadable=True,
+            minimum=0.1),
+    Setting("robot_move_timeout", float, 60.0, "seconds a robot move may take until its duration is learned",
+            reloadable=True, minimum=1.0),
+    Setting("cycle_plan", str, "overlapped", "overlap of the phases of consecutive cycles, see motion_pipeline.py",
+            choices=tuple(PLANS)),
+    Setting("cycle_robot_after", str, None, "comma separated dependencies of the robot phase - default of cycle_plan"),
+    Setting("cycle_storage_after", str, None, "dependencies of the storage phase - default of cycle_plan"),
+    Setting("cycle_belt_after", str, None, "dependencies of the belt phase - default of cycle_plan"),
+    Setting("loop_interval", float, 0.5, "seconds between two runs of the server loop", reloadable=True,
+            minimum=0.05),
+    Setting("heartbeat_timeout", float, 5.0, "seconds without a notification until a session is lost",
+            minimum=1.0),
+    Setting("publish_deadband", float, 0.001, "meters ConBeltDist has to change until it is published",
+            reloadable=True, minimum=0.0),
+    Setting("publish_interval", float, 0.2, "minimum seconds between two writes of ConBeltDist and Status",
+            reloadable=True, minimum=0.0),
+    Setting("pick_window", int, 3, "queued jobs the next pick is chosen from to shorten the robot travel, 1 = FIFO",
+            reloadable=True, minimum=1),
+    Setting("log_level", str, "DEBUG", "level of the controller log, also the method SetLogLevel", reloadable=True,
+            choices=("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")),
+    Setting("log_format", str, "text", "text lines or one JSON object per line", reloadable=True,
+            choices=("text", "json")),
+    Setting("ha_lease", str, None, "lease file shared with a standby instance, see failover.py - empty = no standby"),
+    Setting("ha_lease_ttl", float, 5.0, "seconds until the lease of a stopped active instance expires", minimum=1.0),
+    Setting("server_security", str, "None", "Basic256Sha256 mode of the master server, see security.py",
+            choices=("None", "Sign", "SignAndEncrypt")),
+    Setting("upstream_security", str, "None", "Basic256Sha256 mode of the sessions to the devices",
+            choices=("None", "Sign", "SignAndEncrypt")),
+    Setting("certificate", str, None, "application instance certificate (DER or PEM) of server and sessions"),
+    Setting("private_key", str, None, "private key of the certificate (PEM or DER)"),
+    Setting("channel_lifetime", float, 3600.0, "seconds of a secure channel token, renewed in the background",
+            minimum=10.0),
+    Setting("diagnostics_port", int, 9103, "local port of the diagnostics endpoint (127.0.0.1), 0 = off", minimum=0),
+    Setting("diagnostics_path", str, "./dtz_diagnostics", "directory of the profiles of the method Profile"),
+    Setting("capture_path", str, None, "file the upstream OPC UA traffic is recorded to, see traffic_capture.py"),
+    Setting("history_path", str, "./dtz_history", "directory of the historian segments"),
+    Setting("history_retention", float, 7 * 24 * 3600.0, "seconds of history to keep", reloadable=True,
+            minimum=60.0),
+    Setting("history_max_bytes", int, 64 * 1024 * 1024, "maximum size of the history", reloadable=True,
+            minimum=1024 * 1024),
+)
+
+
+def read_values(path=None, environ=None, overrides=None):
+    """
+    Validated {name: value} of all settings - raises ConfigError with all problems at once
+    """
+    environ = environ if environ is not None else os.environ
+    raw = dict((setting.name, setting.default) for setting in SETTINGS)
+    problems = []
+    if path is not None:
+        try:
+            with open(path, "r", encoding="utf-8") as in_file:
+                data = json.load(in_file)
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+        except (OSError, ValueError) as e:
+            raise ConfigError("config file {}: {}".format(path, e))
+        unknown = sorted(set(data) - set(raw))
+        if unknown:
+            problems.append("unknown settings in {}: {}".format(path, ", ".join(unknown)))
+        raw.update((name, value) for name, value in data.items() if name in raw)
+    for setting in SETTINGS:
+        if setting.env in environ:
+            raw[setting.name] = environ[setting.env]
+    raw.update(overrides or {})
+
+    values = {}
+    for setting in SETTINGS:
+        try:
+            values[setting.name] = setting.parse(raw[setting.name])
+        except (TypeError, ValueError) as e:
+            problems.append("{}: {}".format(setting.name, e))
+    secured = [name for name in ("server_security", "upstream_security") if values.get(name, "None") != "None"]
+    if secured and not (values.get("certificate") and values.get("private_key")):
+        problems.append("{}: needs certificate and private_key".format(", ".join(secured)))
+    if "cycle_plan" in values:
+        try:
+            CyclePlan.from_settings(values["cycle_plan"], values.get("cycle_robot_after"),
+                                    values.get("cycle_storage_after"), values.get("cycle_belt_after"))
+        except ValueError as e:
+            problems.append("cycle plan: {}".format(e))
+    if problems:
+        raise ConfigError("invalid configuration - " + "; ".join(problems))
+    return values
+
+
+def command_line(argv):
+    """
+    path of the config file and the overrides of the command line flags
+    """
+    overrides = {}
+    path = None
+    if "--simulate" in argv:
+        overrides["simulate"] = True
+    if "--asyncio" in argv:
+        overrides["engine"] = "asyncio"
+    if "--cells" in argv and argv.index("--cells") + 1 < len(argv):
+        overrides["cells_file"] = argv[argv.index("--cells") + 1]
+    if "--config" in argv and argv.index("--config") + 1 < len(argv):
+        path = argv[argv.index("--config") + 1]
+    return path, overrides
+
+
+class Config(object):
+    """
+    The current settings as attributes (config.panda_url, config.belt_distance, ...). reload() changes the
+    reloadable ones in place and tells the listeners
+    """
+
+    def __init__(self, path=None, environ=None, overrides=None):
+        self.path = path
+        self.environ = environ
+        self.overrides = overrides or {}
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.__dict__.update(read_values(path, environ, overrides))
+
+    @classmethod
+    def load(cls, argv=None, environ=None):
+        path, overrides = command_line(argv if argv is not None else [])
+        path = path or (environ if environ is not None else os.environ).get("DTZ_CONFIG")
+        if path is None and os.path.exists(DEFAULT_PATH):
+            path = DEFAULT_PATH
+        return cls(path, environ, overrides)
+
+    @property
+    def fhs_endpoint(self):
+        return self.fhs_url or FHS_PROFILES[self.fhs_profile]["url"]
+
+    @property
+    def fhs_node_ids(self):
+        node_ids = dict(FHS_PROFILES[self.fhs_profile]["node_ids"])
+        if self.fhs_shelf_number_node:
+            node_ids["ShelfNumber"] = self.fhs_shelf_number_node
+        if self.fhs_new_val_available_node:
+            node_ids["NewValAvailable"] = self.fhs_new_val_available_node
+        return node_ids
+
+    def as_dict(self):
+        return dict((setting.name, getattr(self, setting.name)) for setting in SETTINGS)
+
+    def add_listener(self, listener):
+        """
+        listener(config, changed) is called after a reload, changed is {name: (old, new)} of the applied settings
+        """
+        self._listeners.append(listener)
+
+    def reload(self):
+        """
+        Read file and environment again. Returns a summary of the changes, raises ConfigError if the new
+        configuration is invalid - the current one stays in place then
+        """
+        with self._lock:
+            values = read_values(self.path, self.environ, self.overrides)
+            changed = {}
+            restart = []
+            for setting in SETTINGS:
+                old, new = getattr(self, setting.name), values[setting.name]
+                if old == new:
+                    continue
+                if setting.reloadable:
+                    setattr(self, setting.name, new)
+                    changed[setting.name] = (old, new)
+                else:
+                    restart.append(setting.name)
+        for listener in self._listeners:
+            try:
+                listener(self, changed)
+            except Exception as e:
+                logger.debug("config: listener Catched Exception: %s", e)
+        summary = ["{}: {} -> {}".format(name, old, new) for name, (old, new) in sorted(changed.items())]
+        summary += ["{}: needs a restart".format(name) for name in restart]
+        logger.debug("config: reloaded %s", "; ".join(summary) or "unchanged")
+        return "; ".join(summary) or "unchanged"
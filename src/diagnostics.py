@@ -0,0 +1,297 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Diagnostics of the DTZ Master Controller
+#   For a controller which stalls in production: the stacks of all threads (and of the asyncio tasks), a sampling
+#   profiler and a census of the live objects. Available as methods of DTZMasterController/Diagnostics (DumpThreads,
+#   Profile(seconds), ObjectCounts) and on a local HTTP port (diagnostics_port, bound to 127.0.0.1):
+#
+#   curl localhost:9103/threads
+#   curl localhost:9103/profile?seconds=30 > dtz.collapsed      flamegraph.pl dtz.collapsed > dtz.svg
+#   curl localhost:9103/objects
+#
+#   The profiler samples the stacks of all threads every 10 ms from its own thread, one line per stack and count
+#   in the collapsed format of flamegraph.pl / speedscope ("thread;file:function;file:function count"). It is a
+#   wall clock profile: waiting threads show up with their wait. Only one profile runs at a time, at most
+#   MAX_PROFILE_SECONDS. A sample only collects the code objects of the stacks, the names are formatted at the end -
+#   below 1% of a CPU with 20 threads under load (benchmark.py, logged with the profile). The method Profile
+#   returns at once with the path of the file, which is written to diagnostics_path when the profile is done.
+#   The census counts the objects known to the garbage collector by type and shows the growth since the last
+#   census and the resident memory. With PYTHONTRACEMALLOC=1 it also lists the allocation sites which grew most.
+
+import collections
+import threading
+import tracemalloc
+import traceback
+import asyncio
+import logging
+import time
+import sys
+import gc
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+MAX_PROFILE_SECONDS = 300
+
+
+def rss_mb():
+    """
+    Resident memory of the process in MB, None if unknown
+    """
+    try:
+        with open("/proc/self/status", "r") as in_file:
+            for line in in_file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def code_name(code):
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Diagnostics(object):
+    """
+    Thread dump, sampling profiler and object census. Thread safe
+    """
+
+    def __init__(self, path="./dtz_diagnostics", interval=0.01):
+        self.path = path
+        self.interval = interval  # seconds between two samples of the profiler
+        self.loop = None  # event loop of the asyncio engine - its tasks are part of the thread dump
+        self._loop_thread = None
+        self._profiling = threading.Lock()
+        self._census_lock = threading.Lock()
+        self._last_counts = None
+        self._last_rss = None
+        self._start_rss = rss_mb()
+        self._last_snapshot = None
+
+    def configure(self, config):
+        self.path = config.diagnostics_path
+        return self
+
+    ############# THREADS #############
+    def threads(self):
+        """
+        Stacks of all threads with their names, then the asyncio tasks
+        """
+        frames = sys._current_frames()
+        lines = ["{} threads, {}".format(threading.active_count(), time.strftime("%Y-%m-%d %H:%M:%S"))]
+        for thread in sorted(threading.enumerate(), key=lambda t: t.name):
+            lines.append("")
+            lines.append("Thread {} (ident {}{})".format(thread.name, thread.ident,
+                                                        ", daemon" if thread.daemon else ""))
+            frame = frames.get(thread.ident)
+            if frame is not None:
+                lines.extend(line.rstrip("\n") for line in traceback.format_stack(frame))
+        if self.loop is not None:
+            lines.append("")
+            lines.extend(self.tasks())
+        return "\n".join(lines)
+
+    def attach(self, loop):
+        """
+        Called in the event loop of the asyncio engine - its tasks are listed with the threads
+        """
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+        return self
+
+    def tasks(self, timeout=1.0):
+        """
+        Stacks of the asyncio tasks - taken in the event loop, which tells as well whether it still responds
+        """
+        loop = self.loop
+
+        def collect():
+            lines = []
+            for task in sorted(asyncio.all_tasks(loop), key=lambda t: t.get_name()):
+                lines.append("Task {} {}".format(task.get_name(), task.get_coro()))
+                for frame in task.get_stack():
+                    lines.append('  File "{}", line {}, in {}'.format(frame.f_code.co_filename, frame.f_lineno,
+                                                                      frame.f_code.co_name))
+            return lines
+
+        if threading.get_ident() == self._loop_thread:
+            return collect()
+        if loop.is_closed():
+            return ["event loop closed"]
+        done = threading.Event()
+        result = []
+
+        def run():
+            result.extend(collect())
+            done.set()
+        loop.call_soon_threadsafe(run)
+        if not done.wait(timeout):
+            return ["event loop does not respond within {} seconds - see the stack of its thread".format(timeout)]
+        return result
+
+    ############# PROFILER #############
+    def profile(self, seconds):
+        """
+        Sample all threads for seconds. Returns (collapsed stacks, summary), None if a profile is running
+        """
+        if not self._profiling.acquire(False):
+            return None
+        try:
+            return self._profile(min(max(float(seconds), 0.1), MAX_PROFILE_SECONDS))
+        finally:
+            self._profiling.release()
+
+    def _profile(self, seconds):
+        # counts the stacks as tuples of code objects, the names are only formatted at the end
+        stacks = collections.Counter()
+        names = {}  # thread ident -> name
+        own = threading.get_ident()
+        samples = 0
+        busy = 0.0  # seconds spent sampling
+        start = time.time()
+        deadline = start + seconds
+        while time.time() < deadline:
+            tick = time.perf_counter()
+            if samples % 50 == 0:
+                names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                stacks[(ident, tuple(codes))] += 1
+            samples += 1
+            busy += time.perf_counter() - tick
+            time.sleep(self.interval)
+        collapsed = collections.Counter()
+        for (ident, codes), count in stacks.items():
+            thread = names.get(ident, "thread-{}".format(ident)).replace(";", ":")
+            collapsed[";".join([thread] + [code_name(code) for code in reversed(codes)])] += count
+        elapsed = max(time.time() - start, 1e-6)
+        summary = "{} samples in {:.1f} seconds, {:.2f}% of a CPU for the sampling".format(samples, elapsed,
+                                                                                           100.0 * busy / elapsed)
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(collapsed.items())), summary
+
+    def start_profile(self, seconds):
+        """
+        Profile in its own thread, written to diagnostics_path. Returns the path at once
+        """
+        if self._profiling.locked():
+            return "Error - a profile is running"
+        seconds = min(max(float(seconds), 0.1), MAX_PROFILE_SECONDS)
+        path = os.path.join(self.path, "profile-{}.collapsed".format(time.strftime("%Y%m%d-%H%M%S")))
+
+        def run():
+            result = self.profile(seconds)
+            if result is None:
+                return
+            collapsed, summary = result
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                with open(path, "w", encoding="utf-8") as out_file:
+                    out_file.write(collapsed)
+                logger.info("diagnostics: profile written to %s - %s", path, summary)
+            except (IOError, OSError) as e:
+                logger.error("diagnostics: Catched Exception: %s", e)
+        profile_thread = threading.Thread(name='profile_thread', target=run)
+        profile_thread.daemon = True
+        profile_thread.start()
+        return "Profile of {:.1f} seconds is written to {}".format(seconds, path)
+
+    ############# OBJECTS #############
+    def objects(self, limit=25):
+        """
+        Live objects by type with the growth since the last census, resident memory and garbage collector
+        """
+        with self._census_lock:
+            counts = collections.Counter()
+            for obj in gc.get_objects():
+                kind = type(obj)
+                module = kind.__module__
+                counts[kind.__name__ if module == "builtins" else "{}.{}".format(module, kind.__qualname__)] += 1
+            last, self._last_counts = self._last_counts, counts
+            rss = rss_mb()
+            last_rss, self._last_rss = self._last_rss, rss
+
+            lines = []
+            if rss is not None:
+                lines.append("rss {:.1f} MB ({:+.1f} MB since the last census, {:+.1f} MB since the start)".format(
+                    rss, rss - (last_rss if last_rss is not None else rss),
+                    rss - (self._start_rss if self._start_rss is not None else rss)))
+            lines.append("{} objects, gc counts {}, {} uncollectable".format(sum(counts.values()), gc.get_count(),
+                                                                             len(gc.garbage)))
+            lines.append("")
+            lines.append("{:<48} {:>10} {:>10}".format("type", "count", "growth"))
+            growth = dict((kind, count - (last or {}).get(kind, 0)) for kind, count in counts.items())
+            top = counts.most_common(limit)
+            grown = [kind for kind, delta in sorted(growth.items(), key=lambda item: -item[1])[:limit]
+                     if last is not None and delta > 0 and kind not in dict(top)]
+            for kind, count in top + [(kind, counts[kind]) for kind in grown]:
+                lines.append("{:<48} {:>10} {:>+10}".format(kind[:48], count, growth[kind] if last else 0))
+
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                last_snapshot, self._last_snapshot = self._last_snapshot, snapshot
+                lines.append("")
+                if last_snapshot is None:
+                    lines.append("allocations - growth from the next census on")
+                    stats = snapshot.statistics("lineno")[:limit]
+                else:
+                    lines.append("allocation growth since the last census")
+                    stats = snapshot.compare_to(last_snapshot, "lineno")[:limit]
+                lines.extend(str(stat) for stat in stats)
+            return "\n".join(lines)
+
+    ############# HTTP #############
+    def start_http_server(self, port=9103, host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import urlparse, parse_qs
+        diagnostics = self
+
+        class DiagnosticsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    if url.path == "/threads":
+                        body = diagnostics.threads()
+                    elif url.path == "/objects":
+                        body = diagnostics.objects(int(query.get("limit", ["25"])[0]))
+                    elif url.path == "/profile":
+                        result = diagnostics.profile(float(query.get("seconds", ["10"])[0]))
+                        if result is None:
+                            self.send_error(409, "a profile is running")
+                            return
+                        body = result[0]
+                        logger.debug("diagnostics: profile - %s", result[1])
+                    else:
+                        self.send_error(404)
+                        return
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), DiagnosticsHandler)
+        httpd.daemon_threads = True
+        diagnostics_thread = threading.Thread(name='diagnostics_http_thread', target=httpd.serve_forever)
+        diagnostics_thread.daemon = True
+        diagnostics_thread.start()
+        logger.debug("diagnostics: endpoint started at http://%s:%s/", host, port)
+        return httpd
+
+
+# one for the whole controller
+diagnostics = Diagnostics()
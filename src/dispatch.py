@@ -0,0 +1,97 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Event dispatcher of the DTZ Master Controller
+#   Subscription callbacks run on the receive thread of the OPC UA client - anything slow in there (reads, file I/O)
+#   stalls the delivery of all other notifications of that client. The callbacks only hand a small event to this
+#   bounded worker pool. An event with the same key as one which is still waiting is coalesced, e.g. a second
+#   NewValAvailable edge before the first one was processed - the worker reads the current ShelfNumber anyway.
+#   Events with the same key never run in parallel, so their order is kept.
+
+from metrics import metrics
+import collections
+import threading
+import logging
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+
+class EventDispatcher(object):
+    """
+    Bounded worker pool for the work of the subscription callbacks. submit() never blocks
+    """
+
+    def __init__(self, workers=2, capacity=100, name="dispatch"):
+        self.workers = workers
+        self.capacity = capacity
+        self.name = name
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._pending = set()  # keys of the waiting events
+        self._running = set()  # keys of the events which are processed right now
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def submit(self, key, function, *args):
+        """
+        Queue function(*args). Returns False if it was coalesced with a waiting event of the same key or
+        dropped because the queue is full
+        """
+        with self._cond:
+            if key is not None and key in self._pending:
+                self.coalesced += 1
+                metrics.inc("dtz_dispatch_events_total", result="coalesced", key=key)
+                return False
+            if len(self._queue) >= self.capacity:
+                self.dropped += 1
+                metrics.inc("dtz_dispatch_events_total", result="dropped", key=key)
+                logger.debug("dispatch: queue full - event %s dropped", key)
+                return False
+            if key is not None:
+                self._pending.add(key)
+            self._queue.append((key, function, args, time.time()))
+            self.queued += 1
+            self._cond.notify_all()
+        metrics.inc("dtz_dispatch_events_total", result="queued", key=key)
+        return True
+
+    def depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def start(self):
+        for worker in range(self.workers):
+            worker_thread = threading.Thread(name='{}_worker_{}'.format(self.name, worker), target=self.run)
+            worker_thread.daemon = True
+            worker_thread.start()
+        return self
+
+    def _take(self):
+        # oldest event whose key is not processed by another worker
+        for i, event in enumerate(self._queue):
+            if event[0] is None or event[0] not in self._running:
+                del self._queue[i]
+                return event
+        return None
+
+    def run(self):
+        while True:
+            with self._cond:
+                event = self._take()
+                while event is None:
+                    self._cond.wait()
+                    event = self._take()
+                key, function, args, queued_at = event
+                self._pending.discard(key)  # a new edge from now on is a new event
+                if key is not None:
+                    self._running.add(key)
+            metrics.observe("dtz_dispatch_wait_seconds", time.time() - queued_at, key=key)
+            try:
+                function(*args)
+            except Exception as e:
+                logger.debug("dispatch: event %s Catched Exception: %s", key, e)
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+                    self._cond.notify_all()
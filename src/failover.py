@@ -0,0 +1,269 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Active-standby mode of the DTZ Master Controller
+#   Two instances run side by side on the same host. The one which holds the lease - a small JSON file on the shared
+#   volume (ha_lease), changed under an flock - is active: it serves the master server on port 4840, runs the jobs
+#   and writes storage and job journal. It renews the lease every ha_lease_ttl / 4 seconds and checks before every
+#   write to storage or journal that its lease is still valid for at least that long - an instance which stalled
+#   (GC pause, fsync, busy thread) refuses the write instead of racing the new active one. The standby connects
+#   to the devices like the active one (warm sessions, state cache, address space), follows storage and job journal
+#   on the shared volume and remembers the FHS requests it sees. Once the lease expired it takes over: reads
+#   storage and journal a last time, submits the FHS requests the active one did not journal any more and starts
+#   the server - within ha_lease_ttl plus a few milliseconds after the last renewal. The journal is only compacted
+#   (rewritten) once the lease of the previous instance is expired for another ha_lease_ttl, and the server start is
+#   retried while the previous instance may still hold the port - if it never works out the lease is released.
+#   A job which was in motion at the takeover is not repeated - the part may already be taken - it ends as
+#   interrupted with its phase. An active instance which could not renew its lease in time stops at once (exit 3),
+#   so there are never two active instances - the container is restarted as the new standby.
+#
+#   {"owner": "il060-7-3f2a1c", "renewed": 1760803199.65, "expires": 1760803200.25, "term": 12}
+
+from supervisor import Backoff
+import collections
+import threading
+import logging
+import socket
+import fcntl
+import json
+import time
+import uuid
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+FHS_MATCH = 1.0  # seconds between an FHS request seen by the standby and the journaled job of the same shelf
+START_ATTEMPTS = 6  # server starts after a takeover, the previous instance may still hold the port
+
+
+class LeaseExpired(IOError):
+    """
+    Raised instead of a write to storage or journal by an instance whose lease is about to expire
+    """
+    pass
+
+
+class FileLease(object):
+    """
+    Lease of the active instance. acquire() takes an expired lease or renews the own one
+    """
+
+    def __init__(self, path, ttl=5.0, owner=None):
+        self.path = path
+        self.ttl = ttl
+        self.owner = owner or "{}-{}-{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:6])
+        self.expires = 0.0  # of the own lease
+        self.term = 0
+        self.previous = None  # record of the instance the lease was taken from
+
+    def _read(self, lease_file):
+        try:
+            record = json.loads(lease_file.read() or "{}")
+        except ValueError:
+            record = {}  # torn by a crash of an older version - treated as expired
+        return record if isinstance(record, dict) else {}
+
+    def acquire(self):
+        """
+        True if this instance holds the lease now
+        """
+        with open(self.path, "a+", encoding="utf-8") as lease_file:
+            fcntl.flock(lease_file, fcntl.LOCK_EX)  # released with the file
+            lease_file.seek(0)
+            record = self._read(lease_file)
+            now = time.time()
+            if record.get("owner") not in (None, self.owner) and record.get("expires", 0) > now:
+                return False
+            term = record.get("term", 0) + (0 if record.get("owner") == self.owner else 1)
+            lease_file.seek(0)
+            lease_file.truncate()
+            lease_file.write(json.dumps({"owner": self.owner, "renewed": now, "expires": now + self.ttl,
+                                         "term": term}))
+            lease_file.flush()
+        if record.get("owner") != self.owner:
+            self.previous = record
+            logger.debug("lease: %s holds the lease %s, term %s", self.owner, self.path, term)
+        self.expires, self.term = now + self.ttl, term
+        return True
+
+    def check(self):
+        """
+        Fence of the shared files - raises LeaseExpired if the own lease is valid for less than one renewal
+        interval, e.g. after the renewal thread stalled. Set as fence of storage and job queue at the takeover
+        """
+        if time.time() > self.expires - self.ttl / 4:
+            raise LeaseExpired("lease {} of {} expired - not writing".format(self.path, self.owner))
+
+    def grace_end(self):
+        """
+        Time after which the instance the lease was taken from can not write any more - its lease expired one ttl
+        before. 0 if it was released or there was none
+        """
+        previous = self.previous or {}
+        return previous.get("expires", 0) + self.ttl if previous.get("expires") else 0.0
+
+    def release(self):
+        """
+        Hand the lease over at once, e.g. on a shutdown - the standby does not wait for the expiry
+        """
+        with open(self.path, "a+", encoding="utf-8") as lease_file:
+            fcntl.flock(lease_file, fcntl.LOCK_EX)
+            lease_file.seek(0)
+            record = self._read(lease_file)
+            if record.get("owner") != self.owner:
+                return False
+            lease_file.seek(0)
+            lease_file.truncate()
+            lease_file.write(json.dumps(dict(record, expires=0)))
+        self.expires = 0.0
+        return True
+
+
+class Replica(object):
+    """
+    Copy of the storage and the job queue of one cell, read again whenever the active instance changed the files
+    """
+
+    def __init__(self, storage, jobs, name="dtz"):
+        self.storage = storage
+        self.jobs = jobs
+        self.name = name
+        self.fhs_requests = collections.deque(maxlen=20)  # (time, shelf) seen by the standby
+        self._versions = {}  # path -> (mtime, size) of the last read
+
+    def _changed(self, path):
+        try:
+            stat = os.stat(path)
+            version = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            version = None
+        if self._versions.get(path, False) == version:
+            return False
+        self._versions[path] = version
+        return True
+
+    def refresh(self):
+        if self._changed(self.storage.path):
+            self.storage.load()
+        if self._changed(self.jobs.path):
+            self.jobs.load(replica=True)
+
+    def remember(self, shelf):
+        """
+        An FHS request seen by the standby - submitted at the takeover if the active one did not journal it
+        """
+        self.fhs_requests.append((time.time(), shelf))
+
+    def missed(self, since):
+        """
+        Shelves of the FHS requests after since without a queued or running FHS job of the same shelf
+        """
+        jobs = [job for job in self.jobs.jobs() if job.source == "fhs"]
+        missed = []
+        for seen, shelf in self.fhs_requests:
+            if seen < since:
+                continue
+            match = [job for job in jobs if job.shelf == shelf and abs(job.created - seen) <= FHS_MATCH]
+            if match:
+                jobs.remove(match[0])
+            else:
+                missed.append(shelf)
+        return missed
+
+
+class Standby(object):
+    """
+    Waits for the lease while the replicas follow the active instance, then keeps the lease
+    """
+
+    def __init__(self, lease, replicas, interval=0.05):
+        self.lease = lease
+        self.replicas = replicas
+        self.interval = interval
+        self.active = False
+
+    def wait(self):
+        """
+        Blocks until this instance holds the lease
+        """
+        logger.debug("standby: %s waits for the lease %s", self.lease.owner, self.lease.path)
+        while True:
+            try:
+                if self.lease.acquire():
+                    break
+            except (IOError, OSError) as e:
+                logger.debug("standby: lease Catched Exception: %s", e, extra={"throttle": True})
+            for replica in self.replicas:
+                try:
+                    replica.refresh()
+                except Exception as e:
+                    logger.debug("standby: replica %s Catched Exception: %s", replica.name, e,
+                                 extra={"throttle": True})
+            time.sleep(self.interval)
+        self.active = True  # FHS requests are queued from now on
+        for replica in self.replicas:
+            replica.storage.fence = replica.jobs.fence = self.lease.check
+        previous = self.lease.previous or {}
+        if previous.get("owner"):
+            logger.debug("standby: took over from %s, %.3f seconds after its lease expired", previous["owner"],
+                         time.time() - previous.get("expires", 0))
+
+    def since(self):
+        """
+        Time of the last renewal of the previous active instance - FHS requests after it may be lost
+        """
+        previous = self.lease.previous or {}
+        return previous.get("renewed", 0) - self.interval
+
+    def serve(self, start, stop=None, attempts=START_ATTEMPTS):
+        """
+        start() the master server after the takeover - retried with backoff while the fenced previous instance
+        may still hold the port. On the last failure the lease is released, so the other instance can serve,
+        and the error raised
+        """
+        backoff = Backoff(0.5, self.lease.ttl)
+        for attempt in range(1, attempts + 1):
+            try:
+                return start()
+            except Exception as e:
+                if attempt == attempts:
+                    logger.error("standby: server not started after %s attempts, releasing the lease: %s",
+                                 attempts, e)
+                    self.active = False  # stops the renewal
+                    self.lease.release()
+                    raise
+                delay = backoff.next()
+                logger.debug("standby: server start Catched Exception: %s - trying again in %.1f seconds", e,
+                             delay)
+            if stop is not None:
+                try:
+                    stop()
+                except Exception as e:
+                    logger.debug("standby: server stop Catched Exception: %s", e)
+            time.sleep(delay)
+
+    def keep(self, lost):
+        """
+        Renew the lease in its own thread, lost() is called if it could not be renewed before it expired
+        """
+        lease_thread = threading.Thread(name='lease_thread', target=self.run, args=(lost,))
+        lease_thread.daemon = True
+        lease_thread.start()
+        return lease_thread
+
+    def run(self, lost):
+        while True:
+            time.sleep(self.lease.ttl / 4)
+            if not self.active:
+                return  # released
+            try:
+                if self.lease.acquire():
+                    continue
+                logger.error("standby: lease %s taken over by another instance", self.lease.path)
+            except (IOError, OSError) as e:
+                if time.time() < self.lease.expires:
+                    logger.debug("standby: lease Catched Exception: %s", e)
+                    continue
+                logger.error("standby: lease %s not renewed: %s", self.lease.path, e)
+            self.active = False
+            lost()
+            return
@@ -0,0 +1,308 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Historian of the DTZ Master Controller
+#   Embedded, append-only time-series store of the device state (State/RobotMoving, ...), the shelf occupancy and the
+#   cycle timings, so the recent behaviour can be queried with OPC UA HistoryRead without the external data stack.
+#   Values are buffered per series and written as compressed chunks - one column of timestamps (delta encoded) and
+#   one column of values per chunk - to one append-only segment file per hour. Reads memory-map the segment files
+#   and only decompress the chunks in the requested time range. Old segments are evicted after the retention time
+#   or when the history exceeds max_bytes, so disk and memory stay bounded.
+#
+#   chunk:  header (magic, length of the series name, count, first, last, length of the payload) | series name |
+#           zlib(length of the timestamp column | timestamps in microseconds, delta encoded | JSON list of values)
+
+from metrics import metrics
+from datetime import datetime, timezone
+import threading
+import logging
+import struct
+import mmap
+import json
+import time
+import zlib
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+MAGIC = b"DTZH"
+CHUNK_HEADER = struct.Struct("<4sHIddI")
+SEGMENT_SUFFIX = ".seg"
+
+
+def encode_chunk(series, values):
+    """
+    values is a list of (timestamp, value), oldest first
+    """
+    timestamps = [int(round(timestamp * 1e6)) for timestamp, value in values]
+    deltas = [timestamps[0]] + [timestamp - previous for previous, timestamp in zip(timestamps, timestamps[1:])]
+    column = struct.pack("<{}q".format(len(deltas)), *deltas)
+    payload = zlib.compress(struct.pack("<I", len(column)) + column +
+                            json.dumps([value for timestamp, value in values]).encode("utf-8"))
+    name = series.encode("utf-8")
+    return CHUNK_HEADER.pack(MAGIC, len(name), len(values), values[0][0], values[-1][0], len(payload)) + name + payload
+
+
+def decode_payload(count, payload):
+    data = zlib.decompress(payload)
+    length = struct.unpack_from("<I", data)[0]
+    deltas = struct.unpack_from("<{}q".format(count), data, 4)
+    timestamps = []
+    timestamp = 0
+    for delta in deltas:
+        timestamp += delta
+        timestamps.append(timestamp / 1e6)
+    return list(zip(timestamps, json.loads(data[4 + length:].decode("utf-8"))))
+
+
+class Historian(object):
+    """
+    Append-only time-series store. record() never does I/O - full chunks are written by the flush thread
+    """
+
+    def __init__(self, path="./dtz_history", retention=7 * 24 * 3600, max_bytes=64 * 1024 * 1024,
+                 segment_seconds=3600, chunk_size=256, flush_interval=10, max_pending=1000):
+        self.path = path
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.segment_seconds = segment_seconds
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._buffers = {}  # series -> [(timestamp, value), ...] not yet in a chunk
+        self._ready = []  # (series, values) of the chunks waiting for the flush thread
+        self._write_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def record(self, series, value, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._cond:
+            buffer = self._buffers.get(series)
+            if buffer and timestamp - buffer[0][0] > self.flush_interval:
+                # a chunk spans at most flush_interval - reads only look at the segments around the range
+                self._seal(series)
+                buffer = None
+            if buffer is None:
+                buffer = self._buffers[series] = []
+            buffer.append((timestamp, value))
+            if len(buffer) >= self.chunk_size:
+                self._seal(series)
+
+    def _seal(self, series):
+        self._ready.append((series, self._buffers.pop(series)))
+        if len(self._ready) > self.max_pending:
+            dropped = self._ready.pop(0)
+            logger.debug("historian: flush thread behind - %s values of %s dropped", len(dropped[1]), dropped[0])
+        self._cond.notify_all()
+
+    def flush(self):
+        """
+        Write all buffered values - called by the flush thread and on shutdown
+        """
+        with self._cond:
+            for series in list(self._buffers):
+                self._seal(series)
+        self._write_ready()
+
+    def _write_ready(self):
+        with self._cond:
+            ready, self._ready = self._ready, []
+        if not ready:
+            return
+        segments = {}
+        for series, values in ready:
+            start = int(values[0][0] // self.segment_seconds * self.segment_seconds)
+            segments.setdefault(start, []).append(encode_chunk(series, values))
+        with self._write_lock, metrics.timer("dtz_file_write_seconds", file="history"):
+            for start, chunks in sorted(segments.items()):
+                with open(self._segment_path(start), "ab") as out_file:
+                    out_file.write(b"".join(chunks))
+                    out_file.flush()
+                    os.fsync(out_file.fileno())
+
+    def _segment_path(self, start):
+        return os.path.join(self.path, "{:010d}{}".format(start, SEGMENT_SUFFIX))
+
+    def segments(self):
+        """
+        [(start, path)] of all segment files, oldest first
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                segments.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.path, name)))
+        return sorted(segments)
+
+    def evict(self, now=None):
+        """
+        Delete the segments older than the retention time, then the oldest ones while the history is too big
+        """
+        now = time.time() if now is None else now
+        with self._write_lock:
+            segments = self.segments()
+            keep = []
+            for start, path in segments:
+                if start + self.segment_seconds + self.flush_interval < now - self.retention:
+                    self._remove(path, "retention")
+                else:
+                    keep.append((start, path))
+            sizes = [os.path.getsize(path) for start, path in keep]
+            while len(keep) > 1 and sum(sizes) > self.max_bytes:
+                self._remove(keep.pop(0)[1], "size")
+                sizes.pop(0)
+
+    def _remove(self, path, reason):
+        try:
+            os.remove(path)
+            logger.debug("historian: %s evicted (%s)", path, reason)
+        except OSError as e:
+            logger.debug("historian: Catched Exception while evicting %s: %s", path, e)
+
+    def read(self, series, start=None, end=None, limit=0, newest_first=False):
+        """
+        [(timestamp, value)] of the series with start <= timestamp <= end (both inclusive, None is open),
+        at most limit values (0 = all)
+        """
+        low = float("-inf") if start is None else start
+        high = float("inf") if end is None else end
+        values = []
+        for segment_start, path in self.segments():
+            # chunks are in the segment of their first value and span at most flush_interval
+            if segment_start > high or segment_start + self.segment_seconds + 2 * self.flush_interval < low:
+                continue
+            values.extend(self._read_segment(path, series, low, high))
+        with self._cond:
+            pending = [chunk for name, chunk in self._ready if name == series] + [self._buffers.get(series, [])]
+        for chunk in pending:
+            values.extend(value for value in chunk if low <= value[0] <= high)
+        values.sort(key=lambda value: value[0], reverse=newest_first)
+        return values[:limit] if limit else values
+
+    def _read_segment(self, path, series, low, high):
+        name = series.encode("utf-8")
+        values = []
+        try:
+            with open(path, "rb") as in_file:
+                if os.fstat(in_file.fileno()).st_size == 0:
+                    return values
+                with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    offset = 0
+                    while offset + CHUNK_HEADER.size <= len(data):
+                        magic, name_length, count, first, last, length = CHUNK_HEADER.unpack_from(data, offset)
+                        end = offset + CHUNK_HEADER.size + name_length + length
+                        if magic != MAGIC or end > len(data):
+                            logger.debug("historian: %s is truncated at %s", path, offset)
+                            break
+                        name_start = offset + CHUNK_HEADER.size
+                        if last >= low and first <= high and data[name_start:name_start + name_length] == name:
+                            chunk = decode_payload(count, data[name_start + name_length:end])
+                            values.extend(value for value in chunk if low <= value[0] <= high)
+                        offset = end
+        except (OSError, ValueError, zlib.error) as e:
+            # evicted while reading or a broken chunk - the rest of the history is still readable
+            logger.debug("historian: Catched Exception while reading %s: %s", path, e)
+        return values
+
+    def start(self):
+        historian_thread = threading.Thread(name='historian_thread', target=self.run)
+        historian_thread.daemon = True
+        historian_thread.start()
+        return historian_thread
+
+    def run(self):
+        last_flush = time.time()
+        while True:
+            with self._cond:
+                self._cond.wait(self.flush_interval)
+            try:
+                if time.time() - last_flush >= self.flush_interval:
+                    self.flush()
+                    self.evict()
+                    last_flush = time.time()
+                else:
+                    self._write_ready()
+            except Exception as e:
+                logger.debug("historian: Catched Exception: %s", e)
+
+
+class HistorianStorage(object):
+    """
+    History backend of the OPC UA server (server.iserver.history_manager.set_storage) for the python-opcua
+    engine. Node values come from server.historize_node_data_change(), every node is stored under a readable
+    series name (e.g. State/RobotMoving) instead of its NodeId, so the history survives a changed address space
+    """
+
+    aware = False  # python-opcua uses naive UTC datetimes
+
+    def __init__(self, historian, ua):
+        self.historian = historian
+        self.ua = ua
+        self._series = {}  # NodeId -> series
+
+    def historize(self, server, node, series):
+        """
+        Record the values of node as series and allow HistoryRead on it
+        """
+        self._series[node.nodeid] = series
+        access = self.ua.AccessLevel.CurrentRead.mask | self.ua.AccessLevel.HistoryRead.mask
+        for attribute in (self.ua.AttributeIds.AccessLevel, self.ua.AttributeIds.UserAccessLevel):
+            access_value = node.get_attribute(attribute).Value.Value | access
+            node.set_attribute(attribute, self.ua.DataValue(self.ua.Variant(access_value, self.ua.VariantType.Byte)))
+        node.set_attribute(self.ua.AttributeIds.Historizing, self.ua.DataValue(self.ua.Variant(True)))
+        server.historize_node_data_change(node, count=0)
+
+    def to_epoch(self, moment):
+        if moment is None:
+            return None
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=timezone.utc)
+        return None if moment.year <= 1601 else moment.timestamp()  # the win epoch means "not set"
+
+    def from_epoch(self, timestamp):
+        moment = datetime.fromtimestamp(timestamp, timezone.utc)
+        return moment if self.aware else moment.replace(tzinfo=None)
+
+    def new_historized_node(self, node_id, period, count=0):
+        self._series.setdefault(node_id, node_id.to_string())
+
+    def save_node_value(self, node_id, datavalue):
+        timestamp = self.to_epoch(datavalue.SourceTimestamp or datavalue.ServerTimestamp)
+        self.historian.record(self._series.get(node_id, node_id.to_string()), datavalue.Value.Value, timestamp)
+
+    def read_node_history(self, node_id, start, end, nb_values):
+        """
+        Same semantics as the memory storage of the library: without start the newest values first, start after
+        end reads backwards. The continuation point is the timestamp of the first value which was not returned
+        """
+        series = self._series.get(node_id)
+        if series is None:
+            logger.debug("historian: HistoryRead of %s which is not historized", node_id)
+            return [], None
+        start, end = self.to_epoch(start), self.to_epoch(end)
+        newest_first = start is None or (end is not None and start > end)
+        if start is not None and end is not None and start > end:
+            start, end = end, start
+        limit = nb_values + 1 if nb_values else 0
+        values = self.historian.read(series, start, end, limit, newest_first)
+        continuation = None
+        if nb_values and len(values) > nb_values:
+            continuation = self.from_epoch(values[nb_values][0])
+            values = values[:nb_values]
+        return [self.datavalue(value, self.from_epoch(timestamp)) for timestamp, value in values], continuation
+
+    def datavalue(self, value, moment):
+        datavalue = self.ua.DataValue(self.ua.Variant(value))
+        datavalue.SourceTimestamp = datavalue.ServerTimestamp = moment
+        return datavalue
+
+    def new_historized_event(self, source_id, evtypes, period, count=0):
+        logger.debug("historian: events are not historized")
+
+    def save_event(self, event):
+        pass
+
+    def read_event_history(self, source_id, start, end, nb_values, evfilter):
+        return [], None
+
+    def stop(self):
+        self.historian.flush()
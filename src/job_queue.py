@@ -0,0 +1,474 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Job queue of the DTZ Master Controller
+#   Shelf requests from the FHS server (NewValAvailable) and from the MoveDemonstrator method are queued instead of
+#   being rejected or dropped while the demonstrator is busy. The queue is journaled to disk, so pending requests
+#   survive a restart. The scheduler runs the jobs back to back as cycles of the motion pipeline, so the robot pick
+#   of the next job can overlap the belt of the previous one.
+#   A queued job can be cancelled at once, a running one gets a deadline: its motion waits are aborted when the
+#   deadline passed and the job ends as cancelled - the robot or the belt may still finish the commanded move,
+#   the next job waits for the robot as usual.
+#   With a pick sequencer the next job is not always the oldest one - see pick_sequencer.py.
+
+from motion_pipeline import CyclePlan, CycleRun, FINISHED as PHASE_FINISHED
+from shelf_storage import SHELVES
+from supervisor import wait_state
+from motion_tracker import MotionTracker
+import motion_tracker
+from metrics import metrics
+import collections
+import threading
+import logging
+import json
+import time
+import os
+import re
+
+logger = logging.getLogger('dtz_master_controller')
+
+# job states
+QUEUED = "queued"
+ROBOT = "robot"
+BELT = "belt"
+DONE = "done"
+FAILED = "failed"
+INTERRUPTED = "interrupted"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, INTERRUPTED, CANCELLED)
+
+# movement argument of MoveRobotRos, e.g. "SO"
+MOVEMENT = re.compile(r"^[A-Za-z0-9_]+$")
+
+# properties of the DemonstratorJobEventType, fired on every status change of a job - (name, VariantType)
+JOB_EVENT_PROPERTIES = (("JobId", "Int64"), ("Shelf", "Int64"), ("Status", "String"), ("JobMessage", "String"))
+
+
+def invalid_request(shelf, movement):
+    """
+    Error message of a MoveDemonstrator request which must not be queued, None if it is valid. Checked before the
+    job is submitted - the scheduler moves the robot before the storage rejects a wrong shelf
+    """
+    if isinstance(shelf, bool) or not isinstance(shelf, int) or not 1 <= shelf <= SHELVES:
+        return "Error - invalid shelf"
+    if not isinstance(movement, str) or not MOVEMENT.match(movement):
+        return "Error - invalid movement"
+    return None
+
+
+class Cancelled(Exception):
+    """
+    Raised by the motion waits of a job whose cancel deadline passed
+    """
+    pass
+
+
+class Cancellation(object):
+    """
+    Cancel request of a running job - check() is called by the motion waits like the check() of a breaker
+    """
+
+    def __init__(self):
+        self.deadline = None
+
+    @property
+    def requested(self):
+        return self.deadline is not None
+
+    def request(self, timeout=0.0):
+        deadline = time.time() + timeout
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+
+    def remaining(self):
+        return None if self.deadline is None else max(self.deadline - time.time(), 0)
+
+    def check(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            raise Cancelled("job cancelled")
+
+
+class Job(object):
+    """
+    One shelf request
+    """
+
+    def __init__(self, job_id, shelf, movement="SO", source="fhs", created=None, status=QUEUED, message=""):
+        self.job_id = job_id
+        self.shelf = shelf
+        self.movement = movement
+        self.source = source
+        self.created = created or time.time()
+        self.status = status
+        self.message = message
+        self.cancellation = Cancellation()  # not journaled - a restart interrupts a running job anyway
+        self.overtaken = 0  # times a younger job was taken first, see PickSequencer
+
+    def to_dict(self):
+        return {"id": self.job_id, "shelf": self.shelf, "movement": self.movement, "source": self.source,
+                "created": self.created, "status": self.status, "message": self.message}
+
+    def __repr__(self):
+        return "Job({}, shelf={}, {})".format(self.job_id, self.shelf, self.status)
+
+
+class JobQueue(object):
+    """
+    Persistent FIFO of shelf requests. The journal is a file with one JSON record per line, it is compacted
+    every time the queue runs empty, so its size stays bounded. A sequencer may take a younger job first
+    """
+
+    def __init__(self, path="./dtz_jobs", sequencer=None):
+        self.path = path
+        self.sequencer = sequencer
+        self._cond = threading.Condition()
+        self._pending = []  # queued jobs in order
+        self._active = {}  # job_id -> job which is currently processed
+        self._next_id = 1
+        self._listeners = []
+        self._job_listeners = []
+        self._finished = collections.OrderedDict()  # job_id -> the recently finished jobs, for get()
+        self.fence = None  # called before every write, raises if this instance must not write - see failover.py
+        self.compact_after = 0.0  # no compaction before - the previous active instance may still append
+
+    ############# JOURNAL #############
+    def load(self, replica=False, compact_after=0.0):
+        """
+        Restore the queued jobs after a restart or a takeover. Jobs which were in motion when the controller stopped
+        are not repeated - the part may already be taken - they are marked as interrupted. A replica (the standby,
+        see failover.py) only reads the journal, it belongs to the active instance. After a takeover the journal
+        is compacted at compact_after, not at once. Returns the interrupted and the queued jobs
+        """
+        jobs = {}
+        order = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as in_file:
+                for line in in_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # last line of a write which was interrupted
+                    self._next_id = max(self._next_id, record.get("id", 0) + 1)
+                    if record.get("op") == "submit":
+                        jobs[record["id"]] = Job(record["id"], record["shelf"], record["movement"],
+                                                 record["source"], record["created"])
+                        order.append(record["id"])
+                    elif record.get("op") == "status" and record["id"] in jobs:
+                        jobs[record["id"]].status = record["status"]
+        except IOError:
+            pass
+
+        interrupted = []
+        with self._cond:
+            self._pending = []
+            for job_id in order:
+                job = jobs[job_id]
+                if job.status == QUEUED:
+                    self._pending.append(job)
+                elif job.status not in FINISHED and not replica:
+                    logger.debug("jobs: %s was interrupted by a restart", job)
+                    job.status, job.message = INTERRUPTED, "interrupted in phase {}".format(job.status)
+                    self._finished[job.job_id] = job
+                    interrupted.append(job)
+            if not replica:
+                self.compact_after = compact_after
+                self._compact()
+        if not replica:
+            logger.debug("jobs: %s queued jobs restored", len(self._pending))
+            if time.time() < compact_after:
+                compact_timer = threading.Timer(compact_after - time.time(), self.compact)
+                compact_timer.daemon = True
+                compact_timer.start()
+        self._notify()
+        return interrupted + list(self._pending)
+
+    def _append(self, record):
+        if self.fence is not None:
+            self.fence()
+        with metrics.timer("dtz_file_write_seconds", file="jobs"):
+            with open(self.path, "a", encoding="utf-8") as out_file:
+                out_file.write(json.dumps(record) + "\n")
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+    def compact(self):
+        """
+        Rewrite the journal now - skipped while a job runs, then the queue compacts it when it runs empty
+        """
+        with self._cond:
+            if self._active:
+                return
+            try:
+                self._compact()
+            except (IOError, OSError) as e:
+                logger.debug("jobs: journal not compacted: %s", e)
+
+    def _compact(self):
+        # rewrite the journal with only the still queued jobs - atomic like the shelf storage
+        if time.time() < self.compact_after:
+            return  # the instance the lease was taken from may still append, see failover.py
+        if self.fence is not None:
+            self.fence()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as out_file:
+            out_file.write(json.dumps({"op": "next_id", "id": self._next_id - 1}) + "\n")
+            for job in self._pending:
+                record = job.to_dict()
+                record["op"] = "submit"
+                out_file.write(json.dumps(record) + "\n")
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    ############# QUEUE #############
+    def submit(self, shelf, movement="SO", source="fhs"):
+        with self._cond:
+            job = Job(self._next_id, shelf, movement, source)
+            self._next_id += 1
+            record = job.to_dict()
+            record["op"] = "submit"
+            self._append(record)
+            self._pending.append(job)
+            self._cond.notify_all()
+        logger.debug("jobs: %s submitted by %s", job, source)
+        self._notify(job)
+        return job
+
+    def next(self, timeout=None):
+        """
+        Take the oldest queued job - or the one the sequencer chooses - blocks up to timeout seconds. Returns None
+        if the queue stayed empty
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending, timeout):
+                return None
+            job = self._pending.pop(self.sequencer.choose(self._pending) if self.sequencer is not None else 0)
+            self._active[job.job_id] = job
+        return job
+
+    def set_status(self, job, status, message=""):
+        with self._cond:
+            job.status = status
+            job.message = message
+            self._append({"op": "status", "id": job.job_id, "status": status})
+            if status in FINISHED:
+                self._active.pop(job.job_id, None)
+                self._finished[job.job_id] = job
+                while len(self._finished) > 100:
+                    self._finished.popitem(last=False)
+                if not self._pending and not self._active:
+                    self._compact()
+            self._cond.notify_all()
+        logger.debug("jobs: %s %s", job, message)
+        self._notify(job)
+
+    def finish(self, job, status=DONE, message=""):
+        self.set_status(job, status, message)
+
+    def get(self, job_id):
+        """
+        The queued, running or recently finished job, None if it is unknown
+        """
+        with self._cond:
+            for job in self._pending:
+                if job.job_id == job_id:
+                    return job
+            return self._active.get(job_id) or self._finished.get(job_id)
+
+    def cancel(self, job_id, timeout=0.0):
+        """
+        A queued job is cancelled at once. The motion waits of a running one are aborted once timeout seconds
+        passed - they check every half second. Returns a message for the caller of the OPC UA method
+        """
+        job = self.get(job_id)
+        if job is None:
+            return "Error - unknown job {}".format(job_id)
+        with self._cond:
+            queued = job in self._pending
+            if not queued and job.job_id not in self._active:
+                return "Error - job {} is already {}".format(job_id, job.status)
+            job.cancellation.request(timeout)
+            if queued:
+                self._pending.remove(job)  # never taken by next() now
+        if queued:
+            self.set_status(job, CANCELLED, "cancelled before it started")
+            return "Cancelled"
+        logger.debug("jobs: %s cancel requested, deadline %.1f seconds", job, timeout)
+        return "Cancelling - stops within {:.1f} seconds".format(timeout)
+
+    def record_move(self, shelf, seconds):
+        """
+        Duration of a robot move for the cost model of the sequencer, shelf None if the move failed
+        """
+        if self.sequencer is not None:
+            self.sequencer.record(shelf, seconds)
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def jobs(self):
+        """
+        Running and queued jobs, oldest first
+        """
+        with self._cond:
+            return sorted(self._active.values(), key=lambda job: job.job_id) + list(self._pending)
+
+    def add_listener(self, listener):
+        """
+        listener(queue) is called after every change, e.g. to update the OPC UA variables
+        """
+        self._listeners.append(listener)
+
+    def add_job_listener(self, listener):
+        """
+        listener(job) is called after a job was submitted or changed its status, e.g. to fire the job events
+        """
+        self._job_listeners.append(listener)
+
+    def _notify(self, job=None):
+        calls = [(listener, self) for listener in self._listeners]
+        if job is not None:
+            calls += [(listener, job) for listener in self._job_listeners]
+        for listener, argument in calls:
+            try:
+                listener(argument)
+            except Exception as e:
+                logger.debug("jobs: listener Catched Exception: %s", e)
+
+
+class JobScheduler(object):
+    """
+    Runs the queued jobs back to back in its own thread. Every job is one cycle of the motion pipeline. The next
+    cycle is started as soon as the robot is done with the current one, when its phases really start is decided
+    by the overlap points of the cycle plan (see motion_pipeline.py)
+    """
+
+    errors = {"robot": "Error - Panda not moved", "storage": "Error - Storage not updated",
+              "belt": "Error - Belt not moved"}
+
+    def __init__(self, queue, state, sessions, storage, belt_distance=0.55, plan=None, tracker=None):
+        self.queue = queue
+        self.state = state
+        self.sessions = sessions
+        self.storage = storage
+        self.belt_distance = belt_distance
+        self.tracker = tracker or MotionTracker()  # deadlines of the moves, learned from the previous ones
+        self.plan = plan or CyclePlan()
+        self.actions = {"robot": self.robot_phase, "storage": self.storage_phase, "belt": self.belt_phase}
+        self.last_cycle = None
+        self._listeners = []
+
+    def start(self):
+        scheduler_thread = threading.Thread(name='job_scheduler_thread', target=self.run)
+        scheduler_thread.daemon = True
+        scheduler_thread.start()
+        return scheduler_thread
+
+    def breakers(self, *names):
+        return [self.sessions.get(name).breaker for name in names or ("panda", "pixtend")]
+
+    def run(self):
+        while True:
+            # jobs stay queued while the robot or the belt is unreachable instead of failing one after the other
+            if not all(breaker.allow() for breaker in self.breakers()):
+                time.sleep(0.5)
+                continue
+            prev = self.last_cycle
+            if prev is not None:
+                # there is only one robot - the next cycle can start once it is done with this one. The next job
+                # is taken afterwards, so the sequencer knows where the robot is and sees all queued jobs
+                prev.wait_event("robot", PHASE_FINISHED)
+            job = self.queue.next(timeout=0.5)
+            if job is None:
+                continue
+            if job.cancellation.requested:
+                self.queue.finish(job, CANCELLED, "cancelled before it started")
+                continue
+            self.last_cycle = CycleRun(self.plan, job, prev, self.state, self.actions).start(self.cycle_done)
+
+    def cycle_done(self, cycle):
+        if cycle.ok():
+            self.queue.finish(cycle.job, DONE)
+        elif cycle.job.cancellation.requested:
+            self.queue.finish(cycle.job, CANCELLED, "cancelled in phase {}".format(cycle.failed_phase()))
+        else:
+            self.queue.finish(cycle.job, FAILED, self.errors[cycle.failed_phase()])
+        logger.debug("cycle: %s", cycle.timing)
+        metrics.record_cycle(cycle.timing)
+        for listener in self._listeners:
+            try:
+                listener(cycle.timing)
+            except Exception as e:
+                logger.debug("scheduler: listener Catched Exception: %s", e)
+
+    def add_listener(self, listener):
+        """
+        listener(timing) is called with the CycleTiming after every cycle
+        """
+        self._listeners.append(listener)
+
+    ############# PHASES #############
+    def robot_phase(self, job):
+        self.queue.set_status(job, ROBOT, "move robot to shelf {}".format(job.shelf))
+        timeout = self.tracker.deadline(motion_tracker.ROBOT, motion_tracker.DURATION, motion_tracker.ANY)
+        if not wait_state(self.state, "RobotMoving", False, self.breakers("panda"), timeout=timeout,
+                          cancel=job.cancellation):  # robot is free
+            self.tracker.stalled(motion_tracker.ROBOT, motion_tracker.DURATION, motion_tracker.ANY, timeout)
+            return False
+        commanded = time.time()
+        moved = False
+        try:
+            moved = self.move_robot(job.movement, job.shelf, job.cancellation)
+        finally:
+            self.queue.record_move(job.shelf if moved else None, time.time() - commanded)
+        return moved
+
+    def storage_phase(self, job):
+        self.storage.set(job.shelf, False)
+        return True
+
+    def belt_phase(self, job):
+        self.queue.set_status(job, BELT, "move belt")
+        return self.move_belt("left", self.belt_distance, job.cancellation)
+
+    def move_robot(self, movement, shelf_nr, cancel=None):
+        key = self.tracker.robot_key(movement, shelf_nr)
+        if cancel is not None:
+            cancel.check()
+        since = self.state.sequence()
+        # self.sessions.node("panda", "PandaRobot").call_method("2:MoveRobotLibfranka", movement, str(shelf_nr))
+        self.sessions.get("panda").call("PandaRobot", "2:MoveRobotRos", movement, str(shelf_nr))
+        logger.debug("move robot to shelf %s", shelf_nr)
+        # no fixed sleep - a move which already started (and maybe finished) is detected by the sequence number
+        return self.track_move(motion_tracker.ROBOT, key, "RobotMoving", "panda", since, cancel)
+
+    def move_belt(self, movement, distance, cancel=None):
+        key = self.tracker.belt_key(distance)
+        if cancel is not None:
+            cancel.check()
+        since = self.state.sequence()
+        self.sessions.get("pixtend").call("ConveyorBelt", "2:MoveBelt", movement, distance)
+        return self.track_move(motion_tracker.BELT, key, "ConBeltMoving", "pixtend", since, cancel)
+
+    def track_move(self, device, key, moving, session, since, cancel=None):
+        """
+        Wait for the start and the end of a move which was commanded after the state sequence since - both within
+        the deadline of the motion tracker. False if the device stalled, raises Cancelled if the job was cancelled
+        """
+        commanded = time.time()
+        timeout = self.tracker.deadline(device, motion_tracker.START, key)
+        if not wait_state(self.state, moving, True, self.breakers(session), timeout=timeout, since=since,
+                          cancel=cancel):
+            # device does not react
+            self.tracker.stalled(device, motion_tracker.START, key, timeout)
+            return False
+        started = time.time()
+        self.tracker.record(device, motion_tracker.START, key, started - commanded)
+
+        timeout = self.tracker.deadline(device, motion_tracker.DURATION, key)
+        if not wait_state(self.state, moving, False, self.breakers(session), timeout=timeout, cancel=cancel):
+            self.tracker.stalled(device, motion_tracker.DURATION, key, timeout)
+            return False
+        self.tracker.record(device, motion_tracker.DURATION, key, time.time() - started)
+        logger.debug("%s move finished", device)
+        return True
@@ -0,0 +1,180 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Log pipeline of the DTZ Master Controller
+#   The control threads and the event loop only put the record into a bounded queue - formatting and writing to
+#   stderr happen in the listener thread. A full queue drops the record instead of blocking the caller.
+#   Records carry the job, the shelf and the phase of the cycle they belong to (log_context), as JSON lines with
+#   log_format "json" or appended to the text line. Messages which repeat while an endpoint is down - the exceptions
+#   of the connection and server loops - are logged with extra={"throttle": True} and rate limited per call site:
+#   burst messages per interval, then one summary of the suppressed ones. Connection state changes are never limited.
+#   The level can be changed at runtime with the method SetLogLevel of the master server or a config reload.
+
+from metrics import metrics
+import logging.handlers
+import contextlib
+import contextvars
+import threading
+import logging
+import queue
+import json
+import time
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+CONTEXT_FIELDS = ("job", "shelf", "phase")
+TEXT_FORMAT = '%(asctime)s - %(name)s [%(filename)s:%(lineno)d] - %(levelname)s - %(message)s%(context)s'
+
+_context = contextvars.ContextVar("dtz_log_context", default={})
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Add fields (job, shelf, phase) to all records of the current thread or task
+    """
+    token = _context.set(dict(_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the log context onto the record - runs in the calling thread, the listener has no context
+    """
+
+    def filter(self, record):
+        fields = _context.get()
+        for name in CONTEXT_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, fields.get(name))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most burst records per call site and interval for the records logged with extra={"throttle": True}. The
+    first record after the interval tells how many were suppressed
+    """
+
+    def __init__(self, interval=60.0, burst=3):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._sites = {}  # (pathname, lineno) -> [start of the interval, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno > logging.WARNING or not getattr(record, "throttle", False):
+            return True
+        now = time.time()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno))
+            if site is None or now - site[0] >= self.interval:
+                suppressed = site[2] if site is not None else 0
+                self._sites[(record.pathname, record.lineno)] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            site[1] += 1
+            if site[1] <= self.burst:
+                return True
+            site[2] += 1
+        metrics.inc("dtz_log_records_total", result="suppressed")
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line
+    """
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "where": "{}:{}".format(record.filename, record.lineno), "thread": record.threadName,
+                 "message": record.getMessage()}
+        for name in CONTEXT_FIELDS + ("suppressed",):
+            if getattr(record, name, None) is not None:
+                entry[name] = getattr(record, name)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The format of the controller so far, with the context appended
+    """
+
+    def __init__(self):
+        logging.Formatter.__init__(self, TEXT_FORMAT)
+
+    def format(self, record):
+        context = ["{}={}".format(name, getattr(record, name)) for name in CONTEXT_FIELDS + ("suppressed",)
+                   if getattr(record, name, None) is not None]
+        record.context = " [{}]".format(" ".join(context)) if context else ""
+        return logging.Formatter.format(self, record)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks - a record which does not fit into the queue is dropped and counted
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            metrics.inc("dtz_log_records_total", result="queued")
+        except queue.Full:
+            metrics.inc("dtz_log_records_total", result="dropped")
+
+    def prepare(self, record):
+        # only the message is merged here, so later changes of the arguments do not show up - the formatter
+        # runs in the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogPipeline(object):
+    """
+    Queue handler on the controller logger, the listener thread writes to stderr
+    """
+
+    def __init__(self, logger, level="DEBUG", log_format="text", queue_size=10000, interval=60.0, burst=3):
+        self.logger = logger
+        self.log_format = None
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(ContextFilter())
+        self.handler.addFilter(RateLimitFilter(interval, burst))
+        self.stream_handler = logging.StreamHandler()
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.stream_handler)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(self.handler)
+        logger.propagate = False
+        self.configure(level, log_format)
+
+    def configure(self, level, log_format):
+        self.set_level(level)
+        if log_format != self.log_format:
+            self.stream_handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+            self.log_format = log_format
+
+    def set_level(self, level):
+        """
+        Returns a message for the caller of the OPC UA method
+        """
+        level = str(level).upper()
+        if level not in LEVELS:
+            return "Error - unknown level {}, one of {}".format(level, ", ".join(LEVELS))
+        self.logger.setLevel(level)
+        return "Log level {}".format(level)
+
+    def start(self):
+        self.listener.start()
+        return self
+
+    def stop(self):
+        # writes the records still in the queue
+        self.listener.stop()
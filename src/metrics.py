@@ -0,0 +1,218 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Metrics of the DTZ Master Controller
+#   Latency histograms and counters of the hot path: connect/browse/read/call round trips per upstream server, the
+#   phase durations of every cycle, the reconnects of the connection loops, the time from a shelf request to the end
+#   of its cycle and the write-back of the storage and job files.
+#   Exposed in the Prometheus text format on http://<host>:9102/metrics and mirrored into the OPC UA variables
+#   DTZMasterController/Diagnostics/<metric> (JSON summary per label set).
+
+import threading
+import logging
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help)
+FAMILIES = {
+    "dtz_opcua_latency_seconds": ("histogram", "Round trip of OPC UA requests to the upstream servers"),
+    "dtz_phase_duration_seconds": ("histogram", "Duration of the phases of a pick-and-place cycle"),
+    "dtz_cycle_duration_seconds": ("histogram", "Duration of a complete pick-and-place cycle"),
+    "dtz_job_latency_seconds": ("histogram", "Time from the shelf request to the end of its cycle"),
+    "dtz_file_write_seconds": ("histogram", "Atomic write-back of the storage and the job journal"),
+    "dtz_reconnects_total": ("counter", "Reconnect attempts of the upstream connection loops"),
+    "dtz_dispatch_events_total": ("counter", "Events of the subscription callbacks - queued, coalesced, "
+                                            "dropped or rejected"),
+    "dtz_dispatch_wait_seconds": ("histogram", "Time a callback event waited for a worker"),
+    "dtz_node_cache_total": ("counter", "Node cache lookups on connect - hit or miss"),
+    "dtz_output_writes_total": ("counter", "Writes of the edge-triggered outputs and published variables - "
+                                           "written, skipped or held"),
+    "dtz_motion_seconds": ("histogram", "Start latency and duration of the robot and belt moves"),
+    "dtz_motion_stalls_total": ("counter", "Moves which missed their learned deadline"),
+    "dtz_log_records_total": ("counter", "Log records - queued, dropped on a full queue or suppressed as repeated"),
+    "dtz_pick_sequence_total": ("counter", "Jobs taken by the pick sequencer - in FIFO order or reordered"),
+}
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed buckets, like the Prometheus client
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket containing the quantile q - good enough to spot a slow path
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def summary(self):
+        if self.count == 0:
+            return {"count": 0}
+        return {"count": self.count, "sum": round(self.sum, 4), "mean": round(self.sum / self.count, 4),
+                "p50": round(self.quantile(0.5), 4), "p95": round(self.quantile(0.95), 4), "max": round(self.max, 4)}
+
+
+class Timer(object):
+    """
+    with metrics.timer("dtz_opcua_latency_seconds", server="panda", op="call"): ...
+    Records also if the block raised - a timeout is the interesting case
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Metrics(object):
+    """
+    Registry of all metric series. Recording is a dict lookup and a few additions under one lock,
+    cheap enough for the subscription threads
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # name -> {label key: Histogram or counter value}
+
+    def observe(self, name, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def record_cycle(self, timing, **labels):
+        """
+        Phase durations, cycle duration and request-to-completion latency of a finished CycleTiming
+        """
+        for phase, (started, finished) in timing.phases.items():
+            if finished is not None:
+                self.observe("dtz_phase_duration_seconds", finished - started, phase=phase, **labels)
+        self.observe("dtz_cycle_duration_seconds", timing.duration(), ok=timing.ok, **labels)
+        self.observe("dtz_job_latency_seconds", (timing.end or time.time()) - timing.job.created,
+                     source=timing.job.source, **labels)
+
+    ############# EXPORT #############
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._series):
+                kind, description = FAMILIES.get(name, ("untyped", name))
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, kind))
+                for key, value in sorted(self._series[name].items()):
+                    if isinstance(value, Histogram):
+                        cumulative = 0
+                        for bound, count in zip(list(value.buckets) + ["+Inf"], value.counts):
+                            cumulative += count
+                            lines.append("{}_bucket{} {}".format(name, _format_labels(key, [("le", bound)]),
+                                                                 cumulative))
+                        lines.append("{}_sum{} {}".format(name, _format_labels(key), value.sum))
+                        lines.append("{}_count{} {}".format(name, _format_labels(key), value.count))
+                    else:
+                        lines.append("{}{} {}".format(name, _format_labels(key), value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        """
+        {"server=panda,op=call": {"count": .., "mean": .., "p95": ..}, ...} of one metric, for the OPC UA variables
+        """
+        with self._lock:
+            result = {}
+            for key, value in self._series.get(name, {}).items():
+                label = ",".join("{}={}".format(k, v) for k, v in key)
+                result[label] = value.summary() if isinstance(value, Histogram) else value
+            return result
+
+    def start_http_server(self, port=9102):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+        httpd.daemon_threads = True
+        metrics_thread = threading.Thread(name='metrics_http_thread', target=httpd.serve_forever)
+        metrics_thread.daemon = True
+        metrics_thread.start()
+        logger.debug("metrics: endpoint started at http://0.0.0.0:%s/metrics", port)
+        return httpd
+
+
+# one registry for the whole controller
+metrics = Metrics()
@@ -0,0 +1,311 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Motion pipeline of the DTZ Master Controller
+#   One pick-and-place cycle is modelled as a small dependency graph of phases (robot, storage, belt). Every phase
+#   starts as soon as its dependencies are met, which can be phases of the same cycle, phases of the previous cycle
+#   or a device state. The overlap points are configurable: cycle_plan "overlapped" (default) or "sequential" (no
+#   overlap, the original behaviour), single phases replaced with cycle_<phase>_after, e.g.
+#       DTZ_CYCLE_BELT_AFTER="RobotState=released,prev.belt.finished"    start the belt once the robot released
+#       DTZ_CYCLE_ROBOT_AFTER="prev.robot.finished,prev.belt.started"     pick the next part while the belt drives
+#   Every cycle reports the start and end time of its phases.
+
+from log_pipeline import log_context
+import threading
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+STARTED = "started"
+FINISHED = "finished"
+
+
+def parse_value(text):
+    """
+    Value of a state condition - "True"/"False", numbers or plain strings
+    """
+    if text in ("True", "true"):
+        return True
+    if text in ("False", "false"):
+        return False
+    for convert in (int, float):
+        try:
+            return convert(text)
+        except ValueError:
+            pass
+    return text
+
+
+def parse_dependency(text):
+    """
+    "robot.finished"       -> ("cycle", "robot", "finished")
+    "prev.belt.started"    -> ("prev", "belt", "started")
+    "RobotState=released"  -> ("state", "RobotState", "released")
+    """
+    if "=" in text:
+        key, value = text.split("=", 1)
+        return ("state", key.strip(), parse_value(value.strip()))
+    parts = text.split(".")
+    if len(parts) == 3 and parts[0] == "prev" and parts[2] in (STARTED, FINISHED):
+        return ("prev", parts[1], parts[2])
+    if len(parts) == 2 and parts[1] in (STARTED, FINISHED):
+        return ("cycle", parts[0], parts[1])
+    raise ValueError("unknown phase dependency: {}".format(text))
+
+
+# dependencies of the phases of the two plans of the cycle_plan setting
+PLANS = {
+    # pick the next part while the belt drives, start the belt once the robot is done and the belt is free
+    "overlapped": {"robot": ("prev.robot.finished", "prev.belt.started"), "storage": ("robot.finished",),
+                   "belt": ("robot.finished", "prev.belt.finished")},
+    # the original behaviour - every phase waits for the previous one, no overlap between cycles
+    "sequential": {"robot": ("prev.belt.finished",), "storage": ("robot.finished",), "belt": ("robot.finished",)},
+}
+
+
+class CyclePlan(object):
+    """
+    Phases of one cycle in start order and their dependencies
+    """
+
+    def __init__(self, robot_after=PLANS["overlapped"]["robot"], storage_after=PLANS["overlapped"]["storage"],
+                 belt_after=PLANS["overlapped"]["belt"]):
+        self.phases = ["robot", "storage", "belt"]
+        self.texts = {"robot": list(robot_after), "storage": list(storage_after), "belt": list(belt_after)}
+        self.dependencies = {
+            "robot": [parse_dependency(dep) for dep in robot_after],
+            "storage": [parse_dependency(dep) for dep in storage_after],
+            "belt": [parse_dependency(dep) for dep in belt_after],
+        }
+        for phase, deps in self.dependencies.items():
+            for kind, name, event in deps:
+                if kind != "state" and name not in self.phases:
+                    raise ValueError("phase {} depends on unknown phase {}".format(phase, name))
+
+    @classmethod
+    def sequential(cls):
+        """
+        The original behaviour - every phase waits for the previous one, no overlap between cycles
+        """
+        return cls(PLANS["sequential"]["robot"], PLANS["sequential"]["storage"], PLANS["sequential"]["belt"])
+
+    @classmethod
+    def from_config(cls, config):
+        return cls.from_settings(config.cycle_plan, config.cycle_robot_after, config.cycle_storage_after,
+                                 config.cycle_belt_after)
+
+    @classmethod
+    def from_settings(cls, plan, robot_after=None, storage_after=None, belt_after=None):
+        """
+        One of PLANS, single phases replaced by comma separated dependencies. Raises ValueError for an unknown
+        dependency
+        """
+        dependencies = dict(PLANS[plan])
+        for phase, text in (("robot", robot_after), ("storage", storage_after), ("belt", belt_after)):
+            if text is not None:
+                dependencies[phase] = [dep.strip() for dep in text.split(",") if dep.strip()]
+        return cls(dependencies["robot"], dependencies["storage"], dependencies["belt"])
+
+    def __str__(self):
+        return " ".join("{}_after={}".format(phase, ",".join(self.texts[phase])) for phase in self.phases)
+
+
+class CycleTiming(object):
+    """
+    Start and end of every phase, relative to the start of the cycle
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.start = time.time()
+        self.end = None
+        self.phases = {}
+        self.ok = None
+
+    def phase_started(self, phase):
+        self.phases[phase] = [time.time() - self.start, None]
+
+    def phase_finished(self, phase):
+        if phase in self.phases:
+            self.phases[phase][1] = time.time() - self.start
+
+    def finished(self, ok):
+        self.end = time.time()
+        self.ok = ok
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {"job": self.job.job_id, "shelf": self.job.shelf, "ok": self.ok,
+                "total": round(self.duration(), 3),
+                "phases": dict((phase, [round(t, 3) if t is not None else None for t in times])
+                               for phase, times in self.phases.items())}
+
+    def __str__(self):
+        phases = " ".join("{} {:.2f}-{:.2f}s".format(phase, times[0], times[1] or 0)
+                          for phase, times in sorted(self.phases.items(), key=lambda item: item[1][0]))
+        return "job {} shelf {} total {:.2f}s {}".format(self.job.job_id, self.job.shelf, self.duration(), phases)
+
+
+class _CycleBase(object):
+
+    def __init__(self, plan, job, prev, state, actions):
+        self.plan = plan
+        self.job = job
+        self.prev = prev  # the cycle before, or None
+        self.state = state
+        self.actions = actions  # phase -> function(job) returning True if the phase succeeded
+        self.since = state.sequence()
+        self.results = {}
+        self.timing = CycleTiming(job)
+
+    def earlier_failed(self, phase):
+        for earlier in self.plan.phases[:self.plan.phases.index(phase)]:
+            if self.results.get(earlier) is False:
+                return True
+        return False
+
+    def skipped(self, phase):
+        # a phase is skipped if a phase of the same cycle it depends on failed. A phase waiting for a device state
+        # is also skipped if any earlier phase failed - the state would never be reached
+        for kind, name, event in self.plan.dependencies[phase]:
+            if kind == "cycle" and self.results.get(name) is not True:
+                return True
+            if kind == "state" and self.earlier_failed(phase):
+                return True
+        return False
+
+    def ok(self):
+        return all(self.results.get(phase) is True for phase in self.plan.phases)
+
+    def failed_phase(self):
+        for phase in self.plan.phases:
+            if self.results.get(phase) is not True:
+                return phase
+        return None
+
+
+class CycleRun(_CycleBase):
+    """
+    One cycle, every phase in its own thread
+    """
+
+    def __init__(self, plan, job, prev, state, actions):
+        _CycleBase.__init__(self, plan, job, prev, state, actions)
+        self.events = dict(((phase, event), threading.Event())
+                           for phase in plan.phases for event in (STARTED, FINISHED))
+        self.done = threading.Event()
+
+    def wait_event(self, phase, event, timeout=None):
+        return self.events[(phase, event)].wait(timeout)
+
+    def _wait_dependency(self, phase, kind, name, event):
+        if kind == "cycle":
+            self.wait_event(name, event)
+        elif kind == "prev":
+            if self.prev is not None:
+                self.prev.wait_event(name, event)
+        else:
+            while not self.state.wait_for(name, event, timeout=0.5, since=self.since):
+                if self.earlier_failed(phase):
+                    return
+
+    def _run_phase(self, phase):
+        for dependency in self.plan.dependencies[phase]:
+            self._wait_dependency(phase, *dependency)
+        result = None
+        self.timing.phase_started(phase)
+        self.events[(phase, STARTED)].set()
+        try:
+            if not self.skipped(phase):
+                with log_context(job=self.job.job_id, shelf=self.job.shelf, phase=phase):
+                    result = self.actions[phase](self.job)
+        except Exception as e:
+            logger.debug("pipeline: phase %s Catched Exception: %s", phase, e)
+            result = False
+        finally:
+            self.results[phase] = result
+            self.timing.phase_finished(phase)
+            self.events[(phase, FINISHED)].set()
+
+    def start(self, on_done=None):
+        threads = []
+        for phase in self.plan.phases:
+            phase_thread = threading.Thread(name='{}_phase_thread'.format(phase), target=self._run_phase,
+                                            args=(phase,))
+            phase_thread.daemon = True
+            phase_thread.start()
+            threads.append(phase_thread)
+
+        def finish():
+            for phase_thread in threads:
+                phase_thread.join()
+            self.timing.finished(self.ok())
+            self.prev = None  # do not keep the whole chain of cycles alive
+            self.done.set()
+            if on_done is not None:
+                on_done(self)
+
+        finish_thread = threading.Thread(name='cycle_thread', target=finish)
+        finish_thread.daemon = True
+        finish_thread.start()
+        return self
+
+
+class AsyncCycleRun(_CycleBase):
+    """
+    One cycle for the asyncio engine, every phase a task. The actions are coroutine functions and
+    state has to be an AsyncStateCache
+    """
+
+    def __init__(self, plan, job, prev, state, actions):
+        _CycleBase.__init__(self, plan, job, prev, state, actions)
+        self.events = dict(((phase, event), asyncio.Event())
+                           for phase in plan.phases for event in (STARTED, FINISHED))
+        self.done = asyncio.Event()
+
+    async def wait_event(self, phase, event):
+        await self.events[(phase, event)].wait()
+
+    async def _wait_dependency(self, phase, kind, name, event):
+        if kind == "cycle":
+            await self.wait_event(name, event)
+        elif kind == "prev":
+            if self.prev is not None:
+                await self.prev.wait_event(name, event)
+        else:
+            while not await self.state.wait_for_async(name, event, timeout=0.5, since=self.since):
+                if self.earlier_failed(phase):
+                    return
+
+    async def _run_phase(self, phase):
+        for dependency in self.plan.dependencies[phase]:
+            await self._wait_dependency(phase, *dependency)
+        result = None
+        self.timing.phase_started(phase)
+        self.events[(phase, STARTED)].set()
+        try:
+            if not self.skipped(phase):
+                with log_context(job=self.job.job_id, shelf=self.job.shelf, phase=phase):
+                    result = await self.actions[phase](self.job)
+        except Exception as e:
+            logger.debug("pipeline: phase %s Catched Exception: %s", phase, e)
+            result = False
+        finally:
+            self.results[phase] = result
+            self.timing.phase_finished(phase)
+            self.events[(phase, FINISHED)].set()
+
+    def start(self, on_done=None):
+        async def finish():
+            await asyncio.gather(*[self._run_phase(phase) for phase in self.plan.phases])
+            self.timing.finished(self.ok())
+            self.prev = None
+            self.done.set()
+            if on_done is not None:
+                await on_done(self)
+
+        asyncio.ensure_future(finish())
+        return self
@@ -0,0 +1,120 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Motion tracker of the DTZ Master Controller
+#   Records how long the robot and the belt take to react to a command (start latency) and to finish the move
+#   (duration) - per shelf and movement of the robot, per distance of the belt. The deadlines of the next moves are
+#   derived from the recent ones: quantile * factor + margin. Until enough moves were seen the priors are used: the
+#   configured start timeouts, the configured robot_move_timeout and distance / belt_velocity for the belt - the
+#   configured belt_distance for the moves of all distances (ANY).
+#   A move which misses its deadline is reported as stall and its phase fails, instead of waiting forever.
+#   Stalls and learned deadlines are published as JSON in the variable Jobs/Motion.
+
+from metrics import metrics
+import collections
+import threading
+import logging
+
+logger = logging.getLogger('dtz_master_controller')
+
+ROBOT = "robot"
+BELT = "belt"
+START = "start"  # command -> device reports moving
+DURATION = "duration"  # device reports moving -> device reports not moving
+ANY = "*"  # all keys of a device
+
+
+def quantile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class MotionTracker(object):
+    """
+    Start latencies and durations of the recent moves and the deadlines derived from them. Thread safe
+    """
+
+    def __init__(self, robot_start_timeout=9.0, belt_start_timeout=3.0, robot_move_timeout=60.0,
+                 belt_velocity=0.05428, window=50, min_samples=5, q=0.95, factor=1.5, margin=1.0, belt_distance=0.55):
+        self.robot_start_timeout = robot_start_timeout
+        self.belt_start_timeout = belt_start_timeout
+        self.robot_move_timeout = robot_move_timeout
+        self.belt_velocity = belt_velocity
+        self.belt_distance = belt_distance
+        self.window = window
+        self.min_samples = min_samples
+        self.q = q
+        self.factor = factor
+        self.margin = margin
+        self.stalls = 0
+        self._lock = threading.Lock()
+        self._samples = {}  # (device, stage, key) -> deque of seconds
+
+    @staticmethod
+    def robot_key(movement, shelf):
+        return "{}/{}".format(movement, shelf)
+
+    @staticmethod
+    def belt_key(distance):
+        return "{:.3f}".format(distance)
+
+    def configure(self, config):
+        """
+        Priors from the configuration - called again after a reload
+        """
+        self.robot_start_timeout = config.robot_start_timeout
+        self.belt_start_timeout = config.belt_start_timeout
+        self.robot_move_timeout = config.robot_move_timeout
+        self.belt_velocity = config.belt_velocity
+        self.belt_distance = config.belt_distance
+        return self
+
+    def expected_belt_time(self, distance):
+        return abs(distance) / self.belt_velocity
+
+    def prior(self, device, stage, key):
+        if stage == START:
+            return self.robot_start_timeout if device == ROBOT else self.belt_start_timeout
+        if device == BELT:
+            distance = self.belt_distance if key == ANY else float(key)
+            return self.expected_belt_time(distance) * self.factor + self.margin
+        return self.robot_move_timeout
+
+    def deadline(self, device, stage, key):
+        """
+        Seconds to wait for the device - learned from the moves with the same key, or of all keys of the device
+        (not for belt moves, their duration depends on the distance), or the prior
+        """
+        with self._lock:
+            samples = list(self._samples.get((device, stage, key), ()))
+            if len(samples) < self.min_samples and not (device == BELT and stage == DURATION):
+                samples = list(self._samples.get((device, stage, ANY), ()))
+        prior = self.prior(device, stage, key)
+        if len(samples) < self.min_samples:
+            return prior
+        learned = quantile(samples, self.q) * self.factor + self.margin
+        # a start never waits longer than configured, a move may take longer than the prior if it always does
+        return min(learned, prior) if stage == START else learned
+
+    def record(self, device, stage, key, seconds):
+        with self._lock:
+            for sample_key in (key, ANY):
+                samples = self._samples.get((device, stage, sample_key))
+                if samples is None:
+                    samples = self._samples[(device, stage, sample_key)] = collections.deque(maxlen=self.window)
+                samples.append(seconds)
+        metrics.observe("dtz_motion_seconds", seconds, device=device, stage=stage)
+
+    def stalled(self, device, stage, key, waited):
+        self.stalls += 1
+        metrics.inc("dtz_motion_stalls_total", device=device, stage=stage)
+        logger.debug("motion: %s %s %s stalled - nothing reported after %.1f seconds", device, key, stage, waited)
+
+    def status(self):
+        """
+        {"stalls": n, "deadlines": {"robot/duration/SO/3": {"samples": n, "deadline": seconds}, ...}}
+        """
+        with self._lock:
+            keys = [(key, len(samples)) for key, samples in self._samples.items()]
+        return {"stalls": self.stalls,
+                "deadlines": dict(("/".join(key), {"samples": count, "deadline": round(self.deadline(*key), 2)})
+                                  for key, count in sorted(keys))}
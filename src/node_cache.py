@@ -0,0 +1,95 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Node cache of the DTZ Master Controller
+#   The browse paths of a server (["0:Objects", "2:PandaRobot", "2:RobotMoving"], ...) are resolved in one batched
+#   TranslateBrowsePathsToNodeIds request, the NodeIds are kept across reconnects. On a reconnect only the namespace
+#   array of the server is read: if it is unchanged the cached NodeIds are used, no browsing at all. An entry is
+#   dropped when the namespace array changed or a request failed with BadNodeIdUnknown.
+#   Used by both engines - the helpers take the ua module of the OPC UA library (opcua or asyncua).
+
+from metrics import metrics
+import threading
+import logging
+
+logger = logging.getLogger('dtz_master_controller')
+
+
+class NodeCache(object):
+    """
+    url -> namespace array of the server and {browse path: NodeId string}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def lookup(self, url, namespaces, paths):
+        """
+        {path: NodeId string} of all paths, or None if one is missing or the namespace array changed
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or entry["namespaces"] != list(namespaces):
+                if entry is not None:
+                    logger.debug("nodecache: namespace array of %s changed", url)
+                    del self._entries[url]
+                metrics.inc("dtz_node_cache_total", result="miss")
+                return None
+            nodes = entry["nodes"]
+            if not all(tuple(path) in nodes for path in paths):
+                metrics.inc("dtz_node_cache_total", result="miss")
+                return None
+            metrics.inc("dtz_node_cache_total", result="hit")
+            return dict((tuple(path), nodes[tuple(path)]) for path in paths)
+
+    def store(self, url, namespaces, resolved):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None or entry["namespaces"] != list(namespaces):
+                entry = self._entries[url] = {"namespaces": list(namespaces), "nodes": {}}
+            entry["nodes"].update(resolved)
+
+    def invalidate(self, url, reason=""):
+        with self._lock:
+            if self._entries.pop(url, None) is not None:
+                logger.debug("nodecache: %s invalidated %s", url, reason)
+
+
+def browse_request(ua, paths):
+    """
+    One BrowsePath per path, starting at the root node like get_root_node().get_child(path)
+    """
+    requests = []
+    for path in paths:
+        relative_path = ua.RelativePath()
+        for item in path:
+            element = ua.RelativePathElement()
+            element.ReferenceTypeId = ua.TwoByteNodeId(ua.ObjectIds.HierarchicalReferences)
+            element.IsInverse = False
+            element.IncludeSubtypes = True
+            element.TargetName = ua.QualifiedName.from_string(item)
+            relative_path.Elements.append(element)
+        browse_path = ua.BrowsePath()
+        browse_path.StartingNode = ua.TwoByteNodeId(ua.ObjectIds.RootFolder)
+        browse_path.RelativePath = relative_path
+        requests.append(browse_path)
+    return requests
+
+
+def browse_results(ua, paths, results):
+    """
+    {path: NodeId string} of a TranslateBrowsePathsToNodeIds response. Raises the status of the first path
+    which could not be resolved - BadNoMatch for a good status without targets
+    """
+    resolved = {}
+    for path, result in zip(paths, results):
+        if not result.StatusCode.is_good() or not result.Targets:
+            logger.debug("nodecache: could not resolve %s: %s", path, result.StatusCode)
+            result.StatusCode.check()
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadNoMatch)
+        resolved[tuple(path)] = result.Targets[0].TargetId.to_string()
+    return resolved
+
+
+# one cache for the whole controller
+node_cache = NodeCache()
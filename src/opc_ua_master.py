@@ -12,61 +12,96 @@
 #   their (state) variables
 
 
+from opcua import ua, uamethod, Server
+from session_pool import SessionPool, EdgeOutput
+from state_cache import StateCache, subscribe_state
+from shelf_storage import ShelfStorage
+from job_queue import JobQueue, JobScheduler, FINISHED, JOB_EVENT_PROPERTIES, invalid_request
+from motion_pipeline import CyclePlan
+from pick_sequencer import PickSequencer
+from metrics import metrics, FAMILIES
+from cells import load_registry
+from supervisor import EndpointSupervisor, CONNECTION_VARIABLES
+from dispatch import EventDispatcher
+from config import Config, ConfigError, FHS_REQUEST_KEYS
+from motion_tracker import MotionTracker
+from log_pipeline import LogPipeline
+from publisher import Publisher, STATUS, initial_status
 from datetime import datetime
-from opcua import Client, ua, uamethod, Server
+import collections
 import threading
-import requests
-import pytz
+import signal
+import atexit
 import time
 import sys
+import os
 import logging
-import traceback
+import json
 
-# create logger
+# create logger - the log pipeline is started in main, see log_pipeline.py. The optional subsystems (historian,
+# failover, traffic capture, security, diagnostics, telemetry) are imported where they are enabled
 logger = logging.getLogger('dtz_master_controller')
-logger.setLevel(logging.DEBUG)
-
-# create console handler and set level to debug
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-
-# create formatter
-formatter = logging.Formatter('%(asctime)s - %(name)s [%(filename)s:%(lineno)d] - %(levelname)s - %(message)s')
-
-# add formatter to ch
-ch.setFormatter(formatter)
-
-# add ch to logger
-logger.addHandler(ch)
-
-# 'application' code
-logger.debug('debug message')
-logger.info('info message')
-logger.warn('warn message')
-logger.error('error message')
-logger.critical('critical message')
+log_pipeline = None  # records go through a queue, the listener thread formats and writes them - created in main
 
 sys.path.insert(0, "..")
 
 ################# GLOBAL VARIABLES #################
 
-global_url_opcua_adapter = "192.168.48.81:1337"
-global_url_panda_server = "opc.tcp://192.168.48.41:4840/freeopcua/server/"
-global_url_pixtend_server = "opc.tcp://192.168.48.42:4840/freeopcua/server/"
-global_url_fhs_server = "opc.tcp://192.168.10.102:4840"
-global_url_pseudo_fhs_server = "opc.tcp://192.168.48.44:4840/freeopcua/server/"
-
-desired_distance = 0.55  # distance in meters to drive the belt
-belt_velocity = 0.05428  # velocity of the belt in m/s (5.5cm/s)
-storage = []  # our storage data as an array
+# the defaults of config.py - main loads file and environment and sets these with apply_config()
+config = Config(environ={})
+global_url_opcua_adapter = config.adapter_url
+global_url_panda_server = config.panda_url
+global_url_pixtend_server = config.pixtend_url
+global_url_fhs_server = config.fhs_endpoint
+fhs_node_ids = config.fhs_node_ids
+metrics_port = config.metrics_port  # prometheus endpoint http://<host>:9102/metrics
+history_path = config.history_path  # historian segments - device state, shelves and cycle timings for HistoryRead
+history_retention = config.history_retention
+history_max_bytes = config.history_max_bytes
+
+desired_distance = config.belt_distance  # distance in meters to drive the belt
+belt_velocity = config.belt_velocity  # velocity of the belt in m/s (5.5cm/s)
+shelf_storage = ShelfStorage("./dtz_storage")  # our storage data - 3x3 shelf occupancy, loaded once in main
+job_queue = JobQueue("./dtz_jobs")  # shelf requests of the FHS server and the MoveDemonstrator method
 global_new_val_available = None
 global_demonstrator_busy = None
+demonstrator_busy_output = None  # DemonstratorBusy, only written on a change
+busy_light_output = None  # SwitchBusyLight of the PiXtend, only called on a change
 global_belt_moving = None
 global_panda_moving = None
 global_object_panda = None
 global_object_pixtend = None
 global_desired_shelf = None
 subhandler_already_created = False
+fh_subscription = None  # datachange subscription of NewValAvailable
+event_dispatcher = EventDispatcher(workers=2, capacity=100)  # does the work of the subscription handler
+session_pool = None  # one long-lived session per upstream server - created in main
+state_cache = StateCache()  # device values fed by datachange subscriptions
+publisher = Publisher()  # writes the variables of the master server only on real changes
+standby = None  # active-standby mode with the ha_lease of the configuration - see failover.py, created in main
+replica = None  # storage and jobs of the active instance, followed by the standby
+credentials = None  # Basic256Sha256 of the master server and the sessions - see security.py, created in main
+panda_state_keys = ["RobotMoving", "RobotState"]
+pixtend_state_keys = ["ConBeltMoving", "ConBeltState", "ConBeltDist"]
+state_initial_values = {"RobotMoving": False, "RobotState": "", "ConBeltMoving": False, "ConBeltState": "",
+                        "ConBeltDist": 0.0}  # State/<key> on the master server, typed like the device variables
+
+# node handles which are resolved once per connect by the session pool
+panda_browse_paths = {
+    "PandaRobot": ["0:Objects", "2:PandaRobot"],
+    "MoveRobotRos": ["0:Objects", "2:PandaRobot", "2:MoveRobotRos"],
+    "MoveRobotLibfranka": ["0:Objects", "2:PandaRobot", "2:MoveRobotLibfranka"],
+    "RobotState": ["0:Objects", "2:PandaRobot", "2:RobotState"],
+    "RobotMoving": ["0:Objects", "2:PandaRobot", "2:RobotMoving"],
+}
+pixtend_browse_paths = {
+    "ConveyorBelt": ["0:Objects", "2:ConveyorBelt"],
+    "ConBeltState": ["0:Objects", "2:ConveyorBelt", "2:ConBeltState"],
+    "ConBeltDist": ["0:Objects", "2:ConveyorBelt", "2:ConBeltDist"],
+    "SwitchBusyLight": ["0:Objects", "2:ConveyorBelt", "2:SwitchBusyLight"],
+    "ConBeltMoving": ["0:Objects", "2:ConveyorBelt", "2:ConBeltMoving"],
+}
+# the NodeIds of the FHS server come from the fhs_profile of the configuration - "pseudo" for the pseudo FHS server
 
 
 ################ DATACHANGE HANDLER ################
@@ -85,462 +120,359 @@ class SubHandler(object):
         self.belt_is_moving = belt_moving
         self.panda_obj = panda_object
         self.belt_obj = pixtend_object
-        self.storage = []
-        self.handler_panda_moving = None
-        self.handler_belt_moving = None
-        self.handler_demonstrator_busy = None
-        self.panda_moved = False
-        self.belt_moved = False
-
-    def move_robot_core(self, movement, shelf_nr):
-
-        # self.panda_obj.call_method("2:MoveRobotLibfranka", movement, str(shelf_nr))
-        self.panda_obj.call_method("2:MoveRobotRos", movement, str(shelf_nr))
-        logger.debug("move robot to shelf %s", shelf_nr)
-        time.sleep(3)
-        self.panda_moved = False
-        logger.debug("robot core")
-        mytime = 0
-        while not self.handler_panda_moving.get_value():
-            time.sleep(0.1)
-            mytime += 0.1
-            # panda does not react
-            if mytime >= 6:
-                logger.debug("waited for: %.2s seconds without detecting panda moving", mytime)
-                self.panda_moved = False
-                return False
-
-
-        logger.debug("panda moving: " + str(self.handler_panda_moving.get_value()))
-        while self.handler_panda_moving.get_value():
-            time.sleep(0.1)
-        logger.debug("panda move finished")
-        self.panda_moved = True
-        return True
-
-    def move_belt_core(self, movement, distance):
-
-        self.belt_obj.call_method("2:MoveBelt", movement, distance)
-        self.belt_moved = False
-
-        mytime = 0
-        while not self.handler_belt_moving.get_value():
-            time.sleep(0.1)
-            mytime += 0.1
-            # logger.debug("time: %.2s", mytime)
-            # panda does not react
-            if mytime >= 3:
-                self.belt_moved = False
-                return False
-
-        self.belt_moved = True
-        return True
 
     def datachange_notification(self, node, val, data):
+        # only hand the edge to the dispatcher - reads and file I/O would stall the receiving thread
+        logger.debug("handler: New data change event on fhs server: NewValAvailable=%s", val)
+        from traffic_capture import recorder
+        recorder.record("datachange", "fhs", "NewValAvailable", val)
+        if val is True:
+            event_dispatcher.submit("NewValAvailable", self.new_val_available, val)
+
+    def new_val_available(self, val):
+        # runs in a worker of the event dispatcher
         try:
 
-            logger.debug("handler: New data change event on fhs server: NewValAvailable=%s", val)
-
-            # GET SOME VALUES FROM THIS SERVER
-            logger.debug("handler: connecting to DTZ master Server")
-            this_client = Client("opc.tcp://0.0.0.0:4840/freeopcua/server")
-            this_client.connect()
-            this_client_root = this_client.get_root_node()
-            self.demonstrator_busy = this_client_root.get_child(
-                ["0:Objects", "2:DTZMasterController", "2:DemonstratorBusy"])
-
-            # GET SOME VALUES FROM FHS SERVER
-            logger.debug("handler: connecting to FHS Server")
-            # handler_client_fhs = Client(global_url_pseudo_fhs_server)                                                  # Testing with pseudo FH server
-            handler_client_fhs = Client(global_url_fhs_server)  # Original
-            handler_client_fhs.connect()
-            handler_root_fhs = handler_client_fhs.get_root_node()
-            # handler_desired_shelf = handler_client_fhs.get_node("ns=2;i=3")                                            # Testing with pseudo FH server
-            handler_desired_shelf = handler_client_fhs.get_node("ns=6;s=::AsGlobalPV:ShelfNumber")  # Original
-
-            # GET VALUES FROM PANDA SERVER
-            logger.debug("handler: connecting to Panda Server")
-            handler_client_panda = Client(global_url_panda_server)
-            handler_client_panda.connect()
-            handler_root_panda = handler_client_panda.get_root_node()
-            self.handler_panda_moving = handler_root_panda.get_child(["0:Objects", "2:PandaRobot", "2:RobotMoving"])
-
-            # GET VALUES FROM PIXTEND SERVER
-            logger.debug("handler: connecting to Pixtend Server")
-            handler_client_pixtend = Client(global_url_pixtend_server)
-            handler_client_pixtend.connect()
-            handler_root_pixtend = handler_client_pixtend.get_root_node()
-            self.handler_belt_moving = handler_root_pixtend.get_child(
-                ["0:Objects", "2:ConveyorBelt", "2:ConBeltMoving"])
-
-            # data = NewValueAvailable
-            demoBusy = self.demonstrator_busy.get_value()
-            exit = "NewValAvailable is {}, demonstratorBusy is {}".format(val, demoBusy)
-
-            if val is True and demoBusy is False:
-                logger.debug("handler: global_demonstrator_busy: " + str(demoBusy) + ". NewValAvailable: " + str(
-                    val) + ". ShelfNumber: " + str(handler_desired_shelf.get_value()) + ".")
-
-                ############# LOAD STORAGE DATA  #############
-                # [1][2][3]
-                # [4][5][6]
-                # [7][8][9]
-
-                with open("./dtz_storage", "r", encoding="utf-8") as in_file:
-                    for in_line in in_file:
-                        self.storage.append(in_line)
-
-                # IS THE STORAGE EMPTY?
-                self.storage[handler_desired_shelf.get_value() - 1] = "1"
-
-                #if self.storage[handler_desired_shelf.get_value() - 1] is "0":   # commented because of problems with demonstrator
+            exit = "NewValAvailable is {}".format(val)
+
+            if val is True:
+                # SHELF AND TASK STATE IN ONE READ ON THE LONG-LIVED SESSION
+                request = session_pool.get("fhs").read_many(key for key in FHS_REQUEST_KEYS if key in fhs_node_ids)
+                desired_shelf = request["ShelfNumber"]
+                logger.debug("handler: NewValAvailable: %s. ShelfNumber: %s. TaskRunning: %s.", val, desired_shelf,
+                             request.get("TaskRunning"))
+
+                # a wrong shelf would only be noticed by the storage, after the robot moved - rejected like a
+                # MoveDemonstrator call, the FHS server gets no answer, so it is published in the Status
+                error = invalid_request(desired_shelf, "SO")
+                if error is not None:
+                    logger.warning("handler: FHS request of shelf %r rejected: %s", desired_shelf, error)
+                    metrics.inc("dtz_dispatch_events_total", result="rejected", key="NewValAvailable")
+                    publisher.merge(STATUS, Rejected={"Shelf": desired_shelf, "Error": error})
+                    return error
+
+                if standby is not None and not standby.active:
+                    # the active instance queues it - remembered in case it stopped before its journal write
+                    replica.remember(desired_shelf)
+                    return "Remembered by the standby"
+
+                # IS THE STORAGE EMPTY? - in memory, written back only on a change
+                shelf_storage.set(desired_shelf, True)
+
+                #if not shelf_storage.is_occupied(desired_shelf):   # commented because of problems with demonstrator
                 if False:
                     exit = "Shelf empty - error!"
                 else:
-                    self.demonstrator_busy.set_value(True)
-
-                    # METHOD CALLS
-                    move_panda_thread = threading.Thread(name='move_panda_thread', target=self.move_robot_core,
-                                                         args=("SO", handler_desired_shelf.get_value(),))
-                    move_panda_thread.daemon = True
-                    move_panda_thread.start()
-                    move_panda_thread.join()
-
-                    # logger.debug("p_moved %s", self.panda_moved)
-                    if self.panda_moved is True:
-                        move_belt_thread = threading.Thread(name='move_belt_thread', target=self.move_belt_core,
-                                                            args=("left", 0.55,))
-                        move_belt_thread.daemon = True
-                        move_belt_thread.start()
-                        self.storage[handler_desired_shelf.get_value() - 1] = "0"
-                        move_belt_thread.join()
-                        if not self.belt_moved:
-                            logger.debug("Error - Belt not moved")
-                            exit = "Error - Belt not moved"
-                    else:
-                        logger.debug("Error - Panda not moved")
-                        exit = "Error - Panda not moved"
-
-
-
-                    ############# SAVE STORAGE DATA  #############
-                    # [1][2][3]
-                    # [4][5][6]
-                    # [7][8][9]
-                    with open("./dtz_storage", "w", encoding="utf-8") as out_file:
-                        for out_line in self.storage:
-                            out_file.write(str(out_line))
-
-            logger.debug("handler: disconnect from fhs server")
-            handler_client_fhs.disconnect()
-            logger.debug("handler: disconnect from panda server")
-            handler_client_panda.disconnect()
-            logger.debug("handler: disconnect from pixtend server")
-            handler_client_pixtend.disconnect()
-            this_client.disconnect()
+                    # never dropped while the demonstrator is busy - the job scheduler runs it as soon as possible
+                    job = job_queue.submit(desired_shelf, "SO", "fhs")
+                    demonstrator_busy_output.set(True)
+                    exit = "Queued as job {}".format(job.job_id)
 
         except Exception as e:
-            logger.debug("handler: Catched Exception: " + str(e))
-            try:
-                logger.debug("handler: trying to disconnect from pixtend server")
-                handler_client_pixtend.disconnect()
-            except:
-                logger.debug("handler: pixtend server was disconnected")
-                pass
-            try:
-                logger.debug("handler: trying to disconnect from panda server")
-                handler_client_panda.disconnect()
-            except:
-                logger.debug("handler: panda server was disconnected")
-                pass
-            try:
-                logger.debug("handler: trying to disconnect from fhs server")
-                handler_client_fhs.disconnect()
-            except:
-                logger.debug("handler: fhs server was disconnected")
-                pass
+            # the sessions stay open - reconnecting is the job of the connection threads
+            logger.debug("handler: Catched Exception: %s", e)
             return "handler: Error: " + str(e)
 
-        logger.debug("handler: exiting datachange_notification. return message: %s", exit)
+        logger.debug("handler: exiting new_val_available. return message: %s", exit)
         return exit
 
     def event_notification(self, event):
-        logger.debug("handler: New event", event)
+        logger.debug("handler: New event %s", event)
 
 
 
-######################### CONNECTION THREADS #################
-
-###############  THREAD - CONNECT TO FH SERVER ###############
-# FH Connection in separate thread
-def threaded_fh_connection():
-    # reconnection counter
-    fh_counter = 1
+######################### CONNECTIONS #################
+# every endpoint is kept alive by its own EndpointSupervisor (see supervisor.py) - these functions only set up the
+# session and its subscriptions, the supervisor watches them and reconnects with backoff
 
+###############  CONNECT TO FH SERVER ###############
+def connect_fh():
     global global_desired_shelf
-    global global_panda_moving
-    global global_belt_moving
-    global global_object_panda
-    global global_object_pixtend
     global global_new_val_available
-    global subhandler_already_created
-    temp = None
-    temp_node = None
-    sub = None
-
-
-    while True:
-        try:
-            # connect to fhs server
-            logger.debug("threaded: connecting to fhs server")
-            client_fhs.connect()
-            client_fhs_2.connect()
-            logger.debug("threaded: successful connected to fhs")
-
-            # Get root nodes
-            root_fhs = client_fhs.get_root_node()
-
-            ########## GET VARIABLES FROM SERVER ##########
-            # get our desired objects
-            # object_fhs = root_fhs.get_child(["0:Objects", "2:PLC"])
+    global fh_subscription
+    fhs_session = session_pool.get("fhs")
 
-            # VALUES
-            # get the control values from fh salzburg server
-            global_desired_shelf = client_fhs.get_node("ns=6;s=::AsGlobalPV:ShelfNumber")  # Original
-            # global_desired_shelf = client_fhs.get_node("ns=2;i=3")                                                     # Testing with pseudo FH server
-            local_shelf = global_desired_shelf.get_value() - 1  # Shelf 1-9 to array 0-8
+    # connect to fhs server - one session for the subscription, the reads of the handler and the heartbeat.
+    # The handler does not read on the receiving thread any more, so no second client is needed
+    fhs_session.connect()
 
-            temp_node = client_fhs_2.get_node("ns=6;s=::AsGlobalPV:ShelfNumber")  # For the 2nd Client in the while loop - otherwise exeption when datachange subscription routine is active and get.value() in while loop is called
+    ########## GET VARIABLES FROM SERVER ##########
+    # VALUES
+    # get the control values from fh salzburg server
+    global_desired_shelf = fhs_session.node("ShelfNumber")
+    local_shelf = fhs_session.read("ShelfNumber") - 1  # Shelf 1-9 to array 0-8
 
+    global_new_val_available = fhs_session.node("NewValAvailable")
 
-            global_new_val_available = client_fhs.get_node("ns=6;s=::AsGlobalPV:NewValAvailable")  # Original
-            # global_new_val_available = client_fhs.get_node("ns=2;i=4")                                                 #Testing with pseudo FH server
-            task_running = client_fhs.get_node("ns=6;s=::AsGlobalPV:TaskRunning")
+    ###### SUBSCRIBE TO SERVER DATA CHANGE ON FH SERVER #######
+    demo_handler = SubHandler(str(local_shelf + 1), state_cache.get("RobotMoving"),
+                              state_cache.get("ConBeltMoving"), global_object_panda, global_object_pixtend)
 
+    logger.debug("threaded: create subscription handle fh server")
+    fh_subscription = fhs_session.client.create_subscription(500, demo_handler)
+    fh_subscription.subscribe_data_change(global_new_val_available)
 
-            ###### SUBSCRIBE TO SERVER DATA CHANGE ON FH SERVER #######
-            demo_handler = SubHandler(str(local_shelf + 1), global_panda_moving.get_value(),
-                                    global_belt_moving.get_value(), global_object_panda, global_object_pixtend)
+    # heartbeat of the long-lived session - no polling reads
+    return subscribe_state(fhs_session, state_cache, [], heartbeat_timeout=config.heartbeat_timeout)
 
-            logger.debug("threaded: create subscription handle fh server")
-            sub = client_fhs.create_subscription(500, demo_handler)
-            demo_handle = sub.subscribe_data_change(global_new_val_available)
 
-            # everything went fine? then wait
-            while True:
-                temp = temp_node.get_value() - 1  # Just to see if connection is still alive
-                time.sleep(1)
+def cleanup_fh():
+    global fh_subscription
+    logger.debug("threaded: trying to disconnect from fh server")
+    subscription, fh_subscription = fh_subscription, None
+    if subscription is not None:
+        subscription.delete()
 
 
-        except Exception as e:
-            logger.debug("threaded: Catched Exception: " + str(e))
-            try:
-                logger.debug("threaded: trying to disconnect from fh server")
-                client_fhs.disconnect()
-                client_fhs_2.disconnect()
-                logger.debug("threaded: delete subscription handle fh server")
-                sub.unsubscribe(demo_handle)
-                sub.delete()
-                demo_handle = None
-                demo_handler = None
-            except Exception as e:
-                logger.debug("threaded: Catched Exception: " + str(e))
-
-        logger.debug("threaded: no connection to fh server - trying again in " + str(fh_counter) + " seconds.")
-        fh_counter = fh_counter * 2
-        if fh_counter > 17:
-            fh_counter = 1
-        time.sleep(fh_counter)
-
-
-
-
-###############  THREAD - CONNECT TO PANDA SERVER ###############
-# Panda Connection in separate thread
-def threaded_panda_connection():
-
-    # reconnection counter
-    panda_counter = 1
-
+###############  CONNECT TO PANDA SERVER ###############
+def connect_panda():
     global global_panda_moving
     global global_object_panda
-    temp = None
+    panda_session = session_pool.get("panda")
+    panda_session.connect()
 
-    while True:
-        try:
-            logger.debug("threaded: connecting to panda server")
-            client_panda.connect()
-            logger.debug("threaded: successful connected to panda")
+    ########## GET VARIABLES FROM SERVER ##########
+    # get our desired objects - resolved once by the session pool
+    global_object_panda = panda_session.node("PandaRobot")
 
-            # Get root nodes
-            root_panda = client_panda.get_root_node()
+    # VALUES
+    global_panda_moving = panda_session.node("RobotMoving")
+    return subscribe_state(panda_session, state_cache, panda_state_keys, heartbeat_timeout=config.heartbeat_timeout)
 
-            ########## GET VARIABLES FROM SERVER ##########
-            # get our desired objects
-            global_object_panda = root_panda.get_child(["0:Objects", "2:PandaRobot"])
 
-            # VALUES
-            mover_panda_ros = root_panda.get_child(["0:Objects", "2:PandaRobot", "2:MoveRobotRos"])
-            mover_panda_libfranka = root_panda.get_child(["0:Objects", "2:PandaRobot", "2:MoveRobotLibfranka"])
-            panda_state = root_panda.get_child(["0:Objects", "2:PandaRobot", "2:RobotState"])
-            global_panda_moving = root_panda.get_child(["0:Objects", "2:PandaRobot", "2:RobotMoving"])
-
-            # everything went fine? then wait
-            while True:
-                temp = global_panda_moving.get_value()
-                time.sleep(0.5)
-
-            try:
-                client_panda.disconnect()
-            except:
-                pass
-
-        except Exception as e:
-            try:
-                logger.debug("threaded: Catched Exception: " + str(e))
-                logger.debug("threaded: trying to disconnect from panda server")
-                client_panda.disconnect()
-            except:
-                pass
+###############  CONNECT TO PIXTEND SERVER ###############
+def connect_pixtend():
+    global global_belt_moving
+    global global_object_pixtend
+    pixtend_session = session_pool.get("pixtend")
+    pixtend_session.connect()
 
-        logger.debug("threaded: no connection to panda server - trying again in " + str(panda_counter) + " seconds.")
-        panda_counter = panda_counter * 2
-        if panda_counter > 17:
-            panda_counter = 1
-        time.sleep(panda_counter)
+    ########## GET VARIABLES FROM SERVER ##########
+    # get our desired objects - resolved once by the session pool
+    global_object_pixtend = pixtend_session.node("ConveyorBelt")
 
+    # VALUES
+    global_belt_moving = pixtend_session.node("ConBeltMoving")
+    return subscribe_state(pixtend_session, state_cache, pixtend_state_keys,
+                           heartbeat_timeout=config.heartbeat_timeout)
 
 
-###############  THREAD - CONNECT TO PIXTEND SERVER ###############
-# Pixtend Connection in separate thread
-def threaded_pixtend_connection():
 
-    # reconnection counter
-    pixtend_counter = 1
+##################### METHODS ######################
 
-    global global_belt_moving
-    global global_object_pixtend
+@uamethod
+def start_demo(parent, movement, shelf):
+    global global_demonstrator_busy
+    global global_panda_moving
     global global_belt_moving
 
-    while True:
-        try:
-            logger.debug("threaded: connecting to pixtend server")
-            client_pixtend.connect()
-            logger.debug("threaded: successful connected to pixtend")
+    # a wrong shelf would only be noticed by the storage, after the robot moved
+    error = invalid_request(shelf, movement)
+    if error is not None:
+        return error, 0
 
-            # Get root nodes
-            root_pixtend = client_pixtend.get_root_node()
+    # fail fast - a job for an unreachable robot or belt would only wait in the queue
+    for name in ("panda", "pixtend"):
+        if not session_pool.get(name).breaker.allow():
+            return "Error - {} not connected".format(name), 0
 
-            ########## GET VARIABLES FROM SERVER ##########
-            # get our desired objects
-            global_object_pixtend = root_pixtend.get_child(["0:Objects", "2:ConveyorBelt"])
+    #if not shelf_storage.is_occupied(shelf):  # can be activated - robot then only moves once per shelf number
+    if False:
+        return "Shelf empty - error!", 0
 
-            # VALUES
-            conbelt_state = root_pixtend.get_child(["0:Objects", "2:ConveyorBelt", "2:ConBeltState"])
-            conbelt_dist = root_pixtend.get_child(["0:Objects", "2:ConveyorBelt", "2:ConBeltDist"])
-            busy_light = root_pixtend.get_child(["0:Objects", "2:ConveyorBelt", "2:SwitchBusyLight"])
-            global_belt_moving = root_pixtend.get_child(["0:Objects", "2:ConveyorBelt", "2:ConBeltMoving"])
+    else:
 
+        # queued - also while the robot or the belt is moving, the job scheduler runs it as soon as possible.
+        # The job id is the name of its variable Jobs/Job<id> and in the DemonstratorJobEvents
+        job = job_queue.submit(shelf, movement, "method")
+        demonstrator_busy_output.set(True)
+        return "Successful", job.job_id
 
-            # everything went fine? then wait
-            while True:
-                temp = global_belt_moving.get_value()
-                time.sleep(0.5)
 
-        except Exception as e:
-            logger.debug("threaded: Catched Exception: " + str(e))
-            try:
-                logger.debug("threaded: trying to disconnect from pixtend server")
-                client_pixtend.disconnect()
-            except:
-                pass
+@uamethod
+def cancel_demo(parent, job_id, timeout):
+    # a running job stops waiting for its move after timeout seconds, the robot or belt may finish it
+    return job_queue.cancel(job_id, timeout)
 
-        logger.debug("threaded: no connection to pixtend server - trying again in " + str(pixtend_counter) + " seconds.")
-        pixtend_counter = pixtend_counter * 2
-        if pixtend_counter > 17:
-            pixtend_counter = 1
-        time.sleep(pixtend_counter)
 
+def reload_configuration():
+    # reloadable settings are applied by the listeners of the config, the sessions stay open
+    try:
+        return config.reload()
+    except ConfigError as e:
+        logger.error("config: %s", e)
+        return "Error - {}".format(e)
 
 
-##################### METHODS ######################
+@uamethod
+def reload_config(parent):
+    return reload_configuration()
 
-def start_demo_core(movement, shelf):
-    logger.debug("in start demo core")
-    # global_object_panda.call_method("2:MoveRobotLibfranka", movement, str(global_desired_shelf.get_value()))
-    global_object_panda.call_method("2:MoveRobotRos", movement, str(shelf))
 
-    # wait for robot to even react otherwise the code would jump instantly to the end
-    while not global_panda_moving.get_value():
-        time.sleep(0.2)
+@uamethod
+def set_log_level(parent, level):
+    # until the next reload which changes log_level
+    return log_pipeline.set_level(level)
 
-    while global_panda_moving.get_value():
-        time.sleep(0.2)
 
-    global_object_pixtend.call_method("2:MoveBelt", "left", 0.55)  # drive 55cm right
+##################### DIAGNOSTICS ######################
+# see diagnostics.py - also on the local HTTP port diagnostics_port
 
-    # wait for belt to even react otherwise the code would jump instantly to the end
-    while not global_belt_moving.get_value:
-        time.sleep(0.2)
+@uamethod
+def dump_threads(parent):
+    from diagnostics import diagnostics
+    return diagnostics.threads()
 
-    while global_belt_moving.get_value():
-        time.sleep(0.2)
 
-    return True
+@uamethod
+def profile(parent, seconds):
+    # returns at once, the collapsed stacks are written to diagnostics_path after the seconds
+    from diagnostics import diagnostics
+    return diagnostics.start_profile(seconds)
 
 
 @uamethod
-def start_demo(parent, movement, shelf):
-    global storage
-    global global_demonstrator_busy
-    global global_panda_moving
-    global global_belt_moving
+def object_counts(parent):
+    from diagnostics import diagnostics
+    return diagnostics.objects()
 
-    #if storage[shelf] is "0":  # can be activated - robot then only moves once per shelf number
-    if False:
-        return "Shelf empty - error!"
 
-    elif not global_panda_moving.get_value() and not global_belt_moving.get_value():
+def stop_on_sigterm(signum, frame):
+    # stops like before, but hands the lease over at once - the standby does not wait for its expiry
+    from traffic_capture import recorder
+    standby.lease.release()
+    log_pipeline.stop()
+    recorder.close()
+    os._exit(0)
 
-        global_demonstrator_busy.set_value(True)
-        move_thread = threading.Thread(name='move_demo_thread', target=start_demo_core, args=(movement, shelf,))
-        move_thread.daemon = True
-        move_thread.start()
-        # storage[shelf] = "0"  # make shelf empty
-        return "Successful"
 
-    else:
+##################### CONFIGURATION ######################
 
-        return "Shelf not empty - Demonstrator started!"
+def apply_config(new_config):
+    """
+    Set the module globals of the single demonstrator from the configuration - cells.py and the asyncio engine
+    read them from here
+    """
+    global config
+    global global_url_opcua_adapter
+    global global_url_panda_server
+    global global_url_pixtend_server
+    global global_url_fhs_server
+    global fhs_node_ids
+    global metrics_port
+    global history_path
+    global history_retention
+    global history_max_bytes
+    global desired_distance
+    global belt_velocity
+    config = new_config
+    global_url_opcua_adapter = config.adapter_url
+    global_url_panda_server = config.panda_url
+    global_url_pixtend_server = config.pixtend_url
+    global_url_fhs_server = config.fhs_endpoint
+    fhs_node_ids = config.fhs_node_ids
+    metrics_port = config.metrics_port
+    history_path = config.history_path
+    history_retention = config.history_retention
+    history_max_bytes = config.history_max_bytes
+    desired_distance = config.belt_distance
+    belt_velocity = config.belt_velocity
+
+    # connect to the local simulators instead of the demonstrator - see simulators.py
+    if config.simulate:
+        from simulators import SIM_URLS
+        global_url_panda_server = SIM_URLS["panda"]
+        global_url_pixtend_server = SIM_URLS["pixtend"]
+        global_url_fhs_server = SIM_URLS["fhs"]
+        logger.debug("using the simulated devices %s", SIM_URLS)
 
 
 ################################################# START #######################################################
 
 if __name__ == "__main__":
 
+    ################ LOGGING ################
+    log_pipeline = LogPipeline(logger).start()
+    atexit.register(log_pipeline.stop)
+
+    ################ CONFIGURATION ################
+    # defaults, config file, environment, command line - validated before anything is started, see config.py
+    try:
+        apply_config(Config.load(sys.argv))
+    except ConfigError as e:
+        logger.error("config: %s", e)
+        sys.exit(2)
+    if "--check-config" in sys.argv:
+        print(json.dumps(dict(config.as_dict(), fhs_endpoint=global_url_fhs_server, fhs_node_ids=fhs_node_ids),
+                         indent=2, sort_keys=True))
+        sys.exit(0)
+    log_pipeline.configure(config.log_level, config.log_format)
+    config.add_listener(lambda config, changed: log_pipeline.configure(config.log_level, config.log_format))
+    if config.capture_path:
+        # every request to and notification from the devices - replayed offline with replay.py
+        from traffic_capture import recorder
+        recorder.open(config.capture_path)
+    if config.server_security != "None" or config.upstream_security != "None":
+        # certificate and private key are parsed once, the sessions and the server use the same objects
+        from security import Credentials, SecurityError
+        try:
+            credentials = Credentials.from_config(config)
+        except SecurityError as e:
+            logger.error("security: %s", e)
+            sys.exit(2)
+
+    ################ CELLS ################
+    # one demonstrator by default, several with --cells <file>, DTZ_CELLS_FILE or DTZ_CELLS - see cells.py
+    cell_registry = load_registry(sys.modules[__name__], path=config.cells_file)
+
+    ################ ENGINE SELECTION ################
+    # the asyncio engine runs everything as coroutines in one event loop - see async_engine.py
+    use_asyncio = config.engine == "asyncio"
+    if len(cell_registry) > 1 and not use_asyncio:
+        # the thread engine is built for one demonstrator - several cells share one event loop
+        logger.debug("%s cells configured - using the asyncio engine", len(cell_registry))
+        use_asyncio = True
+    if use_asyncio:
+        import async_engine
+        async_engine.main(sys.modules[__name__], cell_registry)
+        sys.exit(0)
+
+    # the thread engine runs the one configured cell
+    cell = cell_registry.cells()[0]
+    global_url_panda_server = cell.panda_url
+    global_url_pixtend_server = cell.pixtend_url
+    global_url_fhs_server = cell.fhs_url
+    desired_distance = cell.belt_distance
+    shelf_storage = ShelfStorage(cell.storage_path)
+    job_queue = JobQueue(cell.jobs_path, PickSequencer().configure(config))  # travel-optimized order of the picks
+    if config.ha_lease:
+        # active-standby - the instance which holds the lease serves, the other one waits warm, see failover.py
+        from failover import FileLease, Replica, Standby
+        replica = Replica(shelf_storage, job_queue, cell.name)
+        standby = Standby(FileLease(config.ha_lease, config.ha_lease_ttl), [replica])
+
     ################ CLIENT SETUP I ################
 
-    client_panda = Client(global_url_panda_server)
-    client_pixtend = Client(global_url_pixtend_server)
-    client_fhs = Client(global_url_fhs_server)          # Original
-    client_fhs_2 = Client(global_url_fhs_server)       # for the while loop inside the fh connection thread - otherwise there is an exception when getting variables from the server when simultaniously a
-                                                        # datachange subscription routine is running
-    # client_fhs = Client(global_url_pseudo_fhs_server)                                                                  # Testing with pseudo FH server
+    # one long-lived session per upstream server, shared by the connection threads and the handler
+    session_pool = SessionPool(credentials)
+    session_pool.add("panda", global_url_panda_server, browse_paths=panda_browse_paths)
+    session_pool.add("pixtend", global_url_pixtend_server, browse_paths=pixtend_browse_paths)
+    session_pool.add("fhs", global_url_fhs_server, node_ids=fhs_node_ids)
+
     # client = Client("opc.tcp://admin@localhost:4840/freeopcua/server/") #connect using a user
 
     ############# LOAD STORAGE DATA  #############
     # [1][2][3]
     # [4][5][6]
     # [7][8][9]
-    with open("./dtz_storage", "r", encoding="utf-8") as input_file:
-        for line in input_file:
-            storage.append(line)
+    shelf_storage.load()
 
     # reconnection counter
     retry_counter = 1
 
     # counter for server loop in order to get notifications if it is running
     notification_counter = 0
+    last_notification = time.time()
 
     # keyboard interrupt raised by inner while loop giving signal also to outer while loop via variable
     keyboardint = False
@@ -549,8 +481,10 @@ if __name__ == "__main__":
 
     # setup server
     server = Server()
-    url = "opc.tcp://0.0.0.0:4840/freeopcua/server"
+    url = config.server_url
     server.set_endpoint(url)
+    if credentials is not None and config.server_security != "None":
+        credentials.secure_server(server)
     # setup namespace
     uri = "urn:freeopcua"
     idx = server.register_namespace(uri)
@@ -562,15 +496,217 @@ if __name__ == "__main__":
     master_object = objects.add_object(idx, "DTZMasterController")
 
     # Parameters - Addresspsace, Name, Initial Value
-    server_time = master_object.add_variable(idx, "ServerTime", 0)
+    publisher.configure(config)
+    server_time = master_object.add_variable(idx, "ServerTime", datetime.utcnow())
     global_demonstrator_busy = master_object.add_variable(idx, "DemonstratorBusy", False)
     global_demonstrator_busy.set_writable()
+
+    # Status - device state, queue and connections in one JSON object, see publisher.py
+    status_node = master_object.add_variable(idx, STATUS, json.dumps(initial_status(state_initial_values)))
+    publisher.add(STATUS, lambda status: status_node.set_value(json.dumps(status, sort_keys=True)),
+                  initial_status(state_initial_values))
+
+    def write_demonstrator_busy(busy):
+        global_demonstrator_busy.set_value(busy)
+        publisher.merge(STATUS, DemonstratorBusy=busy)
+    demonstrator_busy_output = publisher.add("DemonstratorBusy", write_demonstrator_busy)
+    busy_light_output = EdgeOutput(
+        "SwitchBusyLight", lambda busy: session_pool.get("pixtend").call("ConveyorBelt", "2:SwitchBusyLight", busy),
+        generation=lambda: session_pool.get("pixtend").connect_count)  # switched again after a reconnect
+    master_object.add_method(idx, "ReloadConfig", reload_config, [], [ua.VariantType.String])
+    master_object.add_method(idx, "SetLogLevel", set_log_level, [ua.VariantType.String], [ua.VariantType.String])
     mover = master_object.add_method(idx, "MoveDemonstrator", start_demo, [ua.VariantType.String, ua.VariantType.Int64],
-                                     [ua.VariantType.Boolean])
+                                     [ua.VariantType.String, ua.VariantType.Int64])
+    master_object.add_method(idx, "CancelDemonstrator", cancel_demo, [ua.VariantType.Int64, ua.VariantType.Double],
+                             [ua.VariantType.String])
+
+    # Device state - State/RobotMoving, RobotState, ConBeltMoving, ConBeltState, ConBeltDist, from the state cache
+    state_object = master_object.add_object(idx, "State")
+    state_nodes = dict((key, state_object.add_variable(idx, key, value)) for key, value in state_initial_values.items())
+    for key, node in state_nodes.items():
+        publisher.add("State/" + key, node.set_value, state_initial_values[key])
+
+    def publish_state(key, value):
+        if key in state_nodes and value is not None:
+            publisher.set("State/" + key, value)
+            publisher.merge(STATUS, **{key: value})
+    state_cache.add_listener(publish_state)
+
+    # Shelf occupancy - Storage/Shelf1 ... Storage/Shelf9, kept up to date by the shelf storage
+    storage_object = master_object.add_object(idx, "Storage")
+    shelf_nodes = [storage_object.add_variable(idx, "Shelf{}".format(shelf), occupied)
+                   for shelf, occupied in enumerate(shelf_storage.as_list(), 1)]
+    shelf_storage.add_listener(lambda shelf, occupied: shelf_nodes[shelf - 1].set_value(occupied))
+
+    # Job queue - Jobs/QueueDepth, Jobs/JobStatus (JSON list of the running and queued jobs), Jobs/Motion (stalls
+    # and learned deadlines of the motion tracker) and Jobs/Sequencer (picks reordered by the pick sequencer and the
+    # robot travel saved against FIFO)
+    jobs_object = master_object.add_object(idx, "Jobs")
+    queue_depth = jobs_object.add_variable(idx, "QueueDepth", 0)
+    publisher.add("Jobs/QueueDepth", queue_depth.set_value, 0)
+    job_status = jobs_object.add_variable(idx, "JobStatus", "[]")
+    publisher.add("Jobs/JobStatus", job_status.set_value, "[]")
+    last_cycle_timing = jobs_object.add_variable(idx, "LastCycleTiming", "{}")  # phase start/end of the last cycle
+    publisher.add("Jobs/Motion", jobs_object.add_variable(idx, "Motion", "{}").set_value, "{}")
+    publisher.add("Jobs/Sequencer", jobs_object.add_variable(idx, "Sequencer", "{}").set_value, "{}")
+
+    def publish_jobs(queue):
+        publisher.set("Jobs/QueueDepth", queue.depth())
+        publisher.set("Jobs/JobStatus", json.dumps([job.to_dict() for job in queue.jobs()]))
+        publisher.merge(STATUS, QueueDepth=queue.depth())
+    job_queue.add_listener(publish_jobs)
+
+    # Jobs/Job<id> - JSON of one job, kept until it is finished and one of the 20 oldest. Every status change
+    # (queued, robot, belt, done, failed, cancelled) also fires a DemonstratorJobEvent of DTZMasterController
+    job_event_type = server.create_custom_event_type(
+        idx, "DemonstratorJobEventType", ua.ObjectIds.BaseEventType,
+        [(name, getattr(ua.VariantType, variant_type)) for name, variant_type in JOB_EVENT_PROPERTIES])
+    job_events = server.get_event_generator(job_event_type, master_object)
+    job_nodes = collections.OrderedDict()
+    job_lock = threading.Lock()
+
+    def job_changed(job):
+        with job_lock:
+            node = job_nodes.get(job.job_id)
+            if node is None:
+                node = job_nodes[job.job_id] = jobs_object.add_variable(idx, "Job{}".format(job.job_id), "{}")
+            node.set_value(json.dumps(job.to_dict()))
+            while len(job_nodes) > 20:
+                oldest = job_queue.get(next(iter(job_nodes)))
+                if oldest is not None and oldest.status not in FINISHED:
+                    break
+                server.delete_nodes([job_nodes.popitem(last=False)[1]])
+            job_events.event.JobId, job_events.event.Shelf = job.job_id, job.shelf
+            job_events.event.Status, job_events.event.JobMessage = job.status, job.message
+            job_events.trigger(message="job {} {}".format(job.job_id, job.status))
+    job_queue.add_job_listener(job_changed)
+    if standby is None:
+        for job in job_queue.load():
+            job_changed(job)
+    else:
+        job_queue.load(replica=True)  # the journal belongs to the active instance
+
+    # Diagnostics - one variable per metric with a JSON summary (count, mean, p50, p95, max) per label set
+    diagnostics_object = master_object.add_object(idx, "Diagnostics")
+    for name in sorted(FAMILIES):
+        publisher.add("Diagnostics/" + name, diagnostics_object.add_variable(idx, name, "{}").set_value, "{}")
+    # thread dump, sampling profiler and object census of a stalled controller - see diagnostics.py
+    diagnostics_object.add_method(idx, "DumpThreads", dump_threads, [], [ua.VariantType.String])
+    diagnostics_object.add_method(idx, "Profile", profile, [ua.VariantType.Double], [ua.VariantType.String])
+    diagnostics_object.add_method(idx, "ObjectCounts", object_counts, [], [ua.VariantType.String])
+
+    def publish_diagnostics():
+        for name in FAMILIES:
+            publisher.set("Diagnostics/" + name, json.dumps(metrics.summary(name), sort_keys=True))
+        publisher.set("Jobs/Motion", json.dumps(job_scheduler.tracker.status(), sort_keys=True))
+        publisher.set("Jobs/Sequencer", json.dumps(job_queue.sequencer.status(), sort_keys=True))
+
+    # Connections - state of every upstream endpoint: Connections/<name>/State, Breaker, Reconnects, RetryIn, LastError
+    supervisors = [EndpointSupervisor(session_pool.get("fhs"), connect_fh, cleanup_fh,
+                                      heartbeat_timeout=config.heartbeat_timeout),
+                   EndpointSupervisor(session_pool.get("panda"), connect_panda,
+                                      lambda: state_cache.invalidate(panda_state_keys),
+                                      heartbeat_timeout=config.heartbeat_timeout),
+                   EndpointSupervisor(session_pool.get("pixtend"), connect_pixtend,
+                                      lambda: state_cache.invalidate(pixtend_state_keys),
+                                      heartbeat_timeout=config.heartbeat_timeout)]
+    connections_object = master_object.add_object(idx, "Connections")
+    for supervisor in supervisors:
+        endpoint_object = connections_object.add_object(idx, supervisor.name)
+        for key, name, value in CONNECTION_VARIABLES:
+            publisher.add("Connections/{}/{}".format(supervisor.name, key),
+                          endpoint_object.add_variable(idx, name, value).set_value, value)
+
+        def publish_connection(supervisor):
+            for key, value in supervisor.status().items():
+                publisher.set("Connections/{}/{}".format(supervisor.name, key), value)
+            publisher.merge(STATUS, Connections=dict((supervisor.name, supervisor.status()["state"])
+                                                     for supervisor in supervisors))
+        supervisor.add_listener(publish_connection)
+    publisher.start()
+
+    # the work of the subscription handler is done here, not on the receiving thread
+    event_dispatcher.start()
+
+    #### ONE SUPERVISOR THREAD PER UPSTREAM SERVER ####
+    for supervisor in supervisors:
+        supervisor.start()
+
+    # standby - sessions, state and address space are kept warm, storage and jobs follow the active instance until
+    # its lease expires, see failover.py. The journal is compacted once the previous instance can not append any more
+    if standby is not None:
+        standby.wait()
+        shelf_storage.load()
+        for job in job_queue.load(compact_after=standby.lease.grace_end()):
+            job_changed(job)
+        for shelf in replica.missed(standby.since()):
+            logger.debug("standby: FHS request of shelf %s was not queued by the previous instance", shelf)
+            shelf_storage.set(shelf, True)
+            job_queue.submit(shelf, "SO", "fhs")
 
     # start server
-    server.start()
-    logger.debug("OPC-UA - Master - Server started at {}".format(url))
+    if standby is None:
+        server.start()
+    else:
+        # an instance which lost its lease stops at once - restarted, it is the standby. The lease is kept while
+        # the server start is retried, the previous instance may still hold the port
+        from traffic_capture import recorder
+        standby.keep(lambda: (log_pipeline.stop(), recorder.close(), os._exit(3)))
+        atexit.register(standby.lease.release)
+        signal.signal(signal.SIGTERM, stop_on_sigterm)
+        standby.serve(server.start, server.stop)
+    logger.debug("OPC-UA - Master - Server started at %s", url)
+
+    # History - HistoryRead on State/*, Storage/Shelf* and Jobs/LastCycleTiming, from the embedded historian
+    from historian import Historian, HistorianStorage
+    historian = Historian(history_path, history_retention, history_max_bytes)
+    history_storage = HistorianStorage(historian, ua)
+    server.iserver.history_manager.set_storage(history_storage)
+    for key, node in state_nodes.items():
+        history_storage.historize(server, node, "State/{}".format(key))
+    for shelf, node in enumerate(shelf_nodes, 1):
+        history_storage.historize(server, node, "Storage/Shelf{}".format(shelf))
+    history_storage.historize(server, last_cycle_timing, "Jobs/LastCycleTiming")
+    historian.start()
+
+    # runs the queued jobs back to back - with the overlapped cycle plan the robot pick of the next job overlaps the
+    # belt of the previous one
+    job_scheduler = JobScheduler(job_queue, state_cache, session_pool, shelf_storage, belt_distance=desired_distance,
+                                 plan=CyclePlan.from_config(config), tracker=MotionTracker().configure(config))
+    logger.debug("jobs: cycle plan %s", job_scheduler.plan)
+    job_scheduler.add_listener(lambda timing: last_cycle_timing.set_value(json.dumps(timing.to_dict())))
+    job_scheduler.start()
+
+    # hot reload - SIGHUP or the method ReloadConfig, the sessions stay open
+    def config_reloaded(config, changed):
+        global desired_distance
+        global belt_velocity
+        belt_velocity = config.belt_velocity
+        if cell_registry.default:  # the belt distance of a configured cell comes from the cells file
+            desired_distance = job_scheduler.belt_distance = config.belt_distance
+        job_scheduler.tracker.configure(config)
+        job_queue.sequencer.configure(config)
+        historian.retention = config.history_retention
+        historian.max_bytes = config.history_max_bytes
+        publisher.configure(config)
+    config.add_listener(config_reloaded)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload_configuration())
+
+    # prometheus endpoint of the latency histograms and counters
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    # thread dump, profiler and object census for a stalled controller
+    from diagnostics import diagnostics
+    diagnostics.configure(config)
+    if config.diagnostics_port:
+        diagnostics.start_http_server(config.diagnostics_port)
+
+    # telemetry to the data stack - batched, spilled to disk while the adapter is down
+    from telemetry import TelemetryExporter
+    telemetry = TelemetryExporter(global_url_opcua_adapter, cell.spill_path)
+    state_cache.add_listener(telemetry.state_listener)
+    telemetry.start()
 
     while not keyboardint:
         ###############   START SERVER   ###############
@@ -578,12 +714,13 @@ if __name__ == "__main__":
         try:
             # check if server is really running by setting one of the variables
             global_demonstrator_busy.set_value(True)
+            demonstrator_busy_output.reset()
         except:
 
             try:
                 logger.debug("Server not running?")
                 server.start()
-                logger.debug("OPC-UA - Master - Server started at {}".format(url))
+                logger.debug("OPC-UA - Master - Server started at %s", url)
             except:
                 logger.debug("killing and restarting server")
                 # server has a problem, so kill it and try again
@@ -591,39 +728,9 @@ if __name__ == "__main__":
                 server.start()
 
 
-        time.sleep(0.3)
-        #### CONNECT TO FH SERVER INSIDE A SEPARATE THREAD ####
-        fh_connection_thread = threading.Thread(name='threaded_fh_connection', target=threaded_fh_connection, args=(), )
-        fh_connection_thread.daemon = True
-        fh_connection_thread.start()
-        time.sleep(0.3)
-
-        #### CONNECT TO PANDA SERVER INSIDE A SEPARATE THREAD ####
-        panda_connection_thread = threading.Thread(name='threaded_fh_connection', target=threaded_panda_connection, args=(), )
-        panda_connection_thread.daemon = True
-        panda_connection_thread.start()
-        time.sleep(0.3)
-
-        #### CONNECT TO PIXTEND SERVER INSIDE A SEPARATE THREAD ####
-        pixtend_connection_thread = threading.Thread(name='threaded_fh_connection', target=threaded_pixtend_connection, args=(), )
-        pixtend_connection_thread.daemon = True
-        pixtend_connection_thread.start()
-
-
         ###############  CHRIS' DATASTACK  ###############
-        try:
-
-            # Sending changed states to kafka stack
-            tm = datetime.utcnow().replace(tzinfo=pytz.UTC).isoformat()
-            # r1 = requests.post(url_opcua_adapter,data={'id': 'pandapc.panda_state', 'timestamp': tm, 'panda_state': panda_state})
-            # r2 = requests.post(url_opcua_adapter, data={'id': 'pixtend.conbelt_state', 'timestamp': tm, 'conbelt_state': conbelt_state})
-            # r3 = requests.post(url_opcua_adapter, data={'id': 'pixtend.conbelt_dist', 'timestamp': tm, 'conbelt_dist': conbelt_dist})
-
-            ########################### RUNNNING LOOP ##############################
-            # logger.debug("Starting and running...")
-
-        except requests.exceptions.ConnectionError:
-            logger.debug("Catched Exception: requests - connection to data stack")
+        # panda_state, conbelt_state and conbelt_dist are sent to the kafka stack by the telemetry exporter,
+        # fed by the subscriptions of the state cache - see telemetry.py
 
 
 
@@ -631,33 +738,50 @@ if __name__ == "__main__":
         logger.debug("Going into server loop")
         while True:
 
-            time.sleep(0.5)
+            time.sleep(config.loop_interval)
 
             try:
-                # Every x seconds a message that the server is still running - could be irritating in the log file otherwise
-                if notification_counter > 10:
+                # Each minute a message that the server is still running - could be irritating in the log file otherwise
+                if time.time() - last_notification >= 60:
                     logger.debug("server: running")
-                    notification_counter = 0
+                    last_notification = time.time()
                 notification_counter = notification_counter + 1
 
+                # ServerTime once a second - every write wakes the subscribed clients
+                if notification_counter % 2 == 0:
+                    server_time.set_value(datetime.utcnow())
+
+                # mirror the metrics into the Diagnostics object - every 2 seconds is enough. Guarded on its own, a
+                # failing status must not mark the demonstrator busy below
+                if notification_counter % 4 == 0:
+                    try:
+                        publish_diagnostics()
+                    except Exception as e:
+                        logger.debug("server: diagnostics Catched Exception: %s", e, extra={"throttle": True})
+
                 # logger.debug("panda moving: " + str(global_panda_moving.get_value()) + ". belt_moving: " + str(global_belt_moving.get_value()))
                 # logger.debug("global_panda_moving: " + str(global_panda_moving.get_value()) + ". global_belt_moving: " + str(global_belt_moving.get_value()))
 
-                if global_panda_moving.get_value() is True or global_belt_moving.get_value() is True:
-                    global_object_pixtend.call_method("2:SwitchBusyLight", True)  # switch the alarm light to red - means the demonstrator is working
-                    global_demonstrator_busy.set_value(True)
-                else:
-                    global_object_pixtend.call_method("2:SwitchBusyLight", False)  # switch the alarm light to green - means the demonstrator is not working
-                    global_demonstrator_busy.set_value(False)
+                # values come from the subscriptions - no reads on the device servers
+                panda_moving = state_cache.get("RobotMoving")
+                belt_moving = state_cache.get("ConBeltMoving")
+                if panda_moving is None or belt_moving is None:
+                    raise ConnectionError("state of panda or belt unknown")
+
+                # only edges are written - the light is switched red/green when the demonstrator starts/stops working
+                busy = panda_moving is True or belt_moving is True or bool(job_queue.jobs())
+                demonstrator_busy_output.set(busy)
+                busy_light_output.set(busy)
 
                 # logger.debug("global_demonstrator busy: " + str(global_demonstrator_busy.get_value()))
 
 
             except Exception as e:
-                logger.debug("server: Catched Exception: " + str(e))
-                global_demonstrator_busy.set_value(True)
+                logger.debug("server: Catched Exception: %s", e, extra={"throttle": True})
+                demonstrator_busy_output.set(True)
 
-                logger.debug("server: it seems, that one of the clients is disconnected - waiting 5 seconds")
+                logger.debug("server: it seems, that one of the clients is disconnected - waiting 5 seconds",
+                             extra={"throttle": True})
                 time.sleep(5)
 
 
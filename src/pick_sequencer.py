@@ -0,0 +1,157 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Pick sequencer of the DTZ Master Controller
+#   The robot starts every pick where the previous one ended, so with several shelf requests queued the order decides
+#   how far it travels. The next job is chosen among the oldest pick_window queued jobs: the one which starts the
+#   cheapest order of these jobs. A job is overtaken at most pick_window - 1 times, then it is next - so no request
+#   waits forever. pick_window 1 is the plain FIFO.
+#   The cost of a move from shelf a to shelf b is learned from the measured robot moves (command -> robot stopped):
+#   the mean of the recent moves of the pair, or - for pairs seen too rarely - base + per_cell * grid distance,
+#   fitted over all measured moves. Until the moves show that the distance matters, the queue stays FIFO.
+#   Picks, reordered picks and the estimated robot travel saved against FIFO are published as JSON in the variable
+#   Jobs/Sequencer.
+#
+#   [1][2][3]
+#   [4][5][6]
+#   [7][8][9]
+
+from shelf_storage import grid_distance
+from metrics import metrics
+import collections
+import itertools
+import threading
+import logging
+
+logger = logging.getLogger('dtz_master_controller')
+
+MAX_LOOKAHEAD = 6  # 720 orders - the window may be larger, only its oldest jobs are ordered
+
+
+class PickSequencer(object):
+    """
+    Chooses the next job of the queue. Thread safe, called by JobQueue.next()
+    """
+
+    def __init__(self, window=3, samples=20, min_samples=3, min_gain=0.2):
+        self.window = window
+        self.samples = samples  # recent moves per pair
+        self.min_samples = min_samples  # moves of a pair until its mean is used
+        self.min_gain = min_gain  # seconds an order has to save to overtake a job
+        self.position = None  # shelf of the last finished robot move, None if unknown
+        self.last = None  # shelf of the last chosen job - the robot is there when the next job starts
+        self.picks = 0
+        self.reordered = 0
+        self.saved = 0.0  # estimated seconds of robot travel saved against the FIFO order of the window
+        self._lock = threading.Lock()
+        self._moves = {}  # (from shelf, to shelf) -> deque of seconds
+        self._model = None  # (base, per_cell) of the fitted prior
+
+    def configure(self, config):
+        """
+        Window from the configuration - called again after a reload
+        """
+        self.window = config.pick_window
+        return self
+
+    ############# COST MODEL #############
+    def record(self, shelf, seconds):
+        """
+        A robot move to shelf ended after seconds. shelf None if the move failed - the position is unknown then
+        """
+        with self._lock:
+            if shelf is not None and self.position is not None:
+                pair = (self.position, shelf)
+                self._moves.setdefault(pair, collections.deque(maxlen=self.samples)).append(seconds)
+                self._model = None
+            self.position = shelf
+
+    def _fit(self):
+        # least squares of seconds = base + per_cell * distance over all moves, None without two distances
+        points = [(grid_distance(a, b), seconds) for (a, b), moves in self._moves.items() for seconds in moves]
+        if len(points) < self.min_samples or len(set(distance for distance, _ in points)) < 2:
+            return None
+        n = float(len(points))
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        per_cell = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x, _ in points)
+        per_cell = max(per_cell, 0.0)  # a longer way is never faster
+        return mean_y - per_cell * mean_x, per_cell
+
+    def cost(self, shelf_a, shelf_b):
+        """
+        Expected seconds of the robot move from shelf_a to shelf_b, None if nothing was learned yet
+        """
+        if shelf_a is None:
+            return None
+        moves = self._moves.get((shelf_a, shelf_b))
+        if moves is not None and len(moves) >= self.min_samples:
+            return sum(moves) / len(moves)
+        if self._model is None:
+            self._model = self._fit() or False
+        if not self._model:
+            return None
+        base, per_cell = self._model
+        return base + per_cell * grid_distance(shelf_a, shelf_b)
+
+    def _order_cost(self, start, shelves):
+        total = 0.0
+        for shelf in shelves:
+            step = self.cost(start, shelf)
+            if step is None:
+                return None
+            total += step
+            start = shelf
+        return total
+
+    ############# SEQUENCE #############
+    def choose(self, pending):
+        """
+        Index of the next job in pending (oldest first). Counts the overtaken jobs on the jobs
+        """
+        with self._lock:
+            index, gain = self._choose(pending)
+            self.picks += 1
+            if index:
+                self.reordered += 1
+                self.saved += gain
+            for job in pending[:index]:
+                job.overtaken += 1
+            self.last = pending[index].shelf
+        if index:
+            metrics.inc("dtz_pick_sequence_total", result="reordered")
+            logger.debug("sequencer: %s before %s - %.1f seconds less travel", pending[index],
+                         ", ".join(str(job) for job in pending[:index]), gain)
+        else:
+            metrics.inc("dtz_pick_sequence_total", result="fifo")
+        return index
+
+    def _choose(self, pending):
+        # (index, estimated seconds saved by the order)
+        candidates = pending[:min(self.window, MAX_LOOKAHEAD)]
+        if len(candidates) < 2:
+            return 0, 0.0
+        for index, job in enumerate(candidates):
+            if job.overtaken >= self.window - 1:
+                return index, 0.0  # fairness - this one waited long enough
+        fifo = self._order_cost(self.last, [job.shelf for job in candidates])
+        if fifo is None:
+            return 0, 0.0
+        best, best_index = fifo, 0
+        for order in itertools.permutations(range(len(candidates))):
+            total = self._order_cost(self.last, [candidates[i].shelf for i in order])
+            if total < best - 1e-9:
+                best, best_index = total, order[0]
+        if fifo - best < self.min_gain:
+            return 0, 0.0
+        # the rest of the order is decided again with the next pick
+        return best_index, fifo - best
+
+    def status(self):
+        """
+        {"window": 3, "picks": n, "reordered": n, "saved_seconds": seconds, "pairs": n, "model": {...} or None}
+        """
+        with self._lock:
+            model = self._model if self._model is not None else self._fit()
+            return {"window": self.window, "picks": self.picks, "reordered": self.reordered,
+                    "saved_seconds": round(self.saved, 1), "pairs": len(self._moves),
+                    "model": {"base": round(model[0], 3), "per_cell": round(model[1], 3)} if model else None}
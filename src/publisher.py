@@ -0,0 +1,166 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Publisher of the DTZMasterController address space
+#   Every write to a variable of the master server wakes all clients subscribed to it, so the variables are only
+#   written on real changes: a number within the deadband of the last written value is no change, and a variable
+#   is written at most every interval seconds - a change in between is held back and written by flush(), only the
+#   latest value. Status aggregates the device state, the queue and the connections into one JSON object, a client
+#   which wants to follow the demonstrator subscribes to this one variable.
+#
+#   Status: {"DemonstratorBusy": false, "RobotMoving": false, "RobotState": "...", "ConBeltMoving": false,
+#            "ConBeltState": "...", "ConBeltDist": 0.55, "QueueDepth": 0, "Connections": {"panda": "connected", ...}}
+#   An invalid FHS request adds "Rejected": {"Shelf": 12, "Error": "Error - invalid shelf"}, the last one rejected.
+
+from session_pool import EdgeOutput
+from metrics import metrics
+import fnmatch
+import threading
+import logging
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+STATUS = "Status"
+
+
+def differs(old, new, deadband=0.0):
+    """
+    True if new is a change of old - numbers within the deadband are no change. The deadband of a dict is
+    per field ({"ConBeltDist": 0.001}) or the same for all fields
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        if set(old) != set(new):
+            return True
+        return any(differs(old[key], new[key], deadband.get(key, 0.0) if isinstance(deadband, dict) else deadband)
+                   for key in new)
+    numbers = (int, float)
+    if deadband and isinstance(old, numbers) and isinstance(new, numbers) and not isinstance(old, bool) \
+            and not isinstance(new, bool):
+        return abs(new - old) > deadband
+    return old != new
+
+
+def initial_status(state_values):
+    return dict(state_values, DemonstratorBusy=False, QueueDepth=0, Connections={})
+
+
+class PublishedVariable(EdgeOutput):
+    """
+    A variable of the master server. write(value) sets the node, value is the value it was created with
+    """
+
+    def __init__(self, name, write, value=None, deadband=0.0, interval=0.0):
+        EdgeOutput.__init__(self, name, write)
+        self.value = value
+        self.deadband = deadband
+        self.interval = interval
+        self.written = 0.0
+        self.held = False
+        self.pending = None
+
+    def set(self, value, now=None):
+        """
+        Returns True if the value was written, False if it was unchanged or is held back
+        """
+        with self._lock:
+            result = self._offer(value, time.time() if now is None else now)
+        metrics.inc("dtz_output_writes_total", output=self.name, result=result)
+        return result == "written"
+
+    def merge(self, fields, now=None):
+        """
+        set() of a dict value with some fields changed
+        """
+        with self._lock:
+            value = dict(self.pending if self.held else self.value or {}, **fields)
+            result = self._offer(value, time.time() if now is None else now)
+        metrics.inc("dtz_output_writes_total", output=self.name, result=result)
+        return result == "written"
+
+    def _offer(self, value, now):
+        if not differs(self.value, value, self.deadband):
+            self.held = False  # back at the written value before the interval passed
+            return "skipped"
+        if now - self.written < self.interval:
+            self.held, self.pending = True, value
+            return "held"
+        self._write(value, now)
+        return "written"
+
+    def flush(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self.held or now - self.written < self.interval:
+                return False
+            self._write(self.pending, now)
+        metrics.inc("dtz_output_writes_total", output=self.name, result="written")
+        return True
+
+    def _write(self, value, now):
+        self.write(value)
+        self.value = value
+        self.written = now
+        self.held, self.pending = False, None
+
+
+class Publisher(object):
+    """
+    The published variables by name (State/RobotMoving, Status, <cell>/Status, ...). Deadband and interval of a
+    variable come from the first matching rule
+    """
+
+    def __init__(self, resolution=0.1):
+        self.resolution = resolution  # seconds between two flushes of the held values
+        self.rules = []  # (name pattern, deadband, interval)
+        self._variables = {}
+
+    def configure(self, config):
+        """
+        Rules from the configuration - called again after a reload
+        """
+        self.rules = [("*ConBeltDist", config.publish_deadband, config.publish_interval),
+                      (STATUS, {"ConBeltDist": config.publish_deadband}, config.publish_interval),
+                      ("*/" + STATUS, {"ConBeltDist": config.publish_deadband}, config.publish_interval)]
+        for variable in self._variables.values():
+            variable.deadband, variable.interval = self.rule(variable.name)
+        return self
+
+    def rule(self, name):
+        for pattern, deadband, interval in self.rules:
+            if fnmatch.fnmatchcase(name, pattern):
+                return deadband, interval
+        return 0.0, 0.0
+
+    def add(self, name, write, value=None):
+        deadband, interval = self.rule(name)
+        variable = self._variables[name] = PublishedVariable(name, write, value, deadband, interval)
+        return variable
+
+    def get(self, name):
+        return self._variables[name]
+
+    def set(self, name, value):
+        return self._variables[name].set(value)
+
+    def merge(self, name, **fields):
+        return self._variables[name].merge(fields)
+
+    def flush(self):
+        now = time.time()
+        for variable in list(self._variables.values()):
+            if variable.held:
+                variable.flush(now)
+
+    def start(self):
+        publisher_thread = threading.Thread(name='publisher_thread', target=self.run)
+        publisher_thread.daemon = True
+        publisher_thread.start()
+        return publisher_thread
+
+    def run(self):
+        while True:
+            time.sleep(self.resolution)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.debug("publisher: Catched Exception: %s", e)
@@ -0,0 +1,320 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Replay of a traffic capture of the DTZ Master Controller (see traffic_capture.py)
+#   Stands in for the Panda, the PiXtend and the FHS PLC of the capture on the ports of the simulators - the nodes
+#   are those of simulators.py, the behaviour is the recorded one:
+#     - a method call returns the recorded result (or status error) after the recorded latency. The n-th call of a
+#       method gets the n-th recorded call, the notifications which followed it on the same device until its next
+#       call (robot or belt moving, state, distance) are played with their recorded delays after the call
+#     - notifications without a preceding call - the FHS requests - are played at their recorded time after the
+#       controller subscribed to the device
+#     - the values the controller read after a call or notification (e.g. ShelfNumber) are set before it
+#   --speed divides all delays: 10 replays an hour in six minutes. Only the device side is replayed - requests of
+#   the clients of the master server (MoveDemonstrator) are not part of the capture. Lost sessions of the capture are
+#   not reproduced, --report shows them with the latencies of the requests and the durations of the motions.
+#
+#   DTZ_CAPTURE_PATH=dtz_capture python opc_ua_master.py    record the upstream traffic of the controller
+#   python replay.py dtz_capture [--speed 10] [--cell name]   stand in for the devices of the capture
+#   python opc_ua_master.py --simulate                        controller connected to the replay
+#   python replay.py dtz_capture --report                     latencies, errors and motions of the capture
+
+from opcua import ua, uamethod
+from simulators import SimulatedPanda, SimulatedPixtend, SimulatedFhs
+from traffic_capture import read_capture
+from benchmark import percentile
+from datetime import datetime
+import collections
+import threading
+import argparse
+import logging
+import heapq
+import time
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+ENDPOINTS = ("panda", "pixtend", "fhs")
+
+
+class Trigger(object):
+    """
+    A recorded method call or a notification without a preceding call, with what followed it on the same device
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.time = record.time
+        self.reads = []  # (key, value) read by the controller after it
+        self.changes = []  # (seconds after it, key, value) of the following notifications
+
+
+class Script(object):
+    """
+    What one device did in the capture
+    """
+
+    def __init__(self, records, endpoint):
+        self.endpoint = endpoint
+        self.initial = {}  # key -> value of the first notification or read
+        self.external = []  # triggers of the notifications without a preceding call
+        self.calls = collections.OrderedDict()  # (object key, method) -> [triggers]
+        self.origin = None  # time of the first connect
+        last_call = None
+        last = None
+        subscribed = set()  # keys of the initial notification after a connect
+        for record in records:
+            if record.endpoint != endpoint:
+                continue
+            if self.origin is None:
+                self.origin = record.time
+            if record.op == "connect":
+                subscribed = set()
+            elif record.op == "call":
+                last = last_call = Trigger(record)
+                self.calls.setdefault(tuple(record.target[:2]), []).append(last_call)
+            elif record.op == "datachange":
+                if record.target not in subscribed:
+                    # the current value, sent by the server when the controller subscribed
+                    subscribed.add(record.target)
+                    self.initial.setdefault(record.target, record.value)
+                elif last_call is not None:
+                    last_call.changes.append((record.time - last_call.time, record.target, record.value))
+                else:
+                    last = Trigger(record)
+                    self.external.append(last)
+            elif record.op in ("read", "read_many") and record.error is None:
+                pairs = [(record.target, record.value)] if record.op == "read" else zip(record.target, record.value)
+                for key, value in pairs:
+                    if last is None:
+                        self.initial.setdefault(key, value)
+                    else:
+                        last.reads.append((key, value))
+
+
+class Timeline(object):
+    """
+    Sets node values at their time - one thread for all devices
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._sequence = 0
+
+    def schedule(self, due, action, *args):
+        with self._cond:
+            self._sequence += 1
+            heapq.heappush(self._heap, (due, self._sequence, action, args))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, action, args = heapq.heappop(self._heap)
+            try:
+                action(*args)
+            except Exception as e:
+                logger.debug("replay: Catched Exception: %s", e)
+
+    def start(self):
+        timeline_thread = threading.Thread(name='replay_timeline_thread', target=self.run)
+        timeline_thread.daemon = True
+        timeline_thread.start()
+        return timeline_thread
+
+
+class ReplayDevice(object):
+    """
+    A simulated device whose methods and notifications follow the script
+    """
+
+    def __init__(self, device, nodes, script, timeline, speed=1.0):
+        self.device = device
+        self.nodes = nodes  # key -> variable node
+        self.script = script
+        self.timeline = timeline
+        self.speed = speed
+        self.replayed = collections.Counter()
+        self.differing = 0  # calls with other arguments than in the capture
+        self.beyond = 0  # calls after the last recorded one
+        self._cursors = collections.Counter()
+        self._lock = threading.Lock()
+        for (key, method), triggers in script.calls.items():
+            try:
+                node = device.objects.get_child(["{}:{}".format(device.idx, key), method])
+            except ua.UaStatusCodeError:
+                logger.error("replay: %s has no method %s %s - not replayed", script.endpoint, key, method)
+                continue
+            device.server.link_method(node, uamethod(self._method(key, method)))
+        for key, value in script.initial.items():
+            self.set(key, value)
+
+    def set(self, key, value):
+        node = self.nodes.get(key)
+        if node is None or value is None:
+            return
+        node.set_value(value)
+
+    def _method(self, key, method):
+        def call(parent, *args):
+            with self._lock:
+                triggers = self.script.calls[(key, method)]
+                index = self._cursors[(key, method)]
+                self._cursors[(key, method)] += 1
+            if index >= len(triggers):
+                self.beyond += 1
+                logger.debug("replay: %s %s called more often than in the capture", self.script.endpoint, method)
+                return True
+            trigger = triggers[index]
+            if list(args) != trigger.record.target[2:]:
+                self.differing += 1
+                logger.debug("replay: %s %s%s - %s in the capture", self.script.endpoint, method, list(args),
+                             trigger.record.target[2:])
+            self.replayed[method] += 1
+            self.fire(trigger, time.time())
+            time.sleep(trigger.record.duration / self.speed)
+            if trigger.record.error is not None:
+                raise ua.UaStatusCodeError(trigger.record.error[0] or ua.StatusCodes.BadCommunicationError)
+            return trigger.record.value
+        return call
+
+    def fire(self, trigger, now):
+        for key, value in trigger.reads:
+            self.set(key, value)
+        if trigger.record.op == "datachange":
+            self.set(trigger.record.target, trigger.record.value)
+            self.replayed[trigger.record.target] += 1
+        for offset, key, value in trigger.changes:
+            self.timeline.schedule(now + offset / self.speed, self.set, key, value)
+
+    def subscribed(self):
+        return bool(self.device.server.iserver.subscription_service.subscriptions)
+
+    def start(self):
+        """
+        Play the notifications without a preceding call once the controller subscribed
+        """
+        def run():
+            while not self.subscribed():
+                time.sleep(0.01)
+            origin = time.time()
+            logger.debug("replay: %s subscribed - %s notifications to play", self.script.endpoint,
+                         len(self.script.external))
+            for trigger in self.script.external:
+                self.timeline.schedule(origin + (trigger.time - self.script.origin) / self.speed, self.fire,
+                                       trigger, origin + (trigger.time - self.script.origin) / self.speed)
+            if self.script.external:
+                end = origin + (self.script.external[-1].time - self.script.origin) / self.speed
+                self.timeline.schedule(end, logger.debug, "replay: last notification of %s played",
+                                       self.script.endpoint)
+        replay_thread = threading.Thread(name='{}_replay_thread'.format(self.script.endpoint), target=run)
+        replay_thread.daemon = True
+        replay_thread.start()
+        return replay_thread
+
+
+def start_replay(records, speed=1.0, prefix=""):
+    """
+    Start the three devices of the capture on the ports of the simulators
+    """
+    timeline = Timeline()
+    timeline.start()
+    panda = SimulatedPanda()
+    pixtend = SimulatedPixtend()
+    fhs = SimulatedFhs()
+    nodes = {
+        "panda": {"RobotMoving": panda.robot_moving, "RobotState": panda.robot_state},
+        "pixtend": {"ConBeltMoving": pixtend.belt_moving, "ConBeltState": pixtend.belt_state,
+                    "ConBeltDist": pixtend.belt_dist, "BusyLight": pixtend.busy_light},
+        "fhs": {"ShelfNumber": fhs.shelf_number, "NewValAvailable": fhs.new_val_available,
+                "TaskRunning": fhs.task_running},
+    }
+    devices = []
+    for name, device in zip(ENDPOINTS, (panda, pixtend, fhs)):
+        replay = ReplayDevice(device, nodes[name], Script(records, prefix + name), timeline, speed)
+        device.start()
+        replay.start()
+        devices.append(replay)
+    return devices
+
+
+def report(path, start, records):
+    """
+    Latencies of the requests, errors, lost sessions and durations of the motions
+    """
+    duration = records[-1].time if records else 0.0
+    print("capture {}: {}, {:.1f} seconds, {} records, {} bytes".format(
+        path, datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"), duration, len(records),
+        os.path.getsize(path)))
+    print()
+    print("{:<16} {:<11} {:>7} {:>7} {:>9} {:>9} {:>9}".format("endpoint", "op", "count", "errors", "p50 ms",
+                                                                 "p99 ms", "max ms"))
+    requests = collections.OrderedDict()
+    for record in records:
+        if record.op != "datachange":
+            requests.setdefault((record.endpoint, record.op), []).append(record)
+    for (endpoint, op), group in sorted(requests.items()):
+        latencies = [record.duration * 1000 for record in group]
+        print("{:<16} {:<11} {:>7} {:>7} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            endpoint, op, len(group), sum(1 for record in group if record.error is not None),
+            percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies)))
+
+    print()
+    print("{:<16} {:<24} {:>7} {:>11} {:>11}".format("endpoint", "motion", "count", "p50 s", "max s"))
+    for endpoint in sorted(set(record.endpoint for record in records)):
+        for (key, method), triggers in Script(records, endpoint).calls.items():
+            # from the call to the last notification before the next call of the device
+            motions = [trigger.changes[-1][0] for trigger in triggers if trigger.changes]
+            if motions:
+                print("{:<16} {:<24} {:>7} {:>11.2f} {:>11.2f}".format(endpoint, method, len(motions),
+                                                                     percentile(motions, 0.5), max(motions)))
+
+    problems = [record for record in records if record.error is not None or record.op == "disconnect"]
+    if problems:
+        print()
+        print("errors and lost sessions")
+        for record in problems[:50]:
+            print("  {:>10.3f} s  {:<16} {:<11} {} {}".format(record.time, record.endpoint, record.op,
+                                                              record.target, record.error[1] if record.error else ""))
+
+    slowest = sorted((record for record in records if record.op != "datachange"), key=lambda r: -r.duration)[:10]
+    if slowest:
+        print()
+        print("slowest requests")
+        for record in slowest:
+            print("  {:>10.3f} s  {:<16} {:<11} {:>9.1f} ms  {}".format(record.time, record.endpoint, record.op,
+                                                                       record.duration * 1000, record.target))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay of a traffic capture of the DTZ Master Controller")
+    parser.add_argument("capture", help="file written with capture_path (DTZ_CAPTURE_PATH)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = recorded timing, 10 = ten times faster")
+    parser.add_argument("--cell", default=None, help="cell of a capture with several cells")
+    parser.add_argument("--report", action="store_true", help="print latencies, errors and motions and exit")
+    args = parser.parse_args()
+
+    start, records = read_capture(args.capture)
+    if args.report:
+        report(args.capture, start, records)
+        return
+
+    logging.basicConfig(level=logging.DEBUG)
+    logging.getLogger("opcua").setLevel(logging.WARNING)
+    devices = start_replay(records, args.speed, "{}/".format(args.cell) if args.cell else "")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for replay in devices:
+            logger.info("replay: %s replayed %s, %s calls with other arguments, %s beyond the capture",
+                        replay.script.endpoint, dict(replay.replayed), replay.differing, replay.beyond)
+            replay.device.stop()
+
+
+if __name__ == "__main__":
+    main()
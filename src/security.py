@@ -0,0 +1,231 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Secure channels of the DTZ Master Controller
+#   Basic256Sha256 with Sign or SignAndEncrypt for the master server (server_security) and for the sessions to the
+#   devices (upstream_security). One application instance certificate with its private key (certificate,
+#   private_key - DER or PEM) serves both sides. Both are read and parsed once at startup. The certificate of a
+#   device is taken from its endpoint list on the first connect and kept for the reconnects. So a reconnect is one
+#   OpenSecureChannel with the cached objects - no file access, no extra GetEndpoints connection. A failed connect
+#   drops the cached device certificate, a renewed one is fetched with the next attempt.
+#   The channel token expires after channel_lifetime seconds. The client libraries renew it in the background while
+#   the session stays open (python-opcua at 70% of it, asyncua at 75%). The sessions are long-lived
+#   (session_pool.py), so the asymmetric handshake is paid once per connect and not per event - see
+#   "python benchmark.py --security-cost".
+#
+#   python security.py cert.der key.pem [--uri urn:dtz:master_controller]   self-signed certificate for a test setup
+
+from opcua import Client, ua
+from opcua.crypto.security_policies import SecurityPolicyBasic256Sha256
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import threading
+import argparse
+import datetime
+import logging
+import socket
+
+logger = logging.getLogger('dtz_master_controller')
+
+MODES = ("None", "Sign", "SignAndEncrypt")
+DEFAULT_URI = "urn:dtz:master_controller"
+
+
+class SecurityError(ValueError):
+    """
+    Raised for a certificate or private key which cannot be read
+    """
+    pass
+
+
+def load_certificate(path):
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    if data.lstrip().startswith(b"-----BEGIN"):
+        return x509.load_pem_x509_certificate(data)
+    return x509.load_der_x509_certificate(data)
+
+
+def load_private_key(path):
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    if data.lstrip().startswith(b"-----BEGIN"):
+        return serialization.load_pem_private_key(data, password=None)
+    return serialization.load_der_private_key(data, password=None)
+
+
+def application_uri(certificate):
+    """
+    URI of the subject alternative names - the application URI of server and client has to match it
+    """
+    try:
+        names = certificate.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return None
+    uris = names.get_values_for_type(x509.UniformResourceIdentifier)
+    return uris[0] if uris else None
+
+
+class Credentials(object):
+    """
+    Certificate and private key of the controller, parsed once, and the certificates of the devices
+    """
+
+    def __init__(self, certificate_path, private_key_path, server_security="None", upstream_security="None",
+                 channel_lifetime=3600.0):
+        try:
+            self.certificate = load_certificate(certificate_path)
+            self.private_key = load_private_key(private_key_path)
+        except (IOError, OSError, ValueError) as e:
+            raise SecurityError("certificate {} / private key {}: {}".format(certificate_path, private_key_path, e))
+        self.application_uri = application_uri(self.certificate)
+        self.server_security = server_security
+        self.upstream_security = upstream_security
+        self.channel_lifetime = channel_lifetime
+        self._peers = {}  # url -> certificate of the device
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        None if neither the master server nor the upstream sessions are secured
+        """
+        if config.server_security == "None" and config.upstream_security == "None":
+            return None
+        return cls(config.certificate, config.private_key, config.server_security, config.upstream_security,
+                   config.channel_lifetime)
+
+    def forget(self, url):
+        """
+        Drop the cached certificate of a device, e.g. after a failed connect - it is fetched again
+        """
+        with self._lock:
+            self._peers.pop(url, None)
+
+    ############# UPSTREAM SESSIONS #############
+    def secure_client(self, client, url):
+        """
+        Set up a python-opcua client before its connect()
+        """
+        if self.upstream_security == "None":
+            return client
+        mode = getattr(ua.MessageSecurityMode, self.upstream_security)
+        with self._lock:
+            peer = self._peers.get(url)
+        if peer is None:
+            endpoint = Client.find_endpoint(client.connect_and_get_server_endpoints(), mode,
+                                            SecurityPolicyBasic256Sha256.URI)
+            peer = x509.load_der_x509_certificate(endpoint.ServerCertificate)
+            with self._lock:
+                self._peers[url] = peer
+            logger.debug("security: certificate of %s: %s", url, peer.subject.rfc4514_string())
+        if self.application_uri:
+            client.application_uri = self.application_uri
+        client.secure_channel_timeout = int(self.channel_lifetime * 1000)
+        client.security_policy = SecurityPolicyBasic256Sha256(peer, self.certificate, self.private_key, mode)
+        client.uaclient.set_security(client.security_policy)
+        return client
+
+    async def secure_async_client(self, client, url):
+        """
+        Set up an asyncua client before its connect()
+        """
+        from asyncua import Client as AsyncClient, ua as async_ua
+        from asyncua.crypto import security_policies
+        if self.upstream_security == "None":
+            return client
+        mode = getattr(async_ua.MessageSecurityMode, self.upstream_security)
+        with self._lock:
+            peer = self._peers.get(url)
+        if peer is None:
+            endpoint = AsyncClient.find_endpoint(await client.connect_and_get_server_endpoints(), mode,
+                                                 security_policies.SecurityPolicyBasic256Sha256.URI)
+            peer = x509.load_der_x509_certificate(endpoint.ServerCertificate)
+            with self._lock:
+                self._peers[url] = peer
+            logger.debug("security: certificate of %s: %s", url, peer.subject.rfc4514_string())
+        if self.application_uri:
+            client.application_uri = self.application_uri
+        client.secure_channel_timeout = int(self.channel_lifetime * 1000)
+        client.security_policy = security_policies.SecurityPolicyBasic256Sha256(peer, self.certificate,
+                                                                               self.private_key, mode)
+        client.uaclient.set_security(client.security_policy)
+        return client
+
+    ############# MASTER SERVER #############
+    def _policies(self, policy_types, modes):
+        modes = modes or [self.server_security]
+        return [policy_types.NoSecurity if mode == "None" else getattr(policy_types, "Basic256Sha256_" + mode)
+                for mode in modes]
+
+    def secure_server(self, server, modes=None):
+        """
+        Set up a python-opcua server before its start(). modes - the offered ones, default server_security
+        """
+        server.certificate = self.certificate
+        server.private_key = self.private_key
+        if self.application_uri:
+            server.set_application_uri(self.application_uri)
+        server.set_security_policy(self._policies(ua.SecurityPolicyType, modes))
+        return server
+
+    async def secure_async_server(self, server, modes=None):
+        """
+        Set up an asyncua server after its init(), before its start()
+        """
+        from asyncua import ua as async_ua
+        server.iserver.certificate = self.certificate
+        server.iserver.private_key = self.private_key
+        if self.application_uri:
+            await server.set_application_uri(self.application_uri)
+        server.set_security_policy(self._policies(async_ua.SecurityPolicyType, modes))
+        return server
+
+
+def generate_certificate(certificate_path, private_key_path, uri=DEFAULT_URI, days=3650):
+    """
+    Self-signed application instance certificate (DER) and its private key (PEM)
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    hostname = socket.gethostname()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "DTZ Master Controller {}".format(hostname)),
+                      x509.NameAttribute(NameOID.ORGANIZATION_NAME, "Salzburg Research")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(name).public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=days))
+                   .add_extension(x509.SubjectAlternativeName([x509.UniformResourceIdentifier(uri),
+                                                               x509.DNSName(hostname)]), critical=False)
+                   .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+                   .add_extension(x509.KeyUsage(digital_signature=True, content_commitment=True,
+                                                key_encipherment=True, data_encipherment=True, key_agreement=False,
+                                                key_cert_sign=False, crl_sign=False, encipher_only=False,
+                                                decipher_only=False), critical=True)
+                   .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH,
+                                                         ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+                   .sign(key, hashes.SHA256()))
+    with open(certificate_path, "wb") as out_file:
+        out_file.write(certificate.public_bytes(serialization.Encoding.DER))
+    with open(private_key_path, "wb") as out_file:
+        out_file.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                         serialization.NoEncryption()))
+    return certificate_path, private_key_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Self-signed application instance certificate for a test setup")
+    parser.add_argument("certificate", help="certificate file to write (DER)")
+    parser.add_argument("private_key", help="private key file to write (PEM)")
+    parser.add_argument("--uri", default=DEFAULT_URI, help="application URI of the certificate")
+    parser.add_argument("--days", type=int, default=3650, help="validity in days")
+    args = parser.parse_args()
+    generate_certificate(args.certificate, args.private_key, args.uri, args.days)
+    print("{} and {} written - DTZ_CERTIFICATE={} DTZ_PRIVATE_KEY={}".format(
+        args.certificate, args.private_key, args.certificate, args.private_key))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Session pool of the DTZ Master Controller
+#   Keeps exactly one long-lived OPC UA client session per upstream server (Panda, PiXtend, FHS). The sessions are
+#   shared by the connection threads and the subscription handler, and hand out node handles which are resolved once
+#   per connect instead of on every datachange event. Every session has a circuit breaker: while the server is
+#   unreachable, or after repeated failing requests, node handles are refused at once instead of waiting for a timeout.
+#   Several nodes of one server are read with a single Read service call (read_many), outputs like the busy light are
+#   only written on a change of their value (EdgeOutput).
+#   All requests go through _request, which also feeds the traffic capture (see traffic_capture.py).
+#   With credentials (security.py) the sessions use a Basic256Sha256 secure channel - the handshake is paid once per
+#   connect of the long-lived session.
+
+from opcua import Client, ua
+from metrics import metrics
+from traffic_capture import recorder
+from node_cache import node_cache, browse_request, browse_results
+import threading
+import logging
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+
+class SessionNotConnected(Exception):
+    """
+    Raised when a node handle is requested from a session which is currently not connected
+    """
+    pass
+
+
+class CircuitOpen(SessionNotConnected):
+    """
+    Raised when the circuit breaker of a session is open - the device is known to be unreachable
+    """
+    pass
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+    """
+    Fail-fast guard of one endpoint. Open while there is no session, half-open during a reconnect attempt, closed
+    when connected. threshold failing requests in a row open it as well - the supervisor then drops the session
+    and reconnects. Request errors reported by the server itself (bad status codes) are no connection failures
+    """
+
+    def __init__(self, name, threshold=3):
+        self.name = name
+        self.threshold = threshold
+        self.state = OPEN  # not connected yet
+        self.failures = 0
+        self.reason = "not connected"
+        self.since = time.time()
+        self.tripped = threading.Event()  # opened by failing requests while connected
+        self._watch = None  # event set on a trip as well - the lost event of the current subscription handler
+
+    def _set(self, state, reason=""):
+        if state != self.state:
+            logger.debug("breaker: %s %s %s", self.name, state, reason)
+            self.state = state
+            self.since = time.time()
+        self.reason = reason
+
+    def allow(self):
+        return self.state == CLOSED
+
+    def check(self):
+        if self.state != CLOSED:
+            raise CircuitOpen("circuit of {} is {} - {}".format(self.name, self.state, self.reason))
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self, error=None):
+        self.failures += 1
+        if self.state == CLOSED and self.failures >= self.threshold:
+            self.trip("{} failing requests: {}".format(self.failures, error))
+
+    def trip(self, reason=""):
+        """
+        Open the breaker of a connected session - the supervisor drops the session and reconnects
+        """
+        self._set(OPEN, reason)
+        self.tripped.set()
+        if self._watch is not None:
+            self._watch.set()
+
+    def watch(self, event):
+        """
+        Set event as soon as the breaker trips - the supervisor waits on it instead of polling between heartbeats
+        """
+        self._watch = event
+        if self.tripped.is_set():
+            event.set()
+
+    def open(self, reason=""):
+        self._set(OPEN, reason)
+
+    def half_open(self):
+        self._set(HALF_OPEN, "reconnecting")
+
+    def close(self):
+        self.failures = 0
+        self.tripped.clear()
+        self._set(CLOSED)
+
+
+class PooledSession(object):
+    """
+    One long-lived client session to an upstream OPC UA server.
+    browse_paths maps a key to a browse path starting at the root node, e.g.
+    {"RobotMoving": ["0:Objects", "2:PandaRobot", "2:RobotMoving"]}, node_ids maps a key to a NodeId string,
+    e.g. {"ShelfNumber": "ns=6;s=::AsGlobalPV:ShelfNumber"}. All of them are resolved on connect.
+    """
+
+    def __init__(self, name, url, browse_paths=None, node_ids=None, timeout=4, credentials=None):
+        self.name = name
+        self.url = url
+        self.browse_paths = browse_paths or {}
+        self.node_ids = node_ids or {}
+        self.timeout = timeout
+        self.credentials = credentials
+        self.client = None
+        self.nodes = {}
+        self.connected = False
+        self.connect_count = 0
+        self.lock = threading.RLock()
+        self.breaker = CircuitBreaker(name)
+        self._state_node = None
+
+    def connect(self):
+        with self.lock:
+            if self.connected:
+                return self.client
+
+            client = Client(self.url, timeout=self.timeout)
+            start = recorder.start()
+            with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op="connect"):
+                try:
+                    if self.credentials is not None:
+                        self.credentials.secure_client(client, self.url)
+                    client.connect()
+                except Exception as e:
+                    recorder.record("connect", self.name, self.url, error=e, start=start)
+                    if self.credentials is not None:
+                        self.credentials.forget(self.url)
+                    raise
+            recorder.record("connect", self.name, self.url, start=start)
+            try:
+                with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op="browse"):
+                    nodes = self.resolve(client)
+            except Exception:
+                client.disconnect()
+                raise
+
+            self.client = client
+            self.nodes = nodes
+            self._state_node = client.get_node(ua.FourByteNodeId(ua.ObjectIds.Server_ServerStatus_State))
+            self.connected = True
+            self.connect_count += 1
+            self.breaker.close()
+            logger.debug("pool: session %s connected to %s", self.name, self.url)
+            return client
+
+    def resolve(self, client):
+        """
+        Resolve all configured node handles of this session - from the node cache if the namespace array of the
+        server is unchanged, otherwise with one batched TranslateBrowsePathsToNodeIds request
+        """
+        paths = list(self.browse_paths.values())
+        nodes = {}
+        if paths:
+            namespaces = client.get_namespace_array()
+            resolved = node_cache.lookup(self.url, namespaces, paths)
+            if resolved is None:
+                results = client.uaclient.translate_browsepaths_to_nodeids(browse_request(ua, paths))
+                resolved = browse_results(ua, paths, results)
+                node_cache.store(self.url, namespaces, resolved)
+            for key, path in self.browse_paths.items():
+                nodes[key] = client.get_node(resolved[tuple(path)])
+        for key, nodeid in self.node_ids.items():
+            nodes[key] = client.get_node(nodeid)
+        return nodes
+
+    def disconnect(self):
+        with self.lock:
+            client = self.client
+            self.connected = False
+            self.client = None
+            self.nodes = {}
+            self._state_node = None
+            self.breaker.open("disconnected")
+        if client is not None:
+            recorder.record("disconnect", self.name, self.url)
+            try:
+                client.disconnect()
+            except Exception as e:
+                logger.debug("pool: session %s disconnected with exception: %s", self.name, e)
+
+    def is_alive(self):
+        """
+        Health check - one read of the server state. A failing read marks the session as disconnected
+        """
+        if not self.connected:
+            return False
+        try:
+            with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op="read"):
+                return self._state_node.get_value() == ua.ServerState.Running
+        except Exception as e:
+            logger.debug("pool: health check of session %s failed: %s", self.name, e)
+            self.disconnect()
+            return False
+
+    def node(self, key):
+        nodes = self.nodes
+        if not self.connected or key not in nodes:
+            raise SessionNotConnected("session {} has no node {} - not connected".format(self.name, key))
+        self.breaker.check()
+        return nodes[key]
+
+    def _request(self, op, target, function, *args):
+        # target as recorded in the capture - the key(s), the written values or the called method with its args
+        start = recorder.start()
+        with metrics.timer("dtz_opcua_latency_seconds", server=self.name, op=op):
+            try:
+                result = function(*args)
+            except ua.UaStatusCodeError as e:
+                recorder.record(op, self.name, target, error=e, start=start)
+                self.breaker.record_success()  # the server answered
+                if e.code == ua.StatusCodes.BadNodeIdUnknown:
+                    # the address space of the server changed - resolve again with a new session
+                    node_cache.invalidate(self.url, str(e))
+                    self.breaker.trip("unknown node: {}".format(e))
+                raise
+            except Exception as e:
+                recorder.record(op, self.name, target, error=e, start=start)
+                self.breaker.record_failure(e)
+                raise
+        recorder.record(op, self.name, target, result, start=start)
+        self.breaker.record_success()
+        return result
+
+    def call(self, key, method, *args):
+        """
+        call_method on a resolved object - fails fast if the circuit is open
+        """
+        return self._request("call", [key, method] + list(args), self.node(key).call_method, method, *args)
+
+    def read(self, key):
+        return self._request("read", key, self.node(key).get_value)
+
+    def read_many(self, keys):
+        """
+        Values of several nodes in one Read service call - {key: value}
+        """
+        keys = list(keys)
+        client = self.client
+        nodes = [self.node(key) for key in keys]
+        return dict(zip(keys, self._request("read_many", keys, client.get_values, nodes)))
+
+
+class SessionPool(object):
+    """
+    Registry of all upstream sessions, one per endpoint
+    """
+
+    def __init__(self, credentials=None):
+        self.credentials = credentials  # see security.py - None for unsecured sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, url, browse_paths=None, node_ids=None, timeout=4):
+        with self._lock:
+            session = PooledSession(name, url, browse_paths, node_ids, timeout, self.credentials)
+            self._sessions[name] = session
+            return session
+
+    def get(self, name):
+        return self._sessions[name]
+
+    def node(self, name, key):
+        return self._sessions[name].node(key)
+
+    def sessions(self):
+        return list(self._sessions.values())
+
+    def close(self):
+        for session in self.sessions():
+            session.disconnect()
+
+
+class EdgeOutput(object):
+    """
+    An output which is only written when its value changes, e.g. the busy light of the PiXtend.
+    write(value) does the actual write, a failing write is repeated with the next set(). generation() - e.g. the
+    connect_count of the session - is compared on every set(): after a reconnect the device may have lost the
+    value, so it is written again
+    """
+
+    def __init__(self, name, write, generation=None):
+        self.name = name
+        self.write = write
+        self.generation = generation
+        self.value = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        """
+        Returns True if the value was written, False if it was unchanged
+        """
+        with self._lock:
+            generation = self.generation() if self.generation is not None else None
+            if value == self.value and generation == self._generation:
+                metrics.inc("dtz_output_writes_total", output=self.name, result="skipped")
+                return False
+            self.write(value)
+            self.value = value
+            self._generation = generation
+        metrics.inc("dtz_output_writes_total", output=self.name, result="written")
+        return True
+
+    def reset(self):
+        with self._lock:
+            self.value = None
@@ -0,0 +1,137 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Shelf storage of the DTZ Master Controller
+#   Occupancy of the 3x3 storage, kept in memory as a 9 bit mask. Every change is written back atomically
+#   (temporary file, fsync, rename), so the file survives a container restart in the middle of a write.
+#   The file format stays the same as before - one line per shelf, "1" = occupied, "0" = empty
+#
+#   [1][2][3]
+#   [4][5][6]
+#   [7][8][9]
+
+from metrics import metrics
+import threading
+import logging
+import math
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+SHELVES = 9
+COLUMNS = 3
+
+
+def grid_position(shelf):
+    """
+    (row, column) of the shelf in the 3x3 storage, [1] is (0, 0)
+    """
+    return divmod(shelf - 1, COLUMNS)
+
+
+def grid_distance(shelf_a, shelf_b):
+    """
+    Distance of two shelves in grid cells - neighbours are 1 apart, diagonal ones 1.41
+    """
+    (row_a, column_a), (row_b, column_b) = grid_position(shelf_a), grid_position(shelf_b)
+    return math.hypot(row_a - row_b, column_a - column_b)
+
+
+class ShelfStorage(object):
+    """
+    In-memory shelf occupancy with atomic write-back. Shelves are numbered 1-9 like on the FHS server
+    """
+
+    def __init__(self, path="./dtz_storage"):
+        self.path = path
+        self._mask = (1 << SHELVES) - 1  # unknown storage is treated as full
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.fence = None  # called before every write, raises if this instance must not write - see failover.py
+
+    def load(self):
+        """
+        Read the storage file at startup - or again by the standby, see failover.py. Only the digits are used,
+        so files written by older versions with missing line breaks are read correctly as well. The listeners
+        are told about the shelves which changed
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as in_file:
+                digits = [c for c in in_file.read() if c in "01"]
+        except IOError as e:
+            logger.debug("storage: could not read %s - all shelves occupied: %s", self.path, e)
+            digits = []
+
+        mask = 0
+        for shelf in range(SHELVES):
+            if shelf >= len(digits) or digits[shelf] == "1":
+                mask |= 1 << shelf
+        with self._lock:
+            changed, self._mask = self._mask ^ mask, mask
+        for shelf in range(1, SHELVES + 1):
+            if changed & (1 << (shelf - 1)):
+                for listener in self._listeners:
+                    try:
+                        listener(shelf, bool(mask & (1 << (shelf - 1))))
+                    except Exception as e:
+                        logger.debug("storage: listener Catched Exception: %s", e)
+        return self.as_list()
+
+    def _check(self, shelf):
+        if not 1 <= shelf <= SHELVES:
+            raise ValueError("shelf number must be between 1 and {}, got {}".format(SHELVES, shelf))
+
+    def is_occupied(self, shelf):
+        self._check(shelf)
+        return bool(self._mask & (1 << (shelf - 1)))
+
+    def set(self, shelf, occupied):
+        """
+        Set the occupancy of one shelf. Writes the file and informs the listeners only on a real change
+        """
+        self._check(shelf)
+        bit = 1 << (shelf - 1)
+        with self._lock:
+            mask = self._mask | bit if occupied else self._mask & ~bit
+            if mask == self._mask:
+                return False
+            # the file first - if the write fails, memory, OPC UA variables and file still agree
+            with metrics.timer("dtz_file_write_seconds", file="storage"):
+                self._save(mask)
+            self._mask = mask
+        for listener in self._listeners:
+            try:
+                listener(shelf, bool(occupied))
+            except Exception as e:
+                logger.debug("storage: listener Catched Exception: %s", e)
+        return True
+
+    def _save(self, mask):
+        ############# SAVE STORAGE DATA  #############
+        if self.fence is not None:
+            self.fence()
+        data = "".join("1\n" if mask & (1 << shelf) else "0\n" for shelf in range(SHELVES))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as out_file:
+            out_file.write(data)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, self.path)
+        # make the rename itself durable
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+    def as_list(self):
+        mask = self._mask
+        return [bool(mask & (1 << shelf)) for shelf in range(SHELVES)]
+
+    def add_listener(self, listener):
+        """
+        listener(shelf, occupied) is called after every change, e.g. to update the OPC UA variables
+        """
+        self._listeners.append(listener)
@@ -0,0 +1,270 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Simulated device servers of the DTZ Master Controller
+#   Local OPC UA servers with the nodes of the Panda robot, the PiXtend conveyor belt and the FHS PLC, so the
+#   controller can be run and benchmarked without the demonstrator. Motion durations are configurable and faults can
+#   be injected: lost commands (the device never moves), failing method calls, extra latency and outages.
+#   With --panda-travel the robot move takes longer the farther the shelf is from the previous one (seconds per grid
+#   cell), like the robot which starts the pick where the previous one ended.
+#   With --certificate and --private-key the devices also offer Basic256Sha256 Sign and SignAndEncrypt endpoints
+#   (see security.py).
+#
+#   python simulators.py [--panda-move 2.0] [--panda-travel 0.0] [--belt-move 3.0] [--lost-rate 0.05]
+#                        [--error-rate 0.05] [--latency 0.1] [--certificate cert.der --private-key key.pem]
+#   python opc_ua_master.py --simulate        controller connected to the simulators (see SIM_URLS)
+
+from opcua import Server, ua, uamethod
+from shelf_storage import grid_distance
+from security import Credentials, MODES
+import argparse
+import threading
+import logging
+import random
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+SIM_URLS = {
+    "panda": "opc.tcp://127.0.0.1:48411/freeopcua/server/",
+    "pixtend": "opc.tcp://127.0.0.1:48412/freeopcua/server/",
+    "fhs": "opc.tcp://127.0.0.1:48413/freeopcua/server/",
+}
+
+
+class Faults(object):
+    """
+    Fault injection of one simulated device
+    lost_rate   probability that a motion command is accepted but the device never moves
+    error_rate  probability that a method call fails with BadInternalError
+    latency     extra seconds before a method call returns
+    """
+
+    def __init__(self, lost_rate=0.0, error_rate=0.0, latency=0.0, seed=None):
+        self.lost_rate = lost_rate
+        self.error_rate = error_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lost = 0
+        self.errors = 0
+
+    def inject(self):
+        """
+        Called at the start of every motion method. Returns False if the command is lost
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            raise ua.UaStatusCodeError(ua.StatusCodes.BadInternalError)
+        if self.random.random() < self.lost_rate:
+            self.lost += 1
+            return False
+        return True
+
+
+class SimulatedDevice(object):
+
+    def __init__(self, name, url, faults=None, credentials=None):
+        self.name = name
+        self.url = url
+        self.faults = faults or Faults()
+        self.server = Server()
+        self.server.set_endpoint(url)
+        self.server.set_server_name("DTZ Simulator - {}".format(name))
+        if credentials is not None:
+            credentials.secure_server(self.server, MODES)  # unsecured and secured sessions
+        self.idx = self.server.register_namespace("urn:freeopcua")
+        self.objects = self.server.get_objects_node()
+        self.busy = threading.Lock()  # one motion at a time, like the real device
+
+    def start(self):
+        self.server.start()
+        logger.debug("simulator: %s started at %s", self.name, self.url)
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def outage(self, duration):
+        """
+        Stop the server for duration seconds - all sessions of the controller are lost
+        """
+        def run():
+            logger.debug("simulator: %s outage for %s seconds", self.name, duration)
+            self.server.stop()
+            time.sleep(duration)
+            self.server.start()
+        outage_thread = threading.Thread(name='{}_outage_thread'.format(self.name), target=run)
+        outage_thread.daemon = True
+        outage_thread.start()
+
+    def _motion(self, moving, state, duration, reaction_delay, progress=None):
+        # runs in its own thread - the method call returns immediately like on the real device
+        def run():
+            with self.busy:
+                time.sleep(reaction_delay)
+                moving.set_value(True)
+                state.set_value("moving")
+                start = time.time()
+                while time.time() - start < duration:
+                    time.sleep(min(0.2, duration))
+                    if progress is not None:
+                        progress(min(time.time() - start, duration))
+                moving.set_value(False)
+                state.set_value("idle")
+        motion_thread = threading.Thread(name='{}_motion_thread'.format(self.name), target=run)
+        motion_thread.daemon = True
+        motion_thread.start()
+
+
+class SimulatedPanda(SimulatedDevice):
+    """
+    PandaRobot with MoveRobotRos, MoveRobotLibfranka, RobotMoving and RobotState
+    """
+
+    def __init__(self, url=SIM_URLS["panda"], move_duration=2.0, reaction_delay=0.2, faults=None, travel=0.0,
+                 credentials=None):
+        SimulatedDevice.__init__(self, "panda", url, faults, credentials)
+        self.move_duration = move_duration
+        self.reaction_delay = reaction_delay
+        self.travel = travel  # extra seconds per grid cell from the previous shelf
+        self.shelf = None
+        self.moves = 0
+        robot = self.objects.add_object(self.idx, "PandaRobot")
+        self.robot_moving = robot.add_variable(self.idx, "RobotMoving", False)
+        self.robot_state = robot.add_variable(self.idx, "RobotState", "idle")
+        for method in ("MoveRobotRos", "MoveRobotLibfranka"):
+            robot.add_method(self.idx, method, self.move_robot, [ua.VariantType.String, ua.VariantType.String],
+                             [ua.VariantType.Boolean])
+
+    @uamethod
+    def move_robot(self, parent, movement, shelf):
+        if self.faults.inject():
+            self.moves += 1
+            duration = self.move_duration
+            if shelf.isdigit() and 1 <= int(shelf) <= 9:
+                if self.shelf is not None:
+                    duration += self.travel * grid_distance(self.shelf, int(shelf))
+                self.shelf = int(shelf)
+            self._motion(self.robot_moving, self.robot_state, duration, self.reaction_delay)
+        return True
+
+
+class SimulatedPixtend(SimulatedDevice):
+    """
+    ConveyorBelt with MoveBelt, SwitchBusyLight, ConBeltMoving, ConBeltState and ConBeltDist
+    """
+
+    def __init__(self, url=SIM_URLS["pixtend"], move_duration=3.0, reaction_delay=0.1, faults=None,
+                 credentials=None):
+        SimulatedDevice.__init__(self, "pixtend", url, faults, credentials)
+        self.move_duration = move_duration
+        self.reaction_delay = reaction_delay
+        self.moves = 0
+        self.light_switches = 0
+        belt = self.objects.add_object(self.idx, "ConveyorBelt")
+        self.belt_moving = belt.add_variable(self.idx, "ConBeltMoving", False)
+        self.belt_state = belt.add_variable(self.idx, "ConBeltState", "idle")
+        self.belt_dist = belt.add_variable(self.idx, "ConBeltDist", 0.0)
+        self.busy_light = belt.add_variable(self.idx, "BusyLight", False)
+        belt.add_method(self.idx, "MoveBelt", self.move_belt, [ua.VariantType.String, ua.VariantType.Float],
+                        [ua.VariantType.Boolean])
+        belt.add_method(self.idx, "SwitchBusyLight", self.switch_busy_light, [ua.VariantType.Boolean],
+                        [ua.VariantType.Boolean])
+
+    @uamethod
+    def move_belt(self, parent, movement, distance):
+        if self.faults.inject():
+            self.moves += 1
+            self._motion(self.belt_moving, self.belt_state, self.move_duration, self.reaction_delay,
+                         progress=lambda t: self.belt_dist.set_value(distance * t / self.move_duration))
+        return True
+
+    @uamethod
+    def switch_busy_light(self, parent, busy):
+        self.light_switches += 1
+        self.busy_light.set_value(busy)
+        return True
+
+
+class SimulatedFhs(SimulatedDevice):
+    """
+    FHS PLC with ::AsGlobalPV:ShelfNumber, NewValAvailable and TaskRunning in namespace 6
+    """
+
+    def __init__(self, url=SIM_URLS["fhs"], pulse=0.5, faults=None, credentials=None):
+        SimulatedDevice.__init__(self, "fhs", url, faults, credentials)
+        self.pulse = pulse
+        self.requests = 0
+        namespace = self.idx
+        while namespace < 6:  # the PLC variables are in namespace 6
+            namespace = self.server.register_namespace("urn:fhs:ns{}".format(namespace + 1))
+        plc = self.objects.add_object(self.idx, "AsGlobalPV")
+        self.shelf_number = plc.add_variable(ua.NodeId("::AsGlobalPV:ShelfNumber", 6), "6:ShelfNumber", 1)
+        self.new_val_available = plc.add_variable(ua.NodeId("::AsGlobalPV:NewValAvailable", 6),
+                                                  "6:NewValAvailable", False)
+        self.task_running = plc.add_variable(ua.NodeId("::AsGlobalPV:TaskRunning", 6), "6:TaskRunning", False)
+        self._lock = threading.Lock()
+
+    def trigger(self, shelf):
+        """
+        One shelf request - ShelfNumber is set, NewValAvailable is True for one pulse. Blocks for 2 pulses,
+        so the next request is a new rising edge
+        """
+        with self._lock:
+            self.requests += 1
+            self.shelf_number.set_value(shelf)
+            self.new_val_available.set_value(True)
+            time.sleep(self.pulse)
+            self.new_val_available.set_value(False)
+            time.sleep(self.pulse)
+
+
+def start_all(panda_move=2.0, belt_move=3.0, faults=None, panda_travel=0.0, credentials=None):
+    """
+    Start the three simulators on the ports of SIM_URLS
+    """
+    panda = SimulatedPanda(move_duration=panda_move, faults=faults, travel=panda_travel,
+                           credentials=credentials).start()
+    pixtend = SimulatedPixtend(move_duration=belt_move, faults=faults, credentials=credentials).start()
+    fhs = SimulatedFhs(credentials=credentials).start()
+    return panda, pixtend, fhs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Panda, PiXtend and FHS servers")
+    parser.add_argument("--panda-move", type=float, default=2.0, help="duration of a robot move in seconds")
+    parser.add_argument("--panda-travel", type=float, default=0.0,
+                        help="extra seconds of a robot move per grid cell from the previous shelf")
+    parser.add_argument("--belt-move", type=float, default=3.0, help="duration of a belt move in seconds")
+    parser.add_argument("--lost-rate", type=float, default=0.0, help="probability of a lost motion command")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a failing method call")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra latency of the method calls in seconds")
+    parser.add_argument("--fhs-every", type=float, default=0, help="FHS shelf request every x seconds, 0 = off")
+    parser.add_argument("--certificate", default=None, help="certificate of the secured endpoints, see security.py")
+    parser.add_argument("--private-key", default=None, help="private key of the certificate")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    logging.getLogger("opcua").setLevel(logging.WARNING)
+    faults = Faults(args.lost_rate, args.error_rate, args.latency)
+    credentials = Credentials(args.certificate, args.private_key) if args.certificate else None
+    devices = start_all(args.panda_move, args.belt_move, faults, args.panda_travel, credentials)
+    try:
+        shelf = 0
+        while True:
+            if args.fhs_every > 0:
+                devices[2].trigger(shelf % 9 + 1)
+                shelf += 1
+                time.sleep(args.fhs_every)
+            else:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for device in devices:
+            device.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   State cache of the DTZ Master Controller
+#   Local copy of the device variables (RobotMoving, ConBeltMoving, RobotState, ...) which is fed by OPC UA datachange
+#   subscriptions instead of polling get_value(). Waiting for a device is done with condition variables, so a motion
+#   end is detected within one publish interval and the network traffic only depends on the state changes.
+
+from opcua import ua
+from traffic_capture import recorder
+import collections
+import threading
+import time
+import logging
+
+logger = logging.getLogger('dtz_master_controller')
+
+# distinct values remembered per key for wait_for(since=...) - the flags have two or three, a continuous value like
+# ConBeltDist would grow the history without limit
+HISTORY = 8
+
+
+class StateCache(object):
+    """
+    Thread safe key/value store of the latest device values. Every update increments a global sequence number,
+    which allows waiting for a value that was only present for a short moment (e.g. a very short robot move)
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._values = {}
+        self._timestamps = {}
+        self._seen = {}  # key -> {value: sequence number of the last update with this value}, the last HISTORY values
+        self._sequence = 0
+        self._listeners = []
+
+    def update(self, key, value):
+        with self._cond:
+            self._sequence += 1
+            self._values[key] = value
+            self._timestamps[key] = time.time()
+            try:
+                seen = self._seen.setdefault(key, collections.OrderedDict())
+                seen.pop(value, None)
+                seen[value] = self._sequence
+                if len(seen) > HISTORY:
+                    seen.popitem(last=False)
+            except TypeError:  # unhashable value, can only be waited for as current value
+                pass
+            self._cond.notify_all()
+        for listener in self._listeners:
+            try:
+                listener(key, value)
+            except Exception as e:
+                logger.debug("state: listener Catched Exception: %s", e)
+
+    def add_listener(self, listener):
+        """
+        listener(key, value) is called after every update - from the subscription thread, so it must not block
+        """
+        self._listeners.append(listener)
+
+    def invalidate(self, keys):
+        """
+        Forget the values of the given keys, e.g. when the session to the device is lost
+        """
+        with self._cond:
+            self._sequence += 1
+            for key in keys:
+                self._values.pop(key, None)
+                self._timestamps.pop(key, None)
+            self._cond.notify_all()
+
+    def get(self, key, default=None):
+        with self._cond:
+            return self._values.get(key, default)
+
+    def timestamp(self, key):
+        with self._cond:
+            return self._timestamps.get(key)
+
+    def sequence(self):
+        with self._cond:
+            return self._sequence
+
+    def _matches(self, key, value, since):
+        if key in self._values and self._values[key] == value:
+            return True
+        if since is not None:
+            try:
+                return self._seen.get(key, {}).get(value, 0) > since
+            except TypeError:
+                return False
+        return False
+
+    def wait_for(self, key, value, timeout=None, since=None):
+        """
+        Block until key == value. With since (a value of sequence()) an update to the value after that point in
+        time is also accepted, even if the value has already changed again.
+        Returns False if the timeout (in seconds, None = forever) expired.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._matches(key, value, since):
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def wait_change(self, since, timeout=None):
+        """
+        Block until any key was updated after the given sequence number. Returns the new sequence number
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._sequence > since, timeout)
+            return self._sequence
+
+
+class StateSubHandler(object):
+    """
+    Subscription handler writing the datachanges of one session into the state cache.
+    Also watches the CurrentTime of the server as heartbeat, so a dead session is detected without polling reads.
+    Called from the receiving thread of the client - only cheap, non-blocking operations in here
+    """
+
+    def __init__(self, cache, keys, name=None):
+        self.cache = cache
+        self.keys = keys  # nodeid -> cache key
+        self.name = name  # of the session, for the traffic capture
+        self.last_notification = time.time()
+        self.lost = threading.Event()
+
+    def datachange_notification(self, node, val, data):
+        self.last_notification = time.time()
+        key = self.keys.get(node.nodeid)
+        if key is not None:
+            recorder.record("datachange", self.name, key, val)
+            self.cache.update(key, val)
+
+    def status_change_notification(self, status):
+        logger.debug("state: subscription status changed: %s", status)
+        self.lost.set()
+        self.cache.invalidate(self.keys.values())
+
+    def event_notification(self, event):
+        pass
+
+    def alive(self, timeout):
+        """
+        Block up to timeout seconds. False if the subscription was lost or no notification arrived within timeout
+        """
+        if self.lost.wait(timeout):
+            return False
+        return time.time() - self.last_notification < timeout
+
+
+def subscribe_state(session, cache, keys, period=100, heartbeat_timeout=5.0):
+    """
+    Subscribe the given node keys of a connected pooled session into the cache.
+    The heartbeat (CurrentTime of the server) gets its own subscription publishing every heartbeat_timeout / 3,
+    so an idle session costs a few notifications per heartbeat_timeout, not ten per second.
+    Returns the handler, whose alive() replaces the polling keep-alive loops
+    """
+    nodes = [session.node(key) for key in keys]
+    handler = StateSubHandler(cache, dict((node.nodeid, key) for node, key in zip(nodes, keys)), session.name)
+    if nodes:
+        session.client.create_subscription(period, handler).subscribe_data_change(nodes)
+    heartbeat = session.client.get_node(ua.FourByteNodeId(ua.ObjectIds.Server_ServerStatus_CurrentTime))
+    session.client.create_subscription(heartbeat_timeout * 1000 / 3, handler).subscribe_data_change(heartbeat)
+    return handler
@@ -0,0 +1,157 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Reconnect supervisor of the DTZ Master Controller
+#   One supervisor per upstream endpoint replaces the three copies of the connect / poll / double the counter loop.
+#   Liveness comes from the subscriptions (datachanges and the CurrentTime heartbeat of the server), there are no
+#   polling reads. A lost session opens the circuit breaker of the endpoint, so callers fail fast, and the next
+#   attempt waits a capped exponential backoff with jitter. The backoff is only reset once a connection was stable
+#   for a while, so a flapping server is not hammered every second.
+
+from metrics import metrics
+import threading
+import logging
+import random
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+# connection states of an endpoint
+CONNECTING = "connecting"
+CONNECTED = "connected"
+BACKOFF = "backoff"
+
+# status key -> OPC UA variable Connections/<endpoint>/<name> and its initial value
+CONNECTION_VARIABLES = (("state", "State", ""), ("breaker", "Breaker", ""), ("reconnects", "Reconnects", 0),
+                        ("retry_in", "RetryIn", 0.0), ("last_error", "LastError", ""))
+
+
+class Backoff(object):
+    """
+    Capped exponential backoff with jitter - the delay is drawn from [(1 - jitter) * d, d] with d = initial * 2^n
+    """
+
+    def __init__(self, initial=1.0, maximum=30.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * (2 ** self.attempt))
+        self.attempt += 1
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+    def reset(self):
+        self.attempt = 0
+
+
+class EndpointSupervisor(object):
+    """
+    Keeps the session of one endpoint alive in its own thread.
+    connect()   connects the session and sets up its subscriptions, returns a watch with alive(timeout)
+                (see state_cache.subscribe_state)
+    cleanup()   called after the session was lost, e.g. to invalidate the cached values
+    """
+
+    def __init__(self, session, connect, cleanup=None, backoff=None, heartbeat_timeout=5, stable_after=30):
+        self.session = session
+        self.name = session.name
+        self.breaker = session.breaker
+        self.connect = connect
+        self.cleanup = cleanup
+        self.backoff = backoff or Backoff()
+        self.heartbeat_timeout = heartbeat_timeout
+        self.stable_after = stable_after
+        self.state = CONNECTING
+        self.reconnects = 0
+        self.retry_in = 0.0
+        self.last_error = ""
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        listener(supervisor) is called after every change of the connection state
+        """
+        self._listeners.append(listener)
+
+    def _set(self, state, error=None):
+        self.state = state
+        if error is not None:
+            self.last_error = str(error)
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                logger.debug("supervisor: listener Catched Exception: %s", e)
+
+    def start(self):
+        supervisor_thread = threading.Thread(name='{}_supervisor_thread'.format(self.name), target=self.run)
+        supervisor_thread.daemon = True
+        supervisor_thread.start()
+        return supervisor_thread
+
+    def run(self):
+        while True:
+            connected_at = None
+            try:
+                logger.debug("supervisor: connecting to %s server", self.name)
+                self.breaker.half_open()
+                self._set(CONNECTING)
+                watch = self.connect()
+                self.breaker.watch(watch.lost)  # a tripped breaker ends the wait below at once
+                connected_at = time.time()
+                logger.debug("supervisor: successful connected to %s", self.name)
+                self._set(CONNECTED, "")
+
+                # everything went fine? then wait - the subscriptions tell if the session is still alive, the
+                # breaker wakes the wait when it trips
+                while watch.alive(self.heartbeat_timeout) and not self.breaker.tripped.is_set():
+                    pass
+                raise ConnectionError("{} session lost - {}".format(
+                    self.name, self.breaker.reason if self.breaker.tripped.is_set() else "no heartbeat"))
+
+            except Exception as e:
+                logger.debug("supervisor: Catched Exception: %s", e, extra={"throttle": True})
+                error = e
+            try:
+                if self.cleanup is not None:
+                    self.cleanup()
+                self.session.disconnect()
+            except Exception as e:
+                logger.debug("supervisor: Catched Exception while disconnecting %s: %s", self.name, e,
+                             extra={"throttle": True})
+            self.breaker.open(str(error))
+
+            if connected_at is not None and time.time() - connected_at > self.stable_after:
+                self.backoff.reset()
+            self.retry_in = self.backoff.next()
+            self.reconnects += 1
+            metrics.inc("dtz_reconnects_total", server=self.name)
+            logger.debug("supervisor: no connection to %s server - trying again in %.1f seconds.", self.name,
+                         self.retry_in)
+            self._set(BACKOFF, error)
+            time.sleep(self.retry_in)
+
+    def status(self):
+        return {"state": self.state, "breaker": self.breaker.state, "reconnects": self.reconnects,
+                "retry_in": round(self.retry_in, 1), "last_error": self.last_error}
+
+
+def wait_state(state, key, value, breakers, timeout=None, since=None, poll=0.5, cancel=None):
+    """
+    StateCache.wait_for which fails fast - raises CircuitOpen as soon as one of the breakers opens, and the
+    exception of cancel.check() (a job_queue.Cancellation) when the job was cancelled
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        for breaker in breakers:
+            breaker.check()
+        if cancel is not None:
+            cancel.check()
+            if cancel.requested:
+                poll = min(poll, cancel.remaining())
+        step = poll if deadline is None else min(poll, max(deadline - time.time(), 0))
+        if state.wait_for(key, value, timeout=step, since=since):
+            return True
+        if deadline is not None and time.time() >= deadline:
+            return False
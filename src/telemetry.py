@@ -0,0 +1,240 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Telemetry exporter of the DTZ Master Controller
+#   Sends the device states (panda_state, conbelt_state, conbelt_dist) to the OPC UA adapter of the data stack.
+#   The values come from the subscriptions of the state cache and are buffered in a bounded ring, a separate thread
+#   ships them in batches over one keep-alive HTTP session. While the adapter is down the batches are spilled to
+#   disk and sent later, in order - every cell has its own spill file next to its storage and job files (spill_path
+#   of cells.py). Recording a value never blocks the control path.
+#
+#   For testing, a stub adapter which prints the received batches can be started with
+#       python telemetry.py --stub 1337
+
+from datetime import datetime
+import collections
+import threading
+import logging
+import json
+import time
+import sys
+import os
+
+logger = logging.getLogger('dtz_master_controller')
+
+# state cache key -> (telemetry id, value name), the format of the data stack
+TELEMETRY_KEYS = {
+    "RobotState": ("pandapc.panda_state", "panda_state"),
+    "ConBeltState": ("pixtend.conbelt_state", "conbelt_state"),
+    "ConBeltDist": ("pixtend.conbelt_dist", "conbelt_dist"),
+}
+
+
+def timestamp():
+    return datetime.utcnow().isoformat() + "+00:00"
+
+
+class TelemetryExporter(object):
+    """
+    Bounded ring buffer plus sender thread. If the ring is full the oldest samples are dropped
+    """
+
+    def __init__(self, url, spill_path="./dtz_telemetry_spill", capacity=10000, batch_size=100,
+                 flush_interval=1.0, max_backoff=30, spill_max_bytes=10 * 1024 * 1024, timeout=2):
+        if "://" not in url:
+            url = "http://" + url
+        self.url = url
+        self.spill_path = spill_path
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.spill_max_bytes = spill_max_bytes
+        self.timeout = timeout
+        self._ring = collections.deque(maxlen=capacity)
+        self._wake = threading.Event()
+        self._stop = False
+        self._session = None
+        self._backoff = 1
+        self._retry_at = 0
+        self._spill_offset = None  # bytes of the spill file which are sent already, read at the first replay
+        self.adapter_down = False
+        # statistics
+        self.recorded = 0
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    ############# PRODUCER SIDE - NEVER BLOCKS #############
+    def record(self, telemetry_id, name, value, tm=None):
+        if len(self._ring) == self.capacity:
+            self.dropped += 1
+        self._ring.append({"id": telemetry_id, "timestamp": tm or timestamp(), name: value})
+        self.recorded += 1
+        if len(self._ring) >= self.batch_size:
+            self._wake.set()
+
+    def state_listener(self, key, value, prefix=None):
+        """
+        Listener for the state cache - records the telemetry keys. With several cells the ids get the cell name
+        as prefix, e.g. cell2.pandapc.panda_state
+        """
+        if key in TELEMETRY_KEYS:
+            telemetry_id, name = TELEMETRY_KEYS[key]
+            self.record(prefix + "." + telemetry_id if prefix else telemetry_id, name, value)
+
+    ############# SENDER THREAD #############
+    def start(self):
+        telemetry_thread = threading.Thread(name='telemetry_thread', target=self.run)
+        telemetry_thread.daemon = True
+        telemetry_thread.start()
+        return telemetry_thread
+
+    def stop(self):
+        self._stop = True
+        self._wake.set()
+
+    def run(self):
+        while not self._stop:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        batch = self._take()
+        if self.adapter_down and time.time() < self._retry_at:
+            self._spill(batch)
+            return
+        try:
+            self._replay_spill()
+            if batch:
+                self._send(batch)
+            if self.adapter_down:
+                logger.debug("telemetry: adapter %s reachable again", self.url)
+            self.adapter_down = False
+            self._backoff = 1
+        except Exception as e:
+            if not self.adapter_down:
+                logger.debug("telemetry: Catched Exception: requests - connection to data stack: %s", e)
+            self._spill(batch)
+            self.adapter_down = True
+            self._retry_at = time.time() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        if len(self._ring) >= self.batch_size:
+            self._wake.set()
+
+    def _take(self):
+        batch = []
+        try:
+            while len(batch) < self.batch_size:
+                batch.append(self._ring.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def _send(self, batch):
+        if self._session is None:
+            import requests  # only needed once there is something to send
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+        response = self._session.post(self.url, json=batch, timeout=self.timeout)
+        response.raise_for_status()
+        self.sent += len(batch)
+
+    ############# SPILL-OVER #############
+    def _spill(self, batch):
+        if not batch:
+            return
+        try:
+            if os.path.exists(self.spill_path) and \
+                    os.path.getsize(self.spill_path) - (self._spill_offset or 0) > self.spill_max_bytes:
+                self.dropped += len(batch)
+                return
+            with open(self.spill_path, "a", encoding="utf-8") as out_file:
+                for sample in batch:
+                    out_file.write(json.dumps(sample) + "\n")
+            self.spilled += len(batch)
+        except IOError as e:
+            logger.debug("telemetry: could not spill to %s: %s", self.spill_path, e)
+            self.dropped += len(batch)
+
+    def _replay_spill(self):
+        # streamed in batches from the offset of the first unsent sample - the file is not read as a whole
+        if not os.path.exists(self.spill_path):
+            return
+        if self._spill_offset is None:
+            self._spill_offset = self._read_offset()
+        try:
+            with open(self.spill_path, "rb") as in_file:
+                in_file.seek(self._spill_offset)
+                while True:
+                    samples, offset = self._read_batch(in_file)
+                    if not samples:
+                        break
+                    self._send(samples)
+                    self._spill_offset = offset
+        except Exception:
+            if self._spill_offset:
+                self._write_offset(self._spill_offset)  # the samples which are not sent yet stay, in order
+            raise
+        if os.path.exists(self.spill_path + ".offset"):
+            os.remove(self.spill_path + ".offset")  # first - a stale offset must never skip the next spill file
+        os.remove(self.spill_path)
+        self._spill_offset = 0
+
+    def _read_batch(self, in_file):
+        samples = []
+        while len(samples) < self.batch_size:
+            line = in_file.readline()
+            if not line:
+                break
+            try:
+                samples.append(json.loads(line.decode("utf-8")))
+            except ValueError:
+                pass
+        return samples, in_file.tell()
+
+    def _read_offset(self):
+        try:
+            with open(self.spill_path + ".offset", "r", encoding="utf-8") as in_file:
+                return int(in_file.read().strip() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def _write_offset(self, offset):
+        tmp_path = self.spill_path + ".offset.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as out_file:
+                out_file.write(str(offset))
+            os.replace(tmp_path, self.spill_path + ".offset")
+        except IOError as e:
+            logger.debug("telemetry: could not write the spill offset of %s: %s", self.spill_path, e)
+
+def run_stub_server(port=1337):
+    """
+    Stub of the OPC UA adapter - accepts the batches and prints them
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real adapter
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            batch = json.loads(body.decode("utf-8"))
+            print("received {} samples, last: {}".format(len(batch), batch[-1] if batch else None))
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    HTTPServer(("0.0.0.0", port), StubHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--stub":
+        run_stub_server(int(sys.argv[2]) if len(sys.argv) > 2 else 1337)
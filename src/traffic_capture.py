@@ -0,0 +1,249 @@
+#   Salzburg Research ForschungsgesmbH
+
+#   Capture of the upstream OPC UA traffic of the DTZ Master Controller
+#   With capture_path set (DTZ_CAPTURE_PATH) every request of the controller to the Panda, the PiXtend and the FHS
+#   PLC - read, read_many, method call, connect, disconnect - and every datachange notification from them
+#   is recorded with a monotonic nanosecond timestamp and its duration. replay.py stands in for the three servers
+#   with a capture, or reports its latencies - so a slow or stuck cycle can be reproduced and profiled without
+#   the demonstrator.
+#
+#   File: MAGIC, wall clock time of the start (float64), then records. A record is kind (uint8), nanoseconds since
+#   the start (int64), duration in nanoseconds (int64), length of the payload (uint32) and the payload, the tagged
+#   encoding of [endpoint, target, value, error]. Short strings (endpoints, keys, methods, states) are written once
+#   as STRING record and referenced by their number afterwards - a datachange takes about 30 bytes.
+#   target depends on the op: read - key, read_many - [keys], call - [object key, method, args...], datachange -
+#   key, connect/disconnect - url. error is [status code or 0, message] or None. Kind 5 (write_many) is reserved:
+#   it was the grouped write, which is not recorded any more - older captures with it are still read.
+#   The records are buffered and written every second - a crashed controller loses at most the last second.
+
+import collections
+import threading
+import datetime
+import logging
+import atexit
+import struct
+import time
+
+logger = logging.getLogger('dtz_master_controller')
+
+MAGIC = b"DTZCAP\x01\n"
+HEADER = struct.Struct("<d")
+RECORD = struct.Struct("<BqqI")
+
+STRING = 0
+OPS = ("string", "connect", "disconnect", "read", "read_many",
+       "write_many",  # reserved - legacy, no longer written, the kinds of the following ops stay the same
+       "call", "datachange")
+KINDS = dict((op, kind) for kind, op in enumerate(OPS))
+
+MAX_INTERNED = 0xffff
+INTERN_LENGTH = 64  # longer strings, e.g. error messages, are written inline
+
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_LENGTH = struct.Struct("<I")
+_INDEX = struct.Struct("<H")
+
+Record = collections.namedtuple("Record", "op time duration endpoint target value error")
+
+
+class CaptureError(ValueError):
+    """
+    Raised for a file which is no capture
+    """
+    pass
+
+
+class TrafficRecorder(object):
+    """
+    Writes the capture. Thread safe, does nothing until open() - the hooks in the sessions cost one attribute lookup
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.records = 0
+        self._file = None
+        self._lock = threading.Lock()
+        self._strings = {}
+        self._origin = 0
+
+    def open(self, path, flush_interval=1.0):
+        with self._lock:
+            self._file = open(path, "wb")
+            self._file.write(MAGIC + HEADER.pack(time.time()))
+            self._origin = time.perf_counter_ns()
+            self._strings = {}
+            self.records = 0
+            self.path = path
+            self.enabled = True
+        atexit.register(self.close)
+        flush_thread = threading.Thread(name='capture_flush_thread', target=self.run, args=(flush_interval,))
+        flush_thread.daemon = True
+        flush_thread.start()
+        logger.debug("capture: recording the upstream traffic to %s", path)
+        return self
+
+    def run(self, flush_interval):
+        while self.enabled:
+            time.sleep(flush_interval)
+            with self._lock:
+                if self._file is None:
+                    return
+                try:
+                    self._file.flush()
+                except (IOError, OSError) as e:
+                    logger.error("capture: Catched Exception: %s - capture stopped", e)
+                    self.enabled = False
+
+    def close(self):
+        with self._lock:
+            self.enabled = False
+            capture, self._file = self._file, None
+            if capture is not None:
+                capture.close()
+                logger.debug("capture: %s records written to %s", self.records, self.path)
+
+    def start(self):
+        """
+        Timestamp of a request which is about to be sent - None while not recording
+        """
+        return time.perf_counter_ns() if self.enabled else None
+
+    def record(self, op, endpoint, target, value=None, error=None, start=None):
+        """
+        One request (start from start()) or notification (start None)
+        """
+        if not self.enabled:
+            return
+        end = time.perf_counter_ns()
+        if start is None:
+            start = end
+        if error is not None:
+            error = [int(getattr(error, "code", 0) or 0), str(error)]
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                payload = bytearray()
+                self._encode(payload, [endpoint, target, value, error])
+                self._file.write(RECORD.pack(KINDS[op], start - self._origin, end - start, len(payload)))
+                self._file.write(payload)
+                self.records += 1
+            except Exception as e:
+                logger.debug("capture: Catched Exception: %s", e)
+
+    def _intern(self, text):
+        # number of the string, written as STRING record the first time
+        index = self._strings.get(text)
+        if index is None:
+            if len(self._strings) >= MAX_INTERNED:
+                return None
+            index = self._strings[text] = len(self._strings)
+            data = text.encode("utf-8")
+            self._file.write(RECORD.pack(STRING, 0, 0, len(data)))
+            self._file.write(data)
+        return index
+
+    def _encode(self, out, value):
+        if value is None:
+            out += b"N"
+        elif value is True:
+            out += b"T"
+        elif value is False:
+            out += b"F"
+        elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+            out += b"i" + _INT.pack(value)
+        elif isinstance(value, float):
+            out += b"d" + _FLOAT.pack(value)
+        elif isinstance(value, str):
+            index = self._intern(value) if len(value) <= INTERN_LENGTH else None
+            if index is not None:
+                out += b"s" + _INDEX.pack(index)
+            else:
+                data = value.encode("utf-8")
+                out += b"S" + _LENGTH.pack(len(data)) + data
+        elif isinstance(value, (bytes, bytearray)):
+            out += b"b" + _LENGTH.pack(len(value)) + bytes(value)
+        elif isinstance(value, (list, tuple)):
+            out += b"l" + _LENGTH.pack(len(value))
+            for item in value:
+                self._encode(out, item)
+        elif isinstance(value, dict):
+            out += b"m" + _LENGTH.pack(len(value))
+            for key, item in value.items():
+                self._encode(out, key)
+                self._encode(out, item)
+        elif isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=datetime.timezone.utc)  # the OPC UA libraries use naive UTC
+            out += b"t" + _FLOAT.pack(value.timestamp())
+        else:
+            self._encode(out, str(value))  # e.g. LocalizedText - replayed as its text
+
+
+def _decode(data, position, strings):
+    # (value, position after it)
+    tag = data[position:position + 1]
+    position += 1
+    if tag == b"N":
+        return None, position
+    if tag == b"T":
+        return True, position
+    if tag == b"F":
+        return False, position
+    if tag == b"i":
+        return _INT.unpack_from(data, position)[0], position + _INT.size
+    if tag == b"d":
+        return _FLOAT.unpack_from(data, position)[0], position + _FLOAT.size
+    if tag == b"s":
+        return strings[_INDEX.unpack_from(data, position)[0]], position + _INDEX.size
+    if tag in (b"S", b"b"):
+        length = _LENGTH.unpack_from(data, position)[0]
+        position += _LENGTH.size
+        raw = bytes(data[position:position + length])
+        return (raw.decode("utf-8") if tag == b"S" else raw), position + length
+    if tag in (b"l", b"m"):
+        count = _LENGTH.unpack_from(data, position)[0]
+        position += _LENGTH.size
+        items = []
+        for _ in range(count * (2 if tag == b"m" else 1)):
+            item, position = _decode(data, position, strings)
+            items.append(item)
+        if tag == b"m":
+            return dict(zip(items[::2], items[1::2])), position
+        return items, position
+    if tag == b"t":
+        timestamp = _FLOAT.unpack_from(data, position)[0]
+        return datetime.datetime.utcfromtimestamp(timestamp), position + _FLOAT.size
+    raise CaptureError("unknown tag {!r} at {}".format(tag, position - 1))
+
+
+def read_capture(path):
+    """
+    (wall clock time of the start, [Record]) - time and duration of the records in seconds since the start.
+    A record cut off by a crash ends the capture
+    """
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    if not data.startswith(MAGIC):
+        raise CaptureError("{} is no capture of the DTZ Master Controller".format(path))
+    start = HEADER.unpack_from(data, len(MAGIC))[0]
+    position = len(MAGIC) + HEADER.size
+    strings = []
+    records = []
+    while position + RECORD.size <= len(data):
+        kind, offset, duration, length = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        if position + length > len(data):
+            break
+        if kind == STRING:
+            strings.append(data[position:position + length].decode("utf-8"))
+        else:
+            endpoint, target, value, error = _decode(data, position, strings)[0]
+            records.append(Record(OPS[kind], offset / 1e9, duration / 1e9, endpoint, target, value, error))
+        position += length
+    return start, records
+
+
+recorder = TrafficRecorder()
@@ -0,0 +1,69 @@
+from config import Config, ConfigError, command_line, read_values, FHS_PROFILES
+import json
+import pytest
+
+
+def test_defaults():
+    config = Config(environ={})
+    assert config.engine == "thread"
+    assert config.belt_distance == 0.55
+    assert config.fhs_endpoint == FHS_PROFILES["original"]["url"]
+
+
+def test_file_then_environment_then_flags(tmp_path):
+    path = tmp_path / "dtz_config.json"
+    path.write_text(json.dumps({"belt_distance": 0.4, "metrics_port": 9200, "fhs_profile": "pseudo"}))
+    values = read_values(str(path), {"DTZ_BELT_DISTANCE": "0.3", "DTZ_SIMULATE": "yes"}, {"engine": "asyncio"})
+    assert values["belt_distance"] == 0.3
+    assert values["metrics_port"] == 9200
+    assert values["simulate"] is True
+    assert values["engine"] == "asyncio"
+    assert values["fhs_profile"] == "pseudo"
+
+
+def test_all_problems_at_once(tmp_path):
+    path = tmp_path / "dtz_config.json"
+    path.write_text(json.dumps({"belt_distance": -1, "engine": "threads", "unknown": 1}))
+    with pytest.raises(ConfigError) as error:
+        read_values(str(path), {"DTZ_PANDA_URL": "http://panda", "DTZ_SIMULATE": "maybe"})
+    message = str(error.value)
+    for problem in ("unknown settings", "belt_distance", "engine", "panda_url", "simulate"):
+        assert problem in message
+
+
+def test_security_needs_certificate_and_key():
+    with pytest.raises(ConfigError, match="certificate and private_key"):
+        read_values(None, {"DTZ_SERVER_SECURITY": "SignAndEncrypt"})
+
+
+def test_fhs_node_overrides():
+    config = Config(environ={"DTZ_FHS_SHELF_NUMBER_NODE": "ns=2;i=9"})
+    assert config.fhs_node_ids["ShelfNumber"] == "ns=2;i=9"
+    assert config.fhs_node_ids["NewValAvailable"] == FHS_PROFILES["original"]["node_ids"]["NewValAvailable"]
+
+
+def test_command_line():
+    assert command_line(["--simulate", "--asyncio", "--config", "c.json", "--cells", "cells.json"]) == \
+        ("c.json", {"simulate": True, "engine": "asyncio", "cells_file": "cells.json"})
+
+
+def test_reload_applies_only_reloadable_settings():
+    environ = {}
+    config = Config(environ=environ)
+    changes = []
+    config.add_listener(lambda config, changed: changes.append(changed))
+    environ.update({"DTZ_BELT_DISTANCE": "0.5", "DTZ_PANDA_URL": "opc.tcp://panda:4840"})
+    summary = config.reload()
+    assert config.belt_distance == 0.5
+    assert config.panda_url != "opc.tcp://panda:4840"
+    assert "panda_url: needs a restart" in summary
+    assert changes == [{"belt_distance": (0.55, 0.5)}]
+
+
+def test_invalid_reload_keeps_the_old_values():
+    environ = {}
+    config = Config(environ=environ)
+    environ["DTZ_BELT_VELOCITY"] = "0"
+    with pytest.raises(ConfigError):
+        config.reload()
+    assert config.belt_velocity == 0.05428
@@ -0,0 +1,64 @@
+from historian import Historian, encode_chunk, decode_payload, CHUNK_HEADER, MAGIC
+import pytest
+
+
+def test_chunk_round_trip():
+    values = [(1000.000001, True), (1000.5, False), (1002.25, {"phase": "robot"}), (1010.0, 0.55)]
+    chunk = encode_chunk("State/RobotMoving", values)
+    magic, name_length, count, first, last, length = CHUNK_HEADER.unpack_from(chunk)
+    assert (magic, count, first, last) == (MAGIC, 4, values[0][0], values[-1][0])
+    name = chunk[CHUNK_HEADER.size:CHUNK_HEADER.size + name_length]
+    assert name == b"State/RobotMoving"
+    decoded = decode_payload(count, chunk[CHUNK_HEADER.size + name_length:])
+    assert [value for timestamp, value in decoded] == [value for timestamp, value in values]
+    assert [timestamp for timestamp, value in decoded] == pytest.approx([timestamp for timestamp, value in values],
+                                                                        abs=1e-6)
+
+
+def make_historian(tmp_path, **kwargs):
+    return Historian(str(tmp_path / "dtz_history"), chunk_size=4, flush_interval=10, segment_seconds=3600, **kwargs)
+
+
+def test_read_range_from_segments_and_buffer(tmp_path):
+    historian = make_historian(tmp_path)
+    for second in range(10):
+        historian.record("Storage/Shelf1", second % 2 == 0, timestamp=7200.0 + second)
+    historian.record("Storage/Shelf2", True, timestamp=7203.0)
+    historian._write_ready()  # the sealed chunks only, the rest stays buffered
+    assert historian.segments()
+    assert [value[0] for value in historian.read("Storage/Shelf1", 7202.0, 7208.0)] == \
+        [7202.0, 7203.0, 7204.0, 7205.0, 7206.0, 7207.0, 7208.0]
+    assert historian.read("Storage/Shelf2") == [(7203.0, True)]
+    assert [value[0] for value in historian.read("Storage/Shelf1", limit=2, newest_first=True)] == [7209.0, 7208.0]
+
+
+def test_values_survive_a_restart(tmp_path):
+    historian = make_historian(tmp_path)
+    historian.record("Jobs/LastCycleTiming", {"robot": 1.5}, timestamp=100.0)
+    historian.flush()
+    assert make_historian(tmp_path).read("Jobs/LastCycleTiming") == [(100.0, {"robot": 1.5})]
+
+
+def test_truncated_segment_keeps_the_complete_chunks(tmp_path):
+    historian = make_historian(tmp_path)
+    historian.record("State/RobotMoving", True, timestamp=10.0)
+    historian.flush()
+    historian.record("State/RobotMoving", False, timestamp=11.0)
+    historian.flush()
+    (start, path), = historian.segments()
+    with open(path, "r+b") as segment:
+        segment.truncate(segment.seek(0, 2) - 3)
+    assert make_historian(tmp_path).read("State/RobotMoving") == [(10.0, True)]
+
+
+def test_evict_by_retention_and_size(tmp_path):
+    historian = make_historian(tmp_path, retention=3600, max_bytes=10 ** 6)
+    for hour in range(4):
+        historian.record("State/RobotMoving", True, timestamp=hour * 3600.0)
+    historian.flush()
+    assert len(historian.segments()) == 4
+    historian.evict(now=4 * 3600.0)
+    assert [start for start, path in historian.segments()] == [2 * 3600, 3 * 3600]
+    historian.max_bytes = 1
+    historian.evict(now=4 * 3600.0)
+    assert [start for start, path in historian.segments()] == [3 * 3600]  # the newest one always stays
@@ -0,0 +1,121 @@
+from job_queue import JobQueue, QUEUED, ROBOT, DONE, CANCELLED, INTERRUPTED, invalid_request
+import json
+import time
+
+
+def journal(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_submit_is_journaled_and_restored(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    first = queue.submit(3, "SO", "fhs")
+    second = queue.submit(5, "SO", "method")
+    assert [record["op"] for record in journal(path)] == ["next_id", "submit", "submit"]
+
+    restored = JobQueue(str(path))
+    jobs = restored.load()
+    assert [(job.job_id, job.shelf, job.source, job.status) for job in jobs] == \
+        [(first.job_id, 3, "fhs", QUEUED), (second.job_id, 5, "method", QUEUED)]
+    assert restored.submit(1).job_id == second.job_id + 1
+
+
+def test_job_in_motion_is_interrupted_by_a_restart(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    queue.submit(3)
+    queue.submit(4)
+    queue.set_status(queue.next(0), ROBOT)
+
+    restored = JobQueue(str(path))
+    jobs = restored.load()
+    assert [(job.shelf, job.status) for job in jobs] == [(3, INTERRUPTED), (4, QUEUED)]
+    assert jobs[0].message == "interrupted in phase robot"
+    # compacted - only the queued job is left
+    assert [record.get("shelf") for record in journal(path)] == [None, 4]
+
+
+def test_replica_neither_interrupts_nor_compacts(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    queue.submit(3)
+    queue.set_status(queue.next(0), ROBOT)
+    before = path.read_text()
+
+    replica = JobQueue(str(path))
+    assert replica.load(replica=True) == []
+    assert path.read_text() == before
+
+
+def test_compaction_is_deferred_after_a_takeover(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    queue.submit(3)
+    queue.set_status(queue.next(0), ROBOT)
+    before = path.read_text()
+
+    taken_over = JobQueue(str(path))
+    taken_over.load(compact_after=time.time() + 60)
+    assert path.read_text() == before
+    taken_over.compact_after = 0.0
+    taken_over.compact()
+    assert len(journal(path)) == 1
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    queue.submit(7)
+    with open(str(path), "a") as out_file:
+        out_file.write('{"op": "submit", "id": 2, "sh')
+    assert [job.shelf for job in JobQueue(str(path)).load()] == [7]
+
+
+def test_queue_runs_empty_and_compacts(tmp_path):
+    path = tmp_path / "dtz_jobs"
+    queue = JobQueue(str(path))
+    queue.load()
+    queue.submit(2)
+    job = queue.next(0)
+    queue.finish(job)
+    assert job.status == DONE
+    assert queue.next(0) is None
+    assert journal(path) == [{"op": "next_id", "id": job.job_id}]
+
+
+def test_cancel_queued_job(tmp_path):
+    queue = JobQueue(str(tmp_path / "dtz_jobs"))
+    queue.load()
+    job = queue.submit(2)
+    assert queue.cancel(job.job_id) == "Cancelled"
+    assert job.status == CANCELLED
+    assert queue.depth() == 0
+    assert queue.cancel(job.job_id).startswith("Error - job {} is already".format(job.job_id))
+    assert queue.cancel(999).startswith("Error - unknown job")
+
+
+def test_cancel_running_job_sets_a_deadline(tmp_path):
+    queue = JobQueue(str(tmp_path / "dtz_jobs"))
+    queue.load()
+    queue.submit(2)
+    job = queue.next(0)
+    assert queue.cancel(job.job_id, 5.0).startswith("Cancelling")
+    assert job.cancellation.requested
+    assert 0 < job.cancellation.remaining() <= 5.0
+    job.cancellation.check()  # deadline not passed yet
+
+
+def test_invalid_request():
+    assert invalid_request(1, "SO") is None
+    assert invalid_request(9, "SO") is None
+    assert invalid_request(0, "SO") == "Error - invalid shelf"
+    assert invalid_request(10, "SO") == "Error - invalid shelf"
+    assert invalid_request(True, "SO") == "Error - invalid shelf"
+    assert invalid_request(3, "") == "Error - invalid movement"
+    assert invalid_request(3, "S O") == "Error - invalid movement"
@@ -0,0 +1,65 @@
+from motion_tracker import MotionTracker, ROBOT, BELT, START, DURATION, ANY
+import pytest
+
+
+def test_priors_until_enough_moves():
+    tracker = MotionTracker(robot_start_timeout=9.0, belt_start_timeout=3.0, robot_move_timeout=60.0,
+                            belt_velocity=0.05, min_samples=5, factor=1.5, margin=1.0)
+    assert tracker.deadline(ROBOT, START, "SO/3") == 9.0
+    assert tracker.deadline(BELT, START, tracker.belt_key(0.5)) == 3.0
+    assert tracker.deadline(ROBOT, DURATION, "SO/3") == 60.0
+    assert tracker.deadline(BELT, DURATION, tracker.belt_key(0.5)) == pytest.approx(0.5 / 0.05 * 1.5 + 1.0)
+
+
+def test_learned_duration_may_exceed_the_prior():
+    tracker = MotionTracker(robot_move_timeout=10.0, min_samples=3, q=0.95, factor=1.5, margin=1.0)
+    key = tracker.robot_key("SO", 3)
+    for seconds in (12.0, 14.0, 16.0):
+        tracker.record(ROBOT, DURATION, key, seconds)
+    assert tracker.deadline(ROBOT, DURATION, key) == pytest.approx(16.0 * 1.5 + 1.0)
+
+
+def test_learned_start_is_capped_by_the_configured_timeout():
+    tracker = MotionTracker(robot_start_timeout=2.0, min_samples=3)
+    for seconds in (3.0, 3.0, 3.0):
+        tracker.record(ROBOT, START, "SO/1", seconds)
+    assert tracker.deadline(ROBOT, START, "SO/1") == 2.0
+
+
+def test_robot_falls_back_to_all_keys_of_the_device():
+    tracker = MotionTracker(min_samples=3, factor=1.0, margin=0.0)
+    for shelf in (1, 2, 3):
+        tracker.record(ROBOT, DURATION, tracker.robot_key("SO", shelf), 20.0)
+    assert tracker.deadline(ROBOT, DURATION, tracker.robot_key("SO", 9)) == 20.0
+    assert tracker.deadline(ROBOT, DURATION, ANY) == 20.0
+
+
+def test_belt_duration_does_not_use_other_distances():
+    tracker = MotionTracker(belt_velocity=0.05, min_samples=3, factor=1.0, margin=0.0)
+    for _ in range(3):
+        tracker.record(BELT, DURATION, tracker.belt_key(0.1), 2.0)
+    assert tracker.deadline(BELT, DURATION, tracker.belt_key(0.5)) == pytest.approx(10.0)
+
+
+def test_window_forgets_old_moves():
+    tracker = MotionTracker(window=3, min_samples=3, q=0.95, factor=1.0, margin=0.0)
+    for seconds in (50.0, 5.0, 5.0, 5.0):
+        tracker.record(ROBOT, DURATION, "SO/1", seconds)
+    assert tracker.deadline(ROBOT, DURATION, "SO/1") == 5.0
+
+
+def test_stalls_are_counted():
+    tracker = MotionTracker()
+    tracker.stalled(ROBOT, START, "SO/1", 9.0)
+    assert tracker.stalls == 1
+    assert tracker.status()["stalls"] == 1
+
+
+def test_status_after_a_belt_move():
+    tracker = MotionTracker(belt_velocity=0.05, belt_distance=0.5, factor=1.0, margin=0.0)
+    tracker.record(BELT, DURATION, tracker.belt_key(0.55), 10.0)
+    tracker.record(BELT, START, tracker.belt_key(0.55), 0.2)
+    status = tracker.status()
+    assert status["deadlines"]["belt/duration/0.550"] == {"samples": 1, "deadline": 11.0}
+    # the moves of all distances fall back to the configured belt distance
+    assert status["deadlines"]["belt/duration/*"] == {"samples": 1, "deadline": 10.0}
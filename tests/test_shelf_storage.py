@@ -0,0 +1,66 @@
+from shelf_storage import ShelfStorage, grid_distance, grid_position
+import pytest
+
+
+def test_unknown_storage_is_full(tmp_path):
+    storage = ShelfStorage(str(tmp_path / "dtz_storage"))
+    assert storage.load() == [True] * 9
+
+
+def test_set_writes_the_file_format(tmp_path):
+    path = tmp_path / "dtz_storage"
+    storage = ShelfStorage(str(path))
+    storage.load()
+    assert storage.set(3, False) is True
+    assert path.read_text() == "1\n1\n0\n1\n1\n1\n1\n1\n1\n"
+    assert storage.set(3, False) is False  # no change, no write
+    assert not storage.is_occupied(3)
+    assert storage.is_occupied(4)
+
+
+def test_load_reads_older_files_without_line_breaks(tmp_path):
+    path = tmp_path / "dtz_storage"
+    path.write_text("0101\n0\n1")
+    assert ShelfStorage(str(path)).load() == [False, True, False, True, False, True, True, True, True]
+
+
+def test_listeners_get_only_the_changed_shelves(tmp_path):
+    path = tmp_path / "dtz_storage"
+    path.write_text("1\n" * 9)
+    storage = ShelfStorage(str(path))
+    storage.load()
+    changes = []
+    storage.add_listener(lambda shelf, occupied: changes.append((shelf, occupied)))
+    storage.set(9, False)
+    path.write_text("0\n" + "1\n" * 7 + "0\n")
+    storage.load()
+    assert changes == [(9, False), (1, False)]
+
+
+def test_failed_write_keeps_memory_and_file(tmp_path):
+    path = tmp_path / "dtz_storage"
+    storage = ShelfStorage(str(path))
+    storage.load()
+    storage.set(1, False)
+
+    def refuse():
+        raise IOError("not the active instance")
+    storage.fence = refuse
+    with pytest.raises(IOError):
+        storage.set(2, False)
+    assert storage.is_occupied(2)
+    assert ShelfStorage(str(path)).load() == storage.as_list()
+
+
+@pytest.mark.parametrize("shelf", [0, 10, -1])
+def test_shelf_out_of_range(tmp_path, shelf):
+    storage = ShelfStorage(str(tmp_path / "dtz_storage"))
+    with pytest.raises(ValueError):
+        storage.set(shelf, True)
+
+
+def test_grid():
+    assert grid_position(1) == (0, 0)
+    assert grid_position(6) == (1, 2)
+    assert grid_distance(1, 2) == 1
+    assert grid_distance(1, 9) == pytest.approx(2 ** 1.5)